@@ -1,14 +1,25 @@
 import os
-import json
+import sys
 import logging
 import time
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+# Shared modules live at the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from avatar_proxy import AvatarProxy, AVATAR_FALLBACK_TTL
+from response_compression import ResponseCompressor
+from json_codec import CodecJSONProvider
+from payment_gateways import (
+    GatewayError, create_gateway_router, gateway_error_response
+)
+from checkout_payloads import build_product_templates, customer_fields
+from nickname_directory import (
+    NicknameService, load_player_directory, is_valid_nickname, normalize_nickname, MAX_BATCH_SIZE
+)
+
 # Load environment variables
 load_dotenv()
 
@@ -23,12 +34,22 @@ app = Flask(__name__)
 # Enable CORS for all domains to allow Vercel frontend to talk to Vercel backend
 CORS(app)
 
+# Request parsing and jsonify() go through the shared codec (orjson when installed)
+app.json = CodecJSONProvider(app)
+
+# gzip/Brotli for API responses (brCodeBase64 alone is tens of KB)
+response_compressor = ResponseCompressor()
+response_compressor.init_app(app)
+
 # Configuration
 ABACATE_API_TOKEN = os.getenv("ABACATE_PAY_TOKEN", "abc_prod_0mDdwwz23aySmeUemLQmPhzw")
 ABACATE_API_URL = "https://api.abacatepay.com/v1/billing/create"
 ABACATE_PIX_URL = "https://api.abacatepay.com/v1/pixQrCode/create"
 API_TIMEOUT = int(os.getenv("API_TIMEOUT", 30))  # 30 seconds timeout
 
+# Payment providers (PAYMENT_PROVIDERS), routed by rolling latency/error stats with failover
+payment_router = create_gateway_router(ABACATE_API_TOKEN, ABACATE_API_URL, ABACATE_PIX_URL, API_TIMEOUT)
+
 # Product Pricing (in cents)
 PRICES = {
     "LORD": 4990,
@@ -37,23 +58,24 @@ PRICES = {
     "CHAMPION": 12990
 }
 
-# --- Helper Functions ---
+# Vercel deployment URL might need adjustment here for production return URLs
+RETURN_URL = os.getenv("RETURN_URL", "http://localhost:5500/success")
+COMPLETION_URL = os.getenv("COMPLETION_URL", "http://localhost:5500/success")
 
-def get_requests_session():
-    """
-    Creates a requests session with retry logic and backoff.
-    """
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=3,
-        backoff_factor=1,  # wait 1s, 2s, 4s...
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
-    return session
+# Gateway payload parts that only depend on the product, built once
+PRODUCT_TEMPLATES = build_product_templates(PRICES, RETURN_URL, COMPLETION_URL)
+
+# Player directory used to check that a nickname exists (e.g. "file:usercache.json", "sqlite:players.db").
+# When unset, nickname checks are disabled and every well-formed nickname is accepted.
+PLAYER_DIRECTORY = os.getenv("PLAYER_DIRECTORY")
+_player_directory = load_player_directory(PLAYER_DIRECTORY)
+nickname_service = NicknameService(_player_directory) if _player_directory else None
+
+# Avatar proxy (replaces hot-linking mc-heads.net from the browser).
+# Only /tmp is writable on Vercel, so the disk cache lives there.
+avatar_proxy = AvatarProxy(cache_dir=os.getenv("AVATAR_CACHE_DIR", "/tmp/avatar_cache"))
+
+# --- Helper Functions ---
 
 def validate_customer_data(data):
     """
@@ -82,6 +104,15 @@ def validate_customer_data(data):
     if len(cpf_clean) != 11:
         return False, "CPF must have 11 digits"
 
+    # The nickname ends up in RCON commands, so its format is always enforced
+    nickname = str(data.get('nickname', ''))
+    if not is_valid_nickname(nickname):
+        return False, "Invalid nickname format"
+
+    # Player must exist on the game server (answered from cache in the common case)
+    if nickname_service is not None and not nickname_service.exists(nickname):
+        return False, f"Player not found: {nickname}"
+
     return True, None
 
 def sanitize_phone(phone):
@@ -109,6 +140,63 @@ def sanitize_phone(phone):
 def home():
     return "Simplex Antigravity Payment API is running!"
 
+@app.route('/nickname/<nickname>', methods=['GET'])
+@app.route('/api/nickname/<nickname>', methods=['GET'])
+def check_nickname(nickname):
+    if not is_valid_nickname(nickname):
+        return jsonify({"error": "Invalid nickname format"}), 400
+
+    if nickname_service is None:
+        return jsonify({"nickname": nickname, "exists": True, "verified": False})
+
+    try:
+        exists = nickname_service.exists(nickname)
+    except Exception as e:
+        logger.exception(f"Nickname lookup failed for {nickname}: {str(e)}")
+        return jsonify({"error": "Player directory unavailable"}), 503
+
+    return jsonify({"nickname": nickname, "exists": exists, "verified": True})
+
+@app.route('/nicknames', methods=['POST'])
+@app.route('/api/nicknames', methods=['POST'])
+def check_nicknames():
+    data = request.json or {}
+    nicknames = data.get('nicknames')
+    if not isinstance(nicknames, list) or not nicknames:
+        return jsonify({"error": "Field 'nicknames' must be a non-empty list"}), 400
+    if len(nicknames) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} nicknames per request"}), 400
+
+    invalid = [n for n in nicknames if not isinstance(n, str) or not is_valid_nickname(n)]
+    if invalid:
+        return jsonify({"error": "Invalid nickname format", "invalid": invalid}), 400
+
+    if nickname_service is None:
+        return jsonify({"results": {n: True for n in nicknames}, "verified": False})
+
+    try:
+        found = nickname_service.exists_many(nicknames)
+    except Exception as e:
+        logger.exception(f"Batch nickname lookup failed: {str(e)}")
+        return jsonify({"error": "Player directory unavailable"}), 503
+
+    return jsonify({"results": {n: found[normalize_nickname(n)] for n in nicknames}, "verified": True})
+
+@app.route('/avatar/<nickname>', methods=['GET'])
+@app.route('/api/avatar/<nickname>', methods=['GET'])
+def avatar(nickname):
+    if is_valid_nickname(nickname):
+        entry, is_fallback = avatar_proxy.get(nickname)
+    else:
+        entry, is_fallback = avatar_proxy.fallback(), True
+
+    max_age = AVATAR_FALLBACK_TTL if is_fallback else avatar_proxy.ttl
+    response = make_response(entry.body)
+    response.headers['Content-Type'] = entry.content_type
+    response.headers['Cache-Control'] = f"public, max-age={max_age}"
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
 @app.route('/create-payment', methods=['POST'])
 @app.route('/api/create-payment', methods=['POST'])
 def create_payment():
@@ -141,76 +229,18 @@ def create_payment():
 
         logger.info(f"[{req_id}] Processing payment for {nickname} - {product_name} ({amount} cents)")
 
-        # 2. Prepare Payload
-        payload = {
-            "frequency": "ONE_TIME",
-            "methods": ["PIX"], # API only accepts PIX for now, others cause 422 error
-            "products": [
-                {
-                    "externalId": product_name,
-                    "name": f"VIP {product_name}",
-                    "quantity": 1,
-                    "price": amount,
-                    "description": f"VIP {product_name} para o jogador {nickname}"
-                }
-            ],
-            # Vercel deployment URL might need adjustment here for production return URLs
-            # For now keeping localhost as default or env var could be better
-            "returnUrl": os.getenv("RETURN_URL", "http://localhost:5500/success"),
-            "completionUrl": os.getenv("COMPLETION_URL", "http://localhost:5500/success"),
-            "customer": {
-                "name": nickname, 
-                "email": email,
-                "taxId": cpf_clean,
-                "cellphone": cellphone_clean
-            }
-        }
-
-        # 3. Send Request with Retries & Timeout
-        session = get_requests_session()
-        headers = {
-            "Authorization": f"Bearer {ABACATE_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        logger.debug(f"[{req_id}] Sending payload to Abacate Pay: {json.dumps(payload, indent=2)}")
-
-        response = session.post(
-            ABACATE_API_URL, 
-            json=payload, 
-            headers=headers, 
-            timeout=API_TIMEOUT
+        # 2. Create the charge on the best available provider (static payload parts come from the template)
+        charge = payment_router.create_billing(
+            PRODUCT_TEMPLATES[product_name], nickname, customer_fields(nickname, email, cpf_clean, cellphone_clean)
         )
-        
-        # 4. Handle Response
-        try:
-            result = response.json()
-        except json.JSONDecodeError:
-            logger.error(f"[{req_id}] Failed to decode JSON response: {response.text}")
-            return jsonify({"error": "Invalid response from Payment Gateway", "details": response.text}), 502
-
-        if response.status_code != 200:
-            error_details = result.get('error') or result
-            logger.error(f"[{req_id}] Abacate Pay API Error ({response.status_code}): {json.dumps(error_details)}")
-            return jsonify({"error": "Payment Gateway Error", "details": error_details}), response.status_code
 
         # Log Success
-        logger.info(f"[{req_id}] Payment created successfully. Bill ID: {result.get('data', {}).get('id')}")
-        
-        data_obj = result.get("data")
-        if not data_obj or not data_obj.get("url"):
-            logger.error(f"[{req_id}] No payment URL in successful response: {json.dumps(result)}")
-            return jsonify({"error": "No payment URL returned"}), 500
+        logger.info(f"[{req_id}] Payment created successfully on {charge.provider}. Bill ID: {charge.charge_id}")
 
-        return jsonify({"url": data_obj.get("url")})
+        return jsonify({"url": charge.url})
 
-    except requests.exceptions.Timeout:
-        logger.error(f"[{req_id}] Request to Payment Gateway timed out after {API_TIMEOUT}s")
-        return jsonify({"error": "Payment Gateway Timeout", "message": "The payment service is taking too long to respond. Please try again."}), 504
-    
-    except requests.exceptions.ConnectionError:
-        logger.error(f"[{req_id}] Connection error to Payment Gateway")
-        return jsonify({"error": "Connection Error", "message": "Could not connect to payment service. Please check your internet connection."}), 503
+    except GatewayError as e:
+        return gateway_error_response(req_id, e)
         
     except Exception as e:
         logger.exception(f"[{req_id}] Unexpected server error: {str(e)}")
@@ -243,65 +273,21 @@ def create_pix_payment():
         cellphone_clean = sanitize_phone(cellphone)
         cpf_clean = "".join(filter(str.isdigit, str(cpf)))
 
-        payload = {
-            "amount": amount,
-            "description": f"VIP {product_name} - {nickname}",
-            "customer": {
-                "name": nickname,
-                "email": email,
-                "taxId": cpf_clean,
-                "cellphone": cellphone_clean
-            }
-        }
-
-        session = get_requests_session()
-        headers = {
-            "Authorization": f"Bearer {ABACATE_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        response = session.post(
-            ABACATE_PIX_URL, 
-            json=payload, 
-            headers=headers,
-            timeout=API_TIMEOUT
+        charge = payment_router.create_pix(
+            PRODUCT_TEMPLATES[product_name], nickname, customer_fields(nickname, email, cpf_clean, cellphone_clean)
         )
-        
-        if response.status_code != 200:
-            logger.error(f"[{req_id}] Abacate Pay PIX Error: {response.text}")
-            return jsonify({"error": "Payment Gateway Error", "details": response.json()}), response.status_code
 
-        result = response.json()
-        logger.info(f"[{req_id}] Abacate Pay Response: {json.dumps(result)}")
-        
-        if result.get('success') is False:
-             raw_error = result.get('error', 'Unknown error from payment provider')
-             
-             # Translate common errors
-             error_msg = raw_error
-             if "taxId" in raw_error:
-                 error_msg = "CPF inválido. Verifique se o número está correto."
-             elif "email" in raw_error:
-                 error_msg = "E-mail inválido."
-             elif "cellphone" in raw_error:
-                 error_msg = "Número de celular inválido."
-                 
-             logger.error(f"[{req_id}] Abacate Pay returned failure: {raw_error} -> {error_msg}")
-             return jsonify({"error": error_msg}), 400
-
-        data_obj = result.get('data')
-        if not data_obj:
-            logger.error(f"[{req_id}] No data object in response")
-            return jsonify({"error": "Invalid response from payment provider"}), 502
-
-        logger.info(f"[{req_id}] PIX generated successfully")
+        logger.info(f"[{req_id}] PIX generated successfully on {charge.provider}: {charge.charge_id}")
         
         return jsonify({
-            "brCode": data_obj.get('brCode'),
-            "brCodeBase64": data_obj.get('brCodeBase64'),
-            "pixId": data_obj.get('id')
+            "brCode": charge.br_code,
+            "brCodeBase64": charge.br_code_base64,
+            "pixId": charge.charge_id
         })
 
+    except GatewayError as e:
+        return gateway_error_response(req_id, e)
+
     except Exception as e:
         logger.exception(f"[{req_id}] Unexpected error in PIX generation: {str(e)}")
         return jsonify({"error": str(e)}), 500
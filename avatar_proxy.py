@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+AVATAR_UPSTREAM_URL = os.getenv("AVATAR_UPSTREAM_URL", "https://mc-heads.net/body/{nickname}/right")
+AVATAR_CACHE_DIR = os.getenv("AVATAR_CACHE_DIR", ".avatar_cache")
+AVATAR_TTL = int(os.getenv("AVATAR_TTL", 86400))  # how long a skin is served before revalidating, seconds
+AVATAR_UPSTREAM_TIMEOUT = float(os.getenv("AVATAR_UPSTREAM_TIMEOUT", 2))  # seconds, then fall back
+AVATAR_MEMORY_BYTES = int(os.getenv("AVATAR_MEMORY_BYTES", 16 * 1024 * 1024))
+AVATAR_DISK_BYTES = int(os.getenv("AVATAR_DISK_BYTES", 256 * 1024 * 1024))  # least recently used skins are deleted past this
+AVATAR_FALLBACK_TTL = 60  # browsers retry a fallback image after a minute
+AVATAR_POOL_SIZE = 10
+
+DEFAULT_NICKNAME = "Steve"
+FALLBACK_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "steve.png")
+
+
+class AvatarEntry:
+    """
+    A cached avatar image plus what is needed to revalidate it upstream.
+    """
+    __slots__ = ("body", "content_type", "etag", "upstream_etag", "last_modified", "fetched_at")
+
+    def __init__(self, body, content_type="image/png", upstream_etag=None, last_modified=None, fetched_at=None):
+        self.body = body
+        self.content_type = content_type
+        # Our own ETag is a content hash so it stays stable across upstream revalidations
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.upstream_etag = upstream_etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+
+    def is_fresh(self, ttl):
+        return time.time() - self.fetched_at < ttl
+
+    def metadata(self):
+        return {
+            "content_type": self.content_type,
+            "upstream_etag": self.upstream_etag,
+            "last_modified": self.last_modified,
+            "fetched_at": self.fetched_at,
+        }
+
+
+class MemoryLRU:
+    """
+    Thread-safe LRU bounded by the total size of the cached images.
+    """
+
+    def __init__(self, max_bytes=AVATAR_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = len(entry.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old.body)
+            self._data[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= len(evicted.body)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache:
+    """
+    Stores each avatar as <key>.img with a <key>.json sidecar holding its metadata.
+    Writes go through a temp file + os.replace so readers never see partial files.
+    Total size is bounded by max_bytes; the least recently used avatars are
+    deleted first (ordered by file mtime after a restart).
+    """
+
+    def __init__(self, directory=AVATAR_CACHE_DIR, max_bytes=AVATAR_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._sizes = OrderedDict()  # key -> bytes on disk, least recently used first
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+        except OSError as e:
+            # Read-only filesystem: keep serving from memory only
+            logger.warning(f"Avatar disk cache disabled ({directory}): {str(e)}")
+
+    def _scan(self):
+        found = []
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if item.name.endswith(".img"):
+                    stat = item.stat()
+                    found.append((stat.st_mtime, item.name[:-len(".img")], stat.st_size))
+        for _, key, size in sorted(found):
+            self._sizes[key] = size
+            self.current_bytes += size
+        self._evict()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".img", base + ".json"
+
+    def get(self, key):
+        img_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(img_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return AvatarEntry(body, **meta)
+
+    def put(self, key, entry):
+        img_path, meta_path = self._paths(key)
+        try:
+            _atomic_write(img_path, entry.body, 'wb')
+            _atomic_write(meta_path, json.dumps(entry.metadata()), 'w')
+        except OSError as e:
+            logger.warning(f"Could not write avatar cache for {key}: {str(e)}")
+            return
+        with self._lock:
+            self.current_bytes += len(entry.body) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(entry.body)
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self.current_bytes -= size
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+def _atomic_write(path, data, mode):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class _InflightFetch:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AvatarProxy:
+    """
+    Serves player avatars from memory, then disk, then upstream.
+    Concurrent misses for the same player share a single upstream request,
+    and a slow or failing upstream falls back to a stale copy or to Steve.
+    """
+
+    def __init__(self, upstream_url=AVATAR_UPSTREAM_URL, cache_dir=AVATAR_CACHE_DIR, ttl=AVATAR_TTL,
+                 timeout=AVATAR_UPSTREAM_TIMEOUT, memory_bytes=AVATAR_MEMORY_BYTES, disk_bytes=AVATAR_DISK_BYTES,
+                 session=None):
+        self.upstream_url = upstream_url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes)
+        self.session = session or self._build_session()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._fallback = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "upstream_fetches": 0, "revalidated": 0, "fallbacks": 0}
+
+    @staticmethod
+    def _build_session():
+        """
+        One pooled session for all upstream calls. No retries: a slow upstream
+        should fall back quickly instead of holding the request.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=AVATAR_POOL_SIZE, pool_maxsize=AVATAR_POOL_SIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get(self, nickname):
+        """
+        Returns (entry, is_fallback). is_fallback is True for stale copies and
+        for Steve, so callers only let browsers cache them briefly.
+        """
+        key = nickname.lower()
+
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.stats["memory_hits"] += 1
+        else:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.stats["disk_hits"] += 1
+                self.memory.put(key, entry)
+
+        if entry is not None and entry.is_fresh(self.ttl):
+            return entry, False
+
+        fetched = self._fetch_coalesced(key, nickname, entry)
+        if fetched is not None:
+            return fetched, False
+
+        # Upstream failed: a stale copy beats a generic skin
+        if entry is not None:
+            return entry, True
+
+        self.stats["fallbacks"] += 1
+        return self.fallback(), True
+
+    def fallback(self):
+        if self._fallback is None:
+            entry = self.memory.get(DEFAULT_NICKNAME.lower()) or self.disk.get(DEFAULT_NICKNAME.lower())
+            if entry is None:
+                with open(FALLBACK_IMAGE_PATH, 'rb') as f:
+                    entry = AvatarEntry(f.read())
+            self._fallback = entry
+        return self._fallback
+
+    def _fetch_coalesced(self, key, nickname, stale):
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _InflightFetch()
+                self._inflight[key] = call
+
+        if not leader:
+            call.event.wait(self.timeout)
+            return call.result
+
+        try:
+            call.result = self._fetch_upstream(key, nickname, stale)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Avatar upstream failed for {nickname}: {str(e)}")
+            call.error = e
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def _fetch_upstream(self, key, nickname, stale):
+        headers = {}
+        if stale is not None:
+            if stale.upstream_etag:
+                headers["If-None-Match"] = stale.upstream_etag
+            if stale.last_modified:
+                headers["If-Modified-Since"] = stale.last_modified
+
+        self.stats["upstream_fetches"] += 1
+        response = self.session.get(self.upstream_url.format(nickname=nickname), headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304 and stale is not None:
+            self.stats["revalidated"] += 1
+            entry = AvatarEntry(stale.body, stale.content_type, stale.upstream_etag, stale.last_modified)
+        elif response.status_code == 200 and response.content:
+            entry = AvatarEntry(
+                response.content,
+                content_type=response.headers.get("Content-Type", "image/png"),
+                upstream_etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+        else:
+            logger.warning(f"Avatar upstream returned {response.status_code} for {nickname}")
+            return None
+
+        self.memory.put(key, entry)
+        self.disk.put(key, entry)
+        return entry
@@ -0,0 +1,72 @@
+from types import MappingProxyType
+
+
+class ProductTemplate:
+    """
+    Everything about a product's gateway payloads that does not depend on
+    the buyer, computed once when prices load. Per request only the
+    customer fields are filled in.
+    """
+    __slots__ = ("name", "amount", "_billing", "_billing_product", "_billing_description", "_pix_description")
+
+    def __init__(self, name, amount, return_url, completion_url):
+        self.name = name
+        self.amount = amount
+        self._billing = MappingProxyType({
+            "frequency": "ONE_TIME",
+            "methods": ("PIX",),  # API only accepts PIX for now, others cause 422 error
+            "returnUrl": return_url,
+            "completionUrl": completion_url,
+        })
+        self._billing_product = MappingProxyType({
+            "externalId": name,
+            "name": f"VIP {name}",
+            "quantity": 1,
+            "price": amount,
+        })
+        self._billing_description = f"VIP {name} para o jogador "
+        self._pix_description = f"VIP {name} - "
+
+    def billing_payload(self, nickname, customer):
+        """
+        Payload for /v1/billing/create.
+        """
+        product = dict(self._billing_product)
+        product["description"] = self._billing_description + nickname
+        payload = dict(self._billing)
+        payload["products"] = [product]
+        payload["customer"] = customer
+        return payload
+
+    def pix_payload(self, nickname, customer, expires_in=None):
+        """
+        Payload for /v1/pixQrCode/create. expires_in (seconds) makes the
+        QR code expire together with a flash-sale reservation.
+        """
+        payload = {
+            "amount": self.amount,
+            "description": self._pix_description + nickname,
+            "customer": customer,
+        }
+        if expires_in is not None:
+            payload["expiresIn"] = expires_in
+        return payload
+
+
+def build_product_templates(prices, return_url, completion_url):
+    """
+    Returns a read-only {product_name: ProductTemplate} mapping.
+    """
+    return MappingProxyType({
+        name: ProductTemplate(name, amount, return_url, completion_url)
+        for name, amount in prices.items()
+    })
+
+
+def customer_fields(nickname, email, cpf_clean, cellphone_clean):
+    return {
+        "name": nickname,
+        "email": email,
+        "taxId": cpf_clean,
+        "cellphone": cellphone_clean,
+    }
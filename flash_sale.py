@@ -0,0 +1,422 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+FLASH_SALE_SHARDS = int(os.getenv("FLASH_SALE_SHARDS", 16))
+FLASH_SALE_RESERVATION_TTL = int(os.getenv("FLASH_SALE_RESERVATION_TTL", 900))  # seconds, also the PIX expiry
+FLASH_SALE_PAYMENT_GRACE = int(os.getenv("FLASH_SALE_PAYMENT_GRACE", 300))  # seconds a hold outlives its PIX
+FLASH_SALE_SWEEP_INTERVAL = 5  # seconds between expiry sweeps
+FLASH_SALE_DURABLE_TIMEOUT = 5  # seconds a checkout waits for its reservation to be committed
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS flash_sales (
+        sale_id TEXT PRIMARY KEY,
+        product TEXT NOT NULL,
+        stock INTEGER NOT NULL,
+        price INTEGER NOT NULL,
+        starts_at REAL NOT NULL,
+        ends_at REAL NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS flash_reservations (
+        reservation_id TEXT PRIMARY KEY,
+        sale_id TEXT NOT NULL,
+        product TEXT NOT NULL,
+        order_id TEXT,
+        status TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_flash_reservations_order ON flash_reservations (order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_flash_reservations_status ON flash_reservations (sale_id, status)",
+]
+
+# confirm() outcomes
+CONFIRMED = "confirmed"
+NO_RESERVATION = "no_reservation"  # not a flash-sale order
+OVERSOLD = "oversold"  # paid after its hold was released, and no unit was left for it
+
+
+class Reservation:
+    __slots__ = ("id", "sale", "shard", "expires_at", "order_id", "committed", "confirmed")
+
+    def __init__(self, reservation_id, sale, shard, expires_at, order_id=None, committed=None):
+        self.id = reservation_id
+        self.sale = sale
+        self.shard = shard
+        self.expires_at = expires_at
+        self.order_id = order_id
+        self.committed = committed
+        self.confirmed = False
+
+    @property
+    def product(self):
+        return self.sale.product
+
+    def wait_durable(self, timeout=FLASH_SALE_DURABLE_TIMEOUT):
+        """
+        Blocks until the reservation is on disk; False if it timed out or
+        the write was dropped. Call it after the gateway round trip so the
+        wait overlaps with work the checkout does anyway.
+        """
+        return self.committed is None or self.committed.wait_committed(timeout)
+
+
+class _Shard:
+    __slots__ = ("lock", "available", "sold", "reservations")
+
+    def __init__(self, available):
+        self.lock = threading.Lock()
+        self.available = available
+        self.sold = 0
+        self.reservations = {}
+
+
+class FlashSale:
+    """
+    A time-boxed, limited-stock sale of one product. Stock is split across
+    shards, each with its own lock, so concurrent checkouts rarely contend.
+    """
+
+    def __init__(self, sale_id, product, stock, price, starts_at, ends_at, shard_count=FLASH_SALE_SHARDS,
+                 available=None):
+        self.sale_id = sale_id
+        self.product = product
+        self.stock = stock
+        self.price = price
+        self.starts_at = starts_at
+        self.ends_at = ends_at
+        available = stock if available is None else available
+        base, extra = divmod(max(available, 0), shard_count)
+        self.shards = [_Shard(base + (1 if i < extra else 0)) for i in range(shard_count)]
+
+    def is_active(self, now=None):
+        now = time.time() if now is None else now
+        return self.starts_at <= now < self.ends_at
+
+    def available(self):
+        # Unlocked reads: good enough for display, never used for decisions
+        return sum(shard.available for shard in self.shards)
+
+    def sold(self):
+        return sum(shard.sold for shard in self.shards)
+
+    def reserved(self):
+        return sum(len(shard.reservations) for shard in self.shards)
+
+
+class FlashSaleInventory:
+    """
+    Atomic reserve / confirm / release of flash-sale stock.
+
+    reserve() takes one unit from a shard picked round-robin and falls back
+    to the other shards only when that one is empty, so there is no global
+    lock on the request path and stock can never go below zero. Every
+    state change is journaled through the order ledger's batched writer;
+    on start-up the journal rebuilds sold counts and live reservations.
+    A reservation is held for its PIX expiry plus FLASH_SALE_PAYMENT_GRACE
+    (late webhooks), then released by a background sweeper.
+    """
+
+    def __init__(self, ledger, shard_count=FLASH_SALE_SHARDS, reservation_ttl=FLASH_SALE_RESERVATION_TTL,
+                 payment_grace=FLASH_SALE_PAYMENT_GRACE, sweep_interval=FLASH_SALE_SWEEP_INTERVAL):
+        self.ledger = ledger
+        self.shard_count = shard_count
+        self.reservation_ttl = reservation_ttl
+        self.payment_grace = payment_grace
+        self._sales = {}  # sale_id -> FlashSale, including ended ones
+        self._current = {}  # product -> its latest FlashSale
+        self._by_order = {}  # order_id -> live or confirmed Reservation
+        self._next_shard = itertools.count()
+        self._config_lock = threading.Lock()
+        self._local = threading.local()
+        self._load()
+
+        self._sweeper = threading.Thread(target=self._sweep_loop, args=(sweep_interval,),
+                                         name="flash-sale-sweeper", daemon=True)
+        self._sweeper.start()
+
+    # --- Persistence ---
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.ledger.path)
+            self._local.conn = conn
+        return conn
+
+    def _load(self):
+        conn = self._conn()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        now = time.time()
+        sales = conn.execute(
+            "SELECT sale_id, product, stock, price, starts_at, ends_at FROM flash_sales ORDER BY created_at"
+        ).fetchall()
+        sold = dict(conn.execute(
+            "SELECT sale_id, COUNT(*) FROM flash_reservations WHERE status = 'confirmed' GROUP BY sale_id"
+        ).fetchall())
+        live = {}
+        for row in conn.execute(
+            "SELECT reservation_id, sale_id, order_id, expires_at FROM flash_reservations "
+            "WHERE status = 'reserved' AND expires_at > ?", (now,)
+        ):
+            live.setdefault(row[1], []).append(row)
+
+        self.ledger.enqueue_write(
+            "UPDATE flash_reservations SET status = 'released' WHERE status = 'reserved' AND expires_at <= ?", (now,)
+        )
+
+        for sale_id, product, stock, price, starts_at, ends_at in sales:
+            held = live.get(sale_id, [])
+            sale = FlashSale(sale_id, product, stock, price, starts_at, ends_at, self.shard_count,
+                             available=stock - sold.get(sale_id, 0) - len(held))
+            sale.shards[0].sold = sold.get(sale_id, 0)
+            for index, (reservation_id, _, order_id, expires_at) in enumerate(held):
+                shard = index % self.shard_count
+                reservation = Reservation(reservation_id, sale, shard, expires_at, order_id)
+                sale.shards[shard].reservations[reservation_id] = reservation
+                if order_id:
+                    self._by_order[order_id] = reservation
+            self._sales[sale_id] = sale
+            self._current[product] = sale  # ordered by creation, so the latest wins
+
+    # --- Configuration ---
+
+    def configure(self, product, stock, price, starts_at, ends_at, now=None):
+        """
+        Edits the product's current sale while it has not ended (units
+        already sold or reserved in it count against the new stock), and
+        otherwise starts a new sale with its own id and fresh stock.
+        Admin-only; briefly locks every shard of the edited sale.
+        """
+        now = time.time() if now is None else now
+        with self._config_lock:
+            old = self._current.get(product)
+            if old is not None and old.ends_at <= now:
+                old = None  # a new drop; the ended one keeps its own holds until they settle
+            sold, live = 0, []
+            if old is not None:
+                for shard in old.shards:
+                    shard.lock.acquire()
+                sold = old.sold()
+                live = [r for shard in old.shards for r in shard.reservations.values()]
+
+            try:
+                sale_id = old.sale_id if old is not None else uuid.uuid4().hex
+                sale = FlashSale(sale_id, product, stock, price, starts_at, ends_at, self.shard_count,
+                                 available=stock - sold - len(live))
+                sale.shards[0].sold = sold
+                for index, reservation in enumerate(live):
+                    reservation.sale = sale
+                    reservation.shard = index % self.shard_count
+                    sale.shards[reservation.shard].reservations[reservation.id] = reservation
+                self._sales[sale_id] = sale
+                self._current[product] = sale
+            finally:
+                if old is not None:
+                    for shard in old.shards:
+                        shard.available = 0  # anyone still holding the old sale finds it empty
+                        shard.lock.release()
+
+        self.ledger.enqueue_write(
+            "INSERT INTO flash_sales (sale_id, product, stock, price, starts_at, ends_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(sale_id) DO UPDATE SET stock = excluded.stock, "
+            "price = excluded.price, starts_at = excluded.starts_at, ends_at = excluded.ends_at",
+            (sale_id, product, stock, price, starts_at, ends_at, time.time())
+        )
+        logger.info(f"Flash sale {sale_id} for {product}: {stock} units at {price} cents, {starts_at} -> {ends_at}")
+        return sale
+
+    def active_sale(self, product, now=None):
+        sale = self._current.get(product)
+        if sale is not None and sale.is_active(now):
+            return sale
+        return None
+
+    # --- Reservation lifecycle ---
+
+    def _hold_until(self):
+        return time.time() + self.reservation_ttl + self.payment_grace
+
+    def reserve(self, sale):
+        """
+        Takes one unit. Returns a Reservation, or None when sold out
+        (expired holds are returned to stock by the sweeper, not here).
+        """
+        count = len(sale.shards)
+        start = next(self._next_shard) % count  # spreads concurrent checkouts over the shards
+        expires_at = self._hold_until()
+        for offset in range(count):
+            index = (start + offset) % count
+            shard = sale.shards[index]
+            if shard.available <= 0:
+                continue  # cheap unlocked skip; re-checked under the lock
+            with shard.lock:
+                if shard.available <= 0:
+                    continue
+                shard.available -= 1
+                reservation = Reservation(uuid.uuid4().hex, sale, index, expires_at)
+                shard.reservations[reservation.id] = reservation
+
+            self.ledger.enqueue_write(
+                "INSERT INTO flash_reservations (reservation_id, sale_id, product, status, expires_at, created_at) "
+                "VALUES (?, ?, ?, 'reserved', ?, ?)",
+                (reservation.id, sale.sale_id, sale.product, expires_at, time.time())
+            )
+            reservation.committed = self.ledger.commit_marker()
+            return reservation
+        return None
+
+    def attach_order(self, reservation, order_id):
+        """
+        Links a reservation to the gateway charge that will pay for it. The
+        hold is restarted here because the charge's expiry counts from its
+        creation, not from reserve().
+        """
+        expires_at = self._hold_until()
+        with reservation.sale.shards[reservation.shard].lock:
+            reservation.order_id = order_id
+            reservation.expires_at = expires_at
+        self._by_order[order_id] = reservation
+        self.ledger.enqueue_write(
+            "UPDATE flash_reservations SET order_id = ?, expires_at = ? WHERE reservation_id = ?",
+            (order_id, expires_at, reservation.id)
+        )
+        reservation.committed = self.ledger.commit_marker()
+
+    def release(self, reservation):
+        """
+        Returns an unpaid reservation's unit to stock (gateway failure).
+        """
+        shard = reservation.sale.shards[reservation.shard]
+        with shard.lock:
+            if shard.reservations.pop(reservation.id, None) is None:
+                return False
+            shard.available += 1
+        if reservation.order_id:
+            self._by_order.pop(reservation.order_id, None)
+        self.ledger.enqueue_write(
+            "UPDATE flash_reservations SET status = 'released' WHERE reservation_id = ?", (reservation.id,)
+        )
+        return True
+
+    def confirm(self, order_id):
+        """
+        Turns the reservation behind a paid order into a sale. Safe to call
+        again for the same order. Returns CONFIRMED, NO_RESERVATION for
+        orders outside flash sales, or OVERSOLD when the hold was already
+        released and the sale has no unit left to give the late payer.
+        """
+        reservation = self._by_order.get(order_id)
+        if reservation is not None:
+            shard = reservation.sale.shards[reservation.shard]
+            with shard.lock:
+                if reservation.confirmed:
+                    return CONFIRMED
+                held = shard.reservations.pop(reservation.id, None) is not None
+                if held:
+                    reservation.confirmed = True
+                    shard.sold += 1
+            if held:
+                self.ledger.enqueue_write(
+                    "UPDATE flash_reservations SET status = 'confirmed' WHERE reservation_id = ?", (reservation.id,)
+                )
+                return CONFIRMED
+        return self._confirm_released(order_id)
+
+    def _confirm_released(self, order_id):
+        row = self._conn().execute(
+            "SELECT reservation_id, sale_id, status FROM flash_reservations WHERE order_id = ?", (order_id,)
+        ).fetchone()
+        if row is None:
+            return NO_RESERVATION
+        reservation_id, sale_id, status = row
+        if status == 'confirmed':
+            return CONFIRMED
+
+        # Paid after the sweeper gave the unit back: take another one if any is left
+        sale = self._sales.get(sale_id)
+        index = self._take_unit(sale) if sale is not None else None
+        if index is None:
+            logger.error(f"Order {order_id} was paid after its flash-sale hold was released and the sale is sold out")
+            return OVERSOLD
+
+        reservation = Reservation(reservation_id, sale, index, 0, order_id)
+        reservation.confirmed = True
+        self._by_order[order_id] = reservation
+        self.ledger.enqueue_write(
+            "UPDATE flash_reservations SET status = 'confirmed' WHERE reservation_id = ?", (reservation_id,)
+        )
+        logger.warning(f"Order {order_id} was paid after its flash-sale hold was released; took a new unit")
+        return CONFIRMED
+
+    def _take_unit(self, sale):
+        count = len(sale.shards)
+        start = next(self._next_shard) % count
+        for offset in range(count):
+            index = (start + offset) % count
+            shard = sale.shards[index]
+            with shard.lock:
+                if shard.available > 0:
+                    shard.available -= 1
+                    shard.sold += 1
+                    return index
+        return None
+
+    def expire(self, sale, now=None):
+        """
+        Releases this sale's reservations past their expiry. Returns how many.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        for shard in sale.shards:
+            with shard.lock:
+                stale = [r for r in shard.reservations.values() if r.expires_at <= now]
+                for reservation in stale:
+                    del shard.reservations[reservation.id]
+                shard.available += len(stale)
+            expired.extend(stale)
+
+        for reservation in expired:
+            if reservation.order_id:
+                self._by_order.pop(reservation.order_id, None)
+            self.ledger.enqueue_write(
+                "UPDATE flash_reservations SET status = 'released' WHERE reservation_id = ?", (reservation.id,)
+            )
+        if expired:
+            logger.info(f"Released {len(expired)} expired {sale.product} reservations")
+        return len(expired)
+
+    def _sweep_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            for sale in list(self._sales.values()):
+                if not sale.reserved():
+                    continue
+                try:
+                    self.expire(sale)
+                except Exception as e:
+                    logger.error(f"Flash sale sweep failed for {sale.product}: {str(e)}")
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        return {
+            product: {
+                "sale_id": sale.sale_id,
+                "stock": sale.stock,
+                "available": sale.available(),
+                "price": sale.price,
+                "starts_at": sale.starts_at,
+                "ends_at": sale.ends_at,
+                "active": sale.is_active(now),
+            }
+            for product, sale in self._current.items()
+        }
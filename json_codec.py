@@ -0,0 +1,72 @@
+import os
+import json
+import logging
+
+from flask.json.provider import JSONProvider
+
+logger = logging.getLogger(__name__)
+
+# "auto" picks orjson when installed; "stdlib" forces the standard library
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib fallback
+    orjson = None
+
+
+def _select_backend(name):
+    if name == "orjson" and orjson is None:
+        logger.warning("JSON_BACKEND=orjson but orjson is not installed, using stdlib json")
+    if name in ("auto", "orjson") and orjson is not None:
+        return "orjson"
+    return "stdlib"
+
+
+BACKEND = _select_backend(JSON_BACKEND)
+
+if BACKEND == "orjson":
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        """
+        Serializes obj to compact UTF-8 JSON bytes.
+        """
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    _decoder = json.JSONDecoder()
+
+    def dumps(obj):
+        """
+        Serializes obj to compact UTF-8 JSON bytes.
+        """
+        return _encoder.encode(obj).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return _decoder.decode(data)
+
+
+class CodecJSONProvider(JSONProvider):
+    """
+    Routes Flask's request parsing and jsonify() through the selected codec.
+    Install with app.json = CodecJSONProvider(app).
+    """
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        # Skip the str round trip: hand the encoded bytes straight to the response
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
@@ -0,0 +1,366 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Minecraft Java nicknames: 3-16 chars, letters/numbers/underscore (same rule as script.js)
+NICKNAME_PATTERN = re.compile(r'^[a-zA-Z0-9_]{3,16}$')
+
+CACHE_SIZE = int(os.getenv("NICKNAME_CACHE_SIZE", 10000))
+CACHE_TTL = int(os.getenv("NICKNAME_CACHE_TTL", 300))  # positive answers, seconds
+NEGATIVE_CACHE_TTL = int(os.getenv("NICKNAME_NEGATIVE_CACHE_TTL", 60))  # unknown names, seconds
+BLOOM_REFRESH_INTERVAL = int(os.getenv("NICKNAME_BLOOM_REFRESH", 300))  # seconds
+MAX_BATCH_SIZE = 100
+
+
+def is_valid_nickname(nickname):
+    return bool(nickname) and bool(NICKNAME_PATTERN.match(nickname))
+
+
+def normalize_nickname(nickname):
+    """
+    Minecraft nicknames are case-insensitive, so every lookup uses the lowercase form.
+    """
+    return str(nickname).strip().lower()
+
+
+# --- Player Directory Backends ---
+
+class PlayerDirectory:
+    """
+    Source of truth for which players exist.
+    Backends must implement lookup_many() and iter_nicknames().
+    """
+
+    def lookup_many(self, nicknames):
+        """
+        Returns the subset of the given (normalized) nicknames that exist.
+        """
+        raise NotImplementedError
+
+    def iter_nicknames(self):
+        """
+        Yields every known (normalized) nickname. Used to build the Bloom filter.
+        """
+        raise NotImplementedError
+
+    def version(self):
+        """
+        Cheap token that changes whenever players are added, or None when the
+        backend cannot tell (the Bloom filter is then refreshed on a timer only).
+        """
+        return None
+
+
+class FilePlayerDirectory(PlayerDirectory):
+    """
+    Reads players from a local file, reloaded whenever its mtime changes.
+    Accepts either a plain text file (one nickname per line) or the game's
+    own usercache.json ([{"name": ..., "uuid": ...}, ...]).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._names = frozenset()
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            logger.warning(f"Player directory file not found: {self.path}")
+            return self._names
+
+        if mtime == self._mtime:
+            return self._names
+
+        with self._lock:
+            if mtime == self._mtime:
+                return self._names
+
+            with open(self.path, 'r', encoding='utf-8') as f:
+                if self.path.endswith('.json'):
+                    entries = json.load(f)
+                    names = (entry.get('name', '') for entry in entries)
+                else:
+                    names = (line for line in f)
+                self._names = frozenset(normalize_nickname(n) for n in names if n.strip())
+
+            self._mtime = mtime
+            logger.info(f"Loaded {len(self._names)} players from {self.path}")
+            return self._names
+
+    def lookup_many(self, nicknames):
+        names = self._load()
+        return {n for n in nicknames if n in names}
+
+    def iter_nicknames(self):
+        return iter(self._load())
+
+    def version(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+
+class SQLitePlayerDirectory(PlayerDirectory):
+    """
+    Reads players from a SQLite table (default: players(nickname)).
+    A connection is opened per thread since sqlite3 connections are not shareable.
+    """
+
+    def __init__(self, path, table="players", column="nickname"):
+        self.path = path
+        self.table = table
+        self.column = column
+        self._local = threading.local()
+        self._version_conn = None
+        self._version_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def lookup_many(self, nicknames):
+        nicknames = list(nicknames)
+        if not nicknames:
+            return set()
+        placeholders = ",".join("?" * len(nicknames))
+        query = (
+            f"SELECT lower({self.column}) FROM {self.table} "
+            f"WHERE lower({self.column}) IN ({placeholders})"
+        )
+        rows = self._connection().execute(query, nicknames).fetchall()
+        return {row[0] for row in rows}
+
+    def iter_nicknames(self):
+        cursor = self._connection().execute(f"SELECT lower({self.column}) FROM {self.table}")
+        for row in cursor:
+            yield row[0]
+
+    def version(self):
+        # data_version only changes between calls on the same connection, so one is kept for it
+        with self._version_lock:
+            if self._version_conn is None:
+                self._version_conn = sqlite3.connect(self.path, check_same_thread=False)
+            return self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+
+def load_player_directory(spec):
+    """
+    Builds a PlayerDirectory from a spec string such as
+    'file:players.txt', 'file:/srv/mc/usercache.json' or 'sqlite:players.db'.
+    Returns None when no spec is given (nickname checks disabled).
+    """
+    if not spec:
+        return None
+
+    kind, _, path = spec.partition(':')
+    if kind == 'file':
+        return FilePlayerDirectory(path)
+    if kind == 'sqlite':
+        return SQLitePlayerDirectory(path)
+    raise ValueError(f"Unknown player directory: {spec}")
+
+
+# --- Caching ---
+
+class TTLCache:
+    """
+    Thread-safe LRU cache where each entry carries its own expiry time.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def discard_value(self, value):
+        """
+        Drops every entry holding the given value.
+        """
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if v == value]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter. A negative answer is definite, so names that are
+    not in the filter can be rejected without touching the directory.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        # Standard sizing: m = -n*ln(p)/ln(2)^2, k = m/n*ln(2)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class NicknameService:
+    """
+    Answers "does this player exist?" from memory whenever possible:
+    1. LRU/TTL cache (positive and negative answers, different TTLs)
+    2. Bloom filter of every known player (definite negatives)
+    3. The PlayerDirectory backend, only on cache misses
+
+    When the directory reports a new version, cached negatives are dropped
+    and the Bloom filter is bypassed until a background rebuild catches up,
+    so a player who just joined is never turned away by stale data.
+    """
+
+    def __init__(self, directory, cache_size=CACHE_SIZE, ttl=CACHE_TTL,
+                 negative_ttl=NEGATIVE_CACHE_TTL, bloom_refresh=BLOOM_REFRESH_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.bloom_refresh = bloom_refresh
+        self.cache = TTLCache(cache_size)
+        self._bloom = None
+        self._bloom_version = None
+        self._bloom_built_at = None
+        self._bloom_lock = threading.Lock()
+        self._seen_version = None
+        self.stats = {"cache_hits": 0, "bloom_rejections": 0, "backend_lookups": 0}
+
+    def rebuild_bloom(self):
+        """
+        Rebuilds the Bloom filter from the directory. Readers keep using the
+        previous filter until the new one is swapped in.
+        """
+        version = self.directory.version()
+        names = list(self.directory.iter_nicknames())
+        bloom = BloomFilter(capacity=len(names) * 2)
+        for name in names:
+            bloom.add(name)
+        self._bloom, self._bloom_version = bloom, version
+        self._bloom_built_at = time.monotonic()
+        logger.info(f"Nickname Bloom filter rebuilt with {len(names)} players")
+
+    def _rebuild_locked(self):
+        try:
+            self.rebuild_bloom()
+        except Exception as e:
+            logger.error(f"Failed to rebuild nickname Bloom filter: {str(e)}")
+            self._bloom_built_at = time.monotonic()
+        finally:
+            self._bloom_lock.release()
+
+    def _current_bloom(self, version):
+        if self._bloom_built_at is None:
+            # First use: build inline once, so there is a filter to answer with
+            self._bloom_lock.acquire()
+            if self._bloom_built_at is None:
+                self._rebuild_locked()
+            else:
+                self._bloom_lock.release()
+        else:
+            changed = version != self._bloom_version
+            if changed or time.monotonic() - self._bloom_built_at >= self.bloom_refresh:
+                # Only one rebuild at a time, off the request thread
+                if self._bloom_lock.acquire(blocking=False):
+                    threading.Thread(target=self._rebuild_locked, name="nickname-bloom", daemon=True).start()
+
+        if self._bloom is None or version != self._bloom_version:
+            return None  # built before the directory changed; new players would be missing
+        return self._bloom
+
+    def exists(self, nickname):
+        return self.exists_many([nickname])[normalize_nickname(nickname)]
+
+    def exists_many(self, nicknames):
+        """
+        Returns {normalized_nickname: bool}. Cache misses are resolved with a
+        single backend query for the whole batch.
+        """
+        version = self.directory.version()
+        if version != self._seen_version:
+            self.cache.discard_value(False)
+            self._seen_version = version
+
+        results = {}
+        misses = []
+        bloom = self._current_bloom(version)
+
+        for raw in nicknames:
+            nickname = normalize_nickname(raw)
+            if nickname in results:
+                continue
+            cached = self.cache.get(nickname)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                results[nickname] = cached
+            elif bloom is not None and nickname not in bloom:
+                # Not cached: the filter answers just as fast and follows directory changes
+                self.stats["bloom_rejections"] += 1
+                results[nickname] = False
+            else:
+                misses.append(nickname)
+
+        if misses:
+            self.stats["backend_lookups"] += 1
+            found = self.directory.lookup_many(misses)
+            for nickname in misses:
+                exists = nickname in found
+                results[nickname] = exists
+                self.cache.set(nickname, exists, self.ttl if exists else self.negative_ttl)
+
+        return results
@@ -0,0 +1,301 @@
+import os
+import hmac
+import time
+import queue
+import atexit
+import sqlite3
+import hashlib
+import logging
+import secrets
+import threading
+
+logger = logging.getLogger(__name__)
+
+LEDGER_DB = os.getenv("LEDGER_DB", "orders.db")
+LEDGER_CPF_SALT = os.getenv("LEDGER_CPF_SALT")  # key for the CPF hashes; generated into <db>.key when unset
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", 365))
+LEDGER_MAX_ROWS = int(os.getenv("LEDGER_MAX_ROWS", 1_000_000))
+LEDGER_BATCH_SIZE = 200  # rows per transaction
+LEDGER_FLUSH_INTERVAL = 0.2  # seconds a write may wait for more rows to batch with
+LEDGER_RETENTION_INTERVAL = 3600  # seconds between retention sweeps
+LEDGER_QUERY_LIMIT = 100
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS orders (
+        order_id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        nickname TEXT NOT NULL,
+        nickname_lower TEXT NOT NULL,
+        product TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        cpf_hash TEXT NOT NULL,
+        email TEXT,
+        status TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_orders_nickname ON orders (nickname_lower, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_cpf_hash ON orders (cpf_hash, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)",
+]
+
+COLUMNS = ("order_id", "kind", "nickname", "product", "amount", "status", "created_at", "updated_at")
+
+
+def hash_cpf(cpf, salt):
+    cpf_clean = "".join(filter(str.isdigit, str(cpf)))
+    return hmac.new(salt.encode('utf-8'), cpf_clean.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def load_cpf_salt(db_path):
+    """
+    Returns LEDGER_CPF_SALT, or a random key created once in <db_path>.key
+    (owner-only). There are only 10^11 CPFs, so an unkeyed hash would be
+    reversed by brute force; keep the key out of database backups.
+    """
+    if LEDGER_CPF_SALT:
+        return LEDGER_CPF_SALT
+
+    key_path = db_path + ".key"
+    try:
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(key_path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+
+    salt = secrets.token_hex(32)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(salt)
+    logger.warning(f"LEDGER_CPF_SALT not set, generated a CPF hash key in {key_path}")
+    return salt
+
+
+class CommitMarker(threading.Event):
+    """
+    Set once the writes queued before it have been applied. failed is True
+    when one of them was dropped by the database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    def wait_committed(self, timeout=None):
+        return self.wait(timeout) and not self.failed
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class OrderLedger:
+    """
+    SQLite (WAL) record of every order created through the payment routes.
+
+    Writes are queued and applied by a background thread in batched
+    transactions, so the request path never waits on the disk. Reads use a
+    per-thread connection and go through the indexes on order id, nickname,
+    CPF hash and creation time.
+    """
+
+    def __init__(self, path=LEDGER_DB, retention_days=LEDGER_RETENTION_DAYS, max_rows=LEDGER_MAX_ROWS,
+                 batch_size=LEDGER_BATCH_SIZE, flush_interval=LEDGER_FLUSH_INTERVAL):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._last_retention = float('-inf')  # sweep once at startup
+        self._dropped_since_marker = False  # writer thread only
+        self.cpf_salt = load_cpf_salt(path)
+
+        self._writer_conn = _connect(path)
+        for statement in SCHEMA:
+            self._writer_conn.execute(statement)
+        self._writer_conn.commit()
+
+        self._writer = threading.Thread(target=self._run, name="order-ledger-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    # --- Writes (non-blocking) ---
+
+    def record_order(self, order_id, kind, nickname, product, amount, cpf, email=None, status="created"):
+        if not order_id:
+            logger.warning(f"Not recording {kind} order for {nickname}: gateway returned no id")
+            return
+        now = time.time()
+        self.enqueue_write(
+            "INSERT OR IGNORE INTO orders (order_id, kind, nickname, nickname_lower, product, amount, cpf_hash,"
+            " email, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (order_id, kind, nickname, nickname.lower(), product, amount, self.hash_cpf(cpf), email, status, now, now)
+        )
+
+    def hash_cpf(self, cpf):
+        return hash_cpf(cpf, self.cpf_salt)
+
+    def update_status(self, order_id, status):
+        self.enqueue_write(
+            "UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ?",
+            (status, time.time(), order_id)
+        )
+
+    def enqueue_write(self, sql, params=()):
+        """
+        Queues any statement for the writer thread. Statements are applied in
+        the order they were queued, batched with the order writes.
+        """
+        self._queue.put((sql, params))
+
+    def commit_marker(self):
+        """
+        Returns a CommitMarker that is set once every write queued so far is
+        applied. Many callers waiting on markers share one transaction.
+        """
+        marker = CommitMarker()
+        self._queue.put(marker)
+        return marker
+
+    def flush(self, timeout=5):
+        """
+        Blocks until every queued write is applied (tests and shutdown).
+        Returns False on timeout or if a write was dropped.
+        """
+        return self.commit_marker().wait_committed(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._maybe_apply_retention()
+                continue
+
+            # Give concurrent requests a moment to join this transaction
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._write_batch(batch)
+            self._maybe_apply_retention()
+
+    def _write_batch(self, batch):
+        writes = [item for item in batch if not isinstance(item, CommitMarker)]
+        dropped = set()
+        try:
+            with self._writer_conn:
+                for sql, params in writes:
+                    self._writer_conn.execute(sql, params)
+        except sqlite3.Error as e:
+            # One bad statement must not take the rest of the batch with it
+            logger.warning(f"Order ledger batch of {len(writes)} rows failed ({str(e)}), replaying one by one")
+            dropped = {index for index, (sql, params) in enumerate(writes) if not self._write_one(sql, params)}
+
+        # Markers can't tell whose write failed, so a drop fails every later marker in the
+        # batch; drops after the last marker carry over to the next batch's markers
+        failed = pending = self._dropped_since_marker
+        position = 0
+        for item in batch:
+            if isinstance(item, CommitMarker):
+                item.failed = failed
+                item.set()
+                pending = False
+            else:
+                if position in dropped:
+                    failed = pending = True
+                position += 1
+        self._dropped_since_marker = pending
+
+    def _write_one(self, sql, params):
+        try:
+            with self._writer_conn:
+                self._writer_conn.execute(sql, params)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Order ledger dropped a write ({str(e)}): {sql[:80]}")
+            return False
+
+    def _maybe_apply_retention(self):
+        if time.monotonic() - self._last_retention < LEDGER_RETENTION_INTERVAL:
+            return
+        self._last_retention = time.monotonic()
+        self.apply_retention()
+
+    def apply_retention(self):
+        """
+        Deletes orders older than the retention window, then trims the oldest
+        rows beyond max_rows. Runs on the writer thread.
+        """
+        cutoff = time.time() - self.retention_days * 86400
+        try:
+            with self._writer_conn:
+                expired = self._writer_conn.execute("DELETE FROM orders WHERE created_at < ?", (cutoff,)).rowcount
+                overflow = self._writer_conn.execute(
+                    "DELETE FROM orders WHERE order_id IN ("
+                    " SELECT order_id FROM orders ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,)
+                ).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Order ledger retention failed: {str(e)}")
+            return
+        if expired or overflow:
+            logger.info(f"Order ledger retention removed {expired + overflow} orders")
+
+    # --- Reads ---
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def get(self, order_id):
+        row = self._reader().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM orders WHERE order_id = ?", (order_id,)
+        ).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def find(self, nickname=None, cpf=None, product=None, status=None, since=None, until=None,
+             limit=LEDGER_QUERY_LIMIT):
+        """
+        Newest-first search. Filtering on nickname or CPF uses their composite
+        (key, created_at) index; otherwise the created_at index drives the scan.
+        """
+        clauses, params = [], []
+        if nickname:
+            clauses.append("nickname_lower = ?")
+            params.append(nickname.lower())
+        if cpf:
+            clauses.append("cpf_hash = ?")
+            params.append(self.hash_cpf(cpf))
+        if product:
+            clauses.append("product = ?")
+            params.append(product)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(max(1, min(limit, LEDGER_QUERY_LIMIT)))  # SQLite reads a negative LIMIT as "no limit"
+        rows = self._reader().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM orders {where} ORDER BY created_at DESC LIMIT ?", params
+        ).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
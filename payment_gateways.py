@@ -0,0 +1,646 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from collections import deque
+
+import requests
+from flask import jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated provider names, in order of preference while there are no stats yet
+PAYMENT_PROVIDERS = os.getenv("PAYMENT_PROVIDERS", "abacate")
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv("GATEWAY_CONNECT_TIMEOUT", 3.05))  # seconds to open a connection
+GATEWAY_STATS_WINDOW = int(os.getenv("GATEWAY_STATS_WINDOW", 50))  # calls per provider used for routing
+GATEWAY_FAILURE_THRESHOLD = int(os.getenv("GATEWAY_FAILURE_THRESHOLD", 3))  # consecutive failures before cooldown
+GATEWAY_COOLDOWN = int(os.getenv("GATEWAY_COOLDOWN", 30))  # seconds a failing provider is tried last
+GATEWAY_POOL_SIZE = 10
+GATEWAY_LIST_PAGE_SIZE = 100  # charges per listing page
+GATEWAY_READ_MAX_BYTES = 1024 * 1024  # largest listing/status response read; a full page is a few dozen KB
+GATEWAY_DECISION_LOG = 100  # routing decisions kept for /debug/gateways
+ABACATE_LIST_URL = os.getenv("ABACATE_LIST_URL", "https://api.abacatepay.com/v1/billing/list")
+ABACATE_PIX_CHECK_URL = os.getenv("ABACATE_PIX_CHECK_URL", "https://api.abacatepay.com/v1/pixQrCode/check")
+
+# Operations that may be sent to a second provider after a timeout. A PIX QR
+# code nobody scans simply expires, so an orphan charge costs nothing; a
+# billing left behind on a slow provider stays open as a pending charge.
+RETRY_SAFE_OPERATIONS = frozenset({"pix"})
+
+
+class GatewayError(Exception):
+    """
+    Base class for provider failures.
+    """
+
+
+class GatewayTimeout(GatewayError):
+    """
+    The provider accepted the request but did not answer in time. The
+    charge may or may not exist on its side.
+    """
+
+
+class GatewayUnavailable(GatewayError):
+    """
+    The request never reached the provider (connection refused, DNS, connect
+    timeout), so trying another provider is always safe.
+    """
+
+
+class GatewayResponseError(GatewayError):
+    """
+    The provider answered with something we cannot use.
+    """
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+class GatewayServerError(GatewayResponseError):
+    """
+    The provider answered 5xx, or 429 after our own retries. It counts
+    against the provider's health; 429 and 503 mean the request was not
+    processed, so any operation may fail over.
+    """
+
+    def __init__(self, status_code, details):
+        super().__init__(f"HTTP {status_code} from payment provider", details)
+        self.status_code = status_code
+
+    @property
+    def not_processed(self):
+        return self.status_code in (429, 503)
+
+
+class GatewayRateLimited(GatewayError):
+    """
+    The provider asked us to slow down (HTTP 429).
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class GatewayRejected(GatewayError):
+    """
+    The provider refused the charge (validation, auth). Another provider
+    would refuse it too, so this is returned to the buyer as-is.
+    """
+
+    def __init__(self, status_code, details, user_message=None):
+        super().__init__(user_message or str(details))
+        self.status_code = status_code
+        self.details = details
+        self.user_message = user_message
+
+
+class ChargeResult:
+    __slots__ = ("provider", "charge_id", "url", "br_code", "br_code_base64", "raw")
+
+    def __init__(self, provider, charge_id, url=None, br_code=None, br_code_base64=None, raw=None):
+        self.provider = provider
+        self.charge_id = charge_id
+        self.url = url
+        self.br_code = br_code
+        self.br_code_base64 = br_code_base64
+        self.raw = raw
+
+
+class GatewayCharge:
+    """
+    One charge as listed or checked by a provider, normalised for reconciliation.
+    status is lowercase ("paid", "pending", "expired", ...).
+    """
+    __slots__ = ("charge_id", "status", "amount", "created_at")
+
+    def __init__(self, charge_id, status, amount, created_at=None):
+        self.charge_id = charge_id
+        self.status = status
+        self.amount = amount
+        self.created_at = created_at
+
+
+class PaymentProvider:
+    """
+    Interface every gateway implements. Payload parts come from the
+    ProductTemplate; providers translate them into their own API.
+    """
+
+    name = None
+    listed_kinds = ()  # order kinds ("billing", "pix") that list_charges() covers; empty if it can't list
+    checked_kinds = ()  # order kinds check_charge() can look up one by one; empty if it can't
+    newest_first = False  # whether listings are ordered by creation time, newest first
+
+    def create_billing(self, template, nickname, customer):
+        """
+        Hosted checkout for one product. Returns a ChargeResult with url.
+        """
+        raise NotImplementedError
+
+    def create_pix(self, template, nickname, customer, expires_in=None):
+        """
+        PIX QR code for one product. Returns a ChargeResult with br_code.
+        """
+        raise NotImplementedError
+
+    def list_charges(self, page, page_size=GATEWAY_LIST_PAGE_SIZE):
+        """
+        One page (1-based) of the provider's charges as GatewayCharge objects.
+        A page shorter than page_size is the last one.
+        """
+        raise NotImplementedError
+
+    def check_charge(self, charge_id):
+        """
+        Current state of one charge as a GatewayCharge, or None if the
+        provider does not know the id.
+        """
+        raise NotImplementedError
+
+    def owns_charge(self, charge_id):
+        """
+        Whether an order id recorded in the ledger is one of our charges.
+        """
+        raise NotImplementedError
+
+
+# Abacate validation messages we can explain to the buyer in Portuguese
+ABACATE_ERROR_MESSAGES = (
+    ("taxId", "CPF inválido. Verifique se o número está correto."),
+    ("email", "E-mail inválido."),
+    ("cellphone", "Número de celular inválido."),
+)
+
+
+class AbacateProvider(PaymentProvider):
+    name = "abacate"
+
+    def __init__(self, token, billing_url, pix_url, timeout, connect_timeout=GATEWAY_CONNECT_TIMEOUT,
+                 list_url=None, pix_check_url=None):
+        self.billing_url = billing_url
+        self.pix_url = pix_url
+        self.list_url = list_url
+        self.pix_check_url = pix_check_url
+        # The listing endpoint returns billings, not PIX QR codes; those are checked one by one
+        self.listed_kinds = ("billing",) if list_url else ()
+        self.checked_kinds = ("pix",) if pix_check_url else ()
+        self.timeout = (connect_timeout, timeout)
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        self.session = requests.Session()
+        retry_strategy = Retry(
+            total=2,
+            read=0,  # a slow answer is left to the router instead of being waited out again
+            backoff_factor=0.5,
+            status_forcelist=[429, 503],  # the request was not processed, so a POST can be repeated
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=GATEWAY_POOL_SIZE, pool_maxsize=GATEWAY_POOL_SIZE,
+                              max_retries=retry_strategy)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, url, payload):
+        try:
+            response = self.session.post(url, data=json_codec.dumps(payload), headers=self.headers,
+                                         timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout as e:
+            raise GatewayUnavailable(str(e)) from e
+        except requests.exceptions.Timeout as e:
+            raise GatewayTimeout(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise GatewayUnavailable(str(e)) from e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise GatewayServerError(response.status_code, _error_details(response))
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise GatewayResponseError("Invalid response from Payment Gateway", response.text)
+
+        if response.status_code != 200:
+            details = (result.get('error') or result) if isinstance(result, dict) else result
+            raise GatewayRejected(response.status_code, details)
+
+        if result.get('success') is False:
+            raw_error = result.get('error', 'Unknown error from payment provider')
+            user_message = raw_error
+            for field, message in ABACATE_ERROR_MESSAGES:
+                if field in raw_error:
+                    user_message = message
+                    break
+            raise GatewayRejected(400, raw_error, user_message)
+
+        data_obj = result.get('data')
+        if not data_obj:
+            raise GatewayResponseError("Invalid response from payment provider", result)
+        return result, data_obj
+
+    def create_billing(self, template, nickname, customer):
+        result, data_obj = self._post(self.billing_url, template.billing_payload(nickname, customer))
+        if not data_obj.get('url'):
+            raise GatewayResponseError("No payment URL returned", result)
+        return ChargeResult(self.name, data_obj.get('id'), url=data_obj.get('url'), raw=result)
+
+    def create_pix(self, template, nickname, customer, expires_in=None):
+        result, data_obj = self._post(self.pix_url, template.pix_payload(nickname, customer, expires_in))
+        return ChargeResult(self.name, data_obj.get('id'), br_code=data_obj.get('brCode'),
+                            br_code_base64=data_obj.get('brCodeBase64'), raw=result)
+
+    def _get(self, url, params):
+        """
+        GET for the read-only endpoints. Returns (status_code, body); the body
+        is streamed and refused past GATEWAY_READ_MAX_BYTES, so a gateway that
+        ignores `limit` cannot hand us its whole listing in one response.
+        """
+        try:
+            response = self.session.get(url, params=params, headers=self.headers, timeout=self.timeout,
+                                        stream=True)
+        except requests.exceptions.ConnectTimeout as e:
+            raise GatewayUnavailable(str(e)) from e
+        except requests.exceptions.Timeout as e:
+            raise GatewayTimeout(str(e)) from e
+        except requests.exceptions.ConnectionError as e:
+            raise GatewayUnavailable(str(e)) from e
+
+        with response:
+            if response.status_code == 429:
+                raise GatewayRateLimited(_retry_after(response))
+            body = bytearray()
+            try:
+                for chunk in response.iter_content(64 * 1024):
+                    body += chunk
+                    if len(body) > GATEWAY_READ_MAX_BYTES:
+                        raise GatewayResponseError(
+                            f"Response from {url} is over {GATEWAY_READ_MAX_BYTES} bytes; is `limit` ignored?")
+            except requests.exceptions.RequestException as e:
+                raise GatewayTimeout(str(e)) from e
+        if response.status_code >= 500:
+            raise GatewayServerError(response.status_code, body.decode('utf-8', 'replace'))
+        return response.status_code, bytes(body)
+
+    def _get_data(self, url, params):
+        status_code, body = self._get(url, params)
+        if status_code != 200:
+            raise GatewayRejected(status_code, body.decode('utf-8', 'replace'))
+        try:
+            result = json_codec.loads(body)
+        except ValueError:
+            raise GatewayResponseError("Invalid response from Payment Gateway", body.decode('utf-8', 'replace'))
+        return result.get('data') if isinstance(result, dict) else None
+
+    def list_charges(self, page, page_size=GATEWAY_LIST_PAGE_SIZE):
+        items = self._get_data(self.list_url, {"page": page, "limit": page_size}) or []
+        return [
+            GatewayCharge(item.get('id'), str(item.get('status', '')).lower(), item.get('amount'),
+                          _parse_timestamp(item.get('createdAt')))
+            for item in items
+        ]
+
+    def check_charge(self, charge_id):
+        try:
+            data_obj = self._get_data(self.pix_check_url, {"id": charge_id})
+        except GatewayRejected as e:
+            if e.status_code == 404:
+                return None
+            raise
+        if not data_obj or not data_obj.get('status'):
+            raise GatewayResponseError("Invalid response from payment provider", data_obj)
+        # The check endpoint only reports the status; the amount was fixed when the QR code was created
+        return GatewayCharge(charge_id, str(data_obj['status']).lower(), None)
+
+    def owns_charge(self, charge_id):
+        return charge_id.startswith(("bill_", "pix_char_"))
+
+
+def _error_details(response):
+    try:
+        result = response.json()
+    except ValueError:
+        return response.text
+    return (result.get('error') or result) if isinstance(result, dict) else result
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1.0  # HTTP-date form; not worth parsing for a pause
+
+
+class LocalProvider(PaymentProvider):
+    """
+    In-process stand-in gateway for tests and local development. Charges
+    live in memory; latency, failures and listing rate limits can be
+    injected.
+    """
+
+    name = "local"
+    listed_kinds = ("billing", "pix")
+    checked_kinds = ("billing", "pix")
+    newest_first = True
+
+    def __init__(self, name="local", latency=0.0, failure=None, rate_limit_every=0, listed_kinds=None):
+        self.name = name
+        if listed_kinds is not None:
+            self.listed_kinds = listed_kinds  # e.g. ("billing",) to behave like a gateway that can't list PIX
+        self.latency = latency
+        self.failure = failure  # None, "timeout", "unavailable" or "reject"
+        self.rate_limit_every = rate_limit_every  # answer every Nth listing call with 429
+        self.charges = {}
+        self._order = []  # charge ids in creation order
+        self._list_calls = 0
+        self._lock = threading.Lock()
+
+    def _create(self, kind, template, nickname, customer, expires_in=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure == "timeout":
+            raise GatewayTimeout(f"{self.name} timed out")
+        if self.failure == "unavailable":
+            raise GatewayUnavailable(f"{self.name} is unavailable")
+        if self.failure == "reject":
+            raise GatewayRejected(400, "taxId is invalid", "CPF inválido. Verifique se o número está correto.")
+
+        charge_id = f"{self.name}_{kind}_{uuid.uuid4().hex[:16]}"
+        now = time.time()
+        charge = {
+            "id": charge_id,
+            "kind": kind,
+            "product": template.name,
+            "amount": template.amount,
+            "nickname": nickname,
+            "customer": customer,
+            "status": "PENDING",
+            "created_at": now,
+            "expires_at": now + expires_in if expires_in else None,
+        }
+        with self._lock:
+            self.charges[charge_id] = charge
+            self._order.append(charge_id)
+        return charge
+
+    def create_billing(self, template, nickname, customer):
+        charge = self._create("billing", template, nickname, customer)
+        return ChargeResult(self.name, charge["id"], url=f"http://localhost/pay/{charge['id']}", raw=charge)
+
+    def create_pix(self, template, nickname, customer, expires_in=None):
+        charge = self._create("pix", template, nickname, customer, expires_in)
+        br_code = f"00020101021226{charge['id']}5204000053039865802BR"
+        return ChargeResult(self.name, charge["id"], br_code=br_code, br_code_base64="", raw=charge)
+
+    def mark_paid(self, charge_id):
+        with self._lock:
+            self.charges[charge_id]["status"] = "PAID"
+
+    def list_charges(self, page, page_size=GATEWAY_LIST_PAGE_SIZE):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._list_calls += 1
+            if self.rate_limit_every and self._list_calls % self.rate_limit_every == 0:
+                raise GatewayRateLimited(0.01)
+            listed = self._order
+            if set(self.listed_kinds) != {"billing", "pix"}:
+                listed = [cid for cid in self._order if self.charges[cid]["kind"] in self.listed_kinds]
+            end = len(listed) - (page - 1) * page_size
+            ids = listed[max(end - page_size, 0):max(end, 0)][::-1]
+            charges = [self.charges[charge_id] for charge_id in ids]
+        return [
+            GatewayCharge(c["id"], c["status"].lower(), c["amount"], c["created_at"]) for c in charges
+        ]
+
+    def check_charge(self, charge_id):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            c = self.charges.get(charge_id)
+        if c is None:
+            return None
+        return GatewayCharge(c["id"], c["status"].lower(), c["amount"], c["created_at"])
+
+    def owns_charge(self, charge_id):
+        return charge_id.startswith(f"{self.name}_")
+
+
+class _ProviderStats:
+    """
+    Rolling latency/error window for one provider, plus a simple circuit:
+    GATEWAY_FAILURE_THRESHOLD failures in a row send it to the back of the
+    line for GATEWAY_COOLDOWN seconds.
+    """
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)  # (latency_seconds, ok)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    def record(self, latency, ok, failure_threshold, cooldown):
+        self.samples.append((latency, ok))
+        self.calls += 1
+        if ok:
+            self.consecutive_failures = 0
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= failure_threshold:
+            self.cooldown_until = time.monotonic() + cooldown
+
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def latencies(self):
+        return sorted(latency for latency, _ in self.samples)
+
+    def score(self):
+        """
+        Expected cost of a call: median latency inflated by the error rate.
+        Providers without samples score 0 and keep their configured order.
+        """
+        latencies = self.latencies()
+        if not latencies:
+            return 0.0
+        return _percentile(latencies, 0.50) / max(1.0 - self.error_rate(), 0.05)
+
+
+class GatewayRouter:
+    """
+    Sends each charge to the healthiest, fastest provider and fails over to
+    the next one when a provider cannot be reached or did not process the
+    request (429/503), or on any other failure of an operation in
+    RETRY_SAFE_OPERATIONS. Rejections are never failed over. The last GATEWAY_DECISION_LOG decisions are kept for monitoring.
+    """
+
+    def __init__(self, providers, window=GATEWAY_STATS_WINDOW, failure_threshold=GATEWAY_FAILURE_THRESHOLD,
+                 cooldown=GATEWAY_COOLDOWN):
+        if not providers:
+            raise ValueError("At least one payment provider is required")
+        self.providers = list(providers)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._stats = {provider.name: _ProviderStats(window) for provider in self.providers}
+        self._decisions = deque(maxlen=GATEWAY_DECISION_LOG)
+        self._lock = threading.Lock()
+
+    def ranked(self):
+        """
+        Providers in the order they will be tried: out of cooldown first,
+        then by score.
+        """
+        now = time.monotonic()
+        with self._lock:
+            keys = {
+                provider.name: (self._stats[provider.name].cooldown_until > now, self._stats[provider.name].score())
+                for provider in self.providers
+            }
+        return sorted(self.providers, key=lambda provider: keys[provider.name])
+
+    def _record(self, provider, latency, ok):
+        with self._lock:
+            self._stats[provider.name].record(latency, ok, self.failure_threshold, self.cooldown)
+
+    def create_billing(self, template, nickname, customer):
+        return self._call("billing", lambda provider: provider.create_billing(template, nickname, customer))
+
+    def create_pix(self, template, nickname, customer, expires_in=None):
+        return self._call("pix", lambda provider: provider.create_pix(template, nickname, customer, expires_in))
+
+    def _call(self, operation, send):
+        retry_safe = operation in RETRY_SAFE_OPERATIONS
+        attempts = []
+        error = None
+        for provider in self.ranked():
+            started = time.perf_counter()
+            try:
+                result = send(provider)
+            except GatewayRejected:
+                # The provider is healthy; the charge itself is bad
+                self._record(provider, time.perf_counter() - started, True)
+                attempts.append(self._attempt(provider, "rejected", started))
+                self._log_decision(operation, provider, attempts)
+                raise
+            except GatewayError as e:
+                self._record(provider, time.perf_counter() - started, False)
+                outcome = type(e).__name__
+                attempts.append(self._attempt(provider, outcome, started))
+                error = e
+                not_processed = isinstance(e, GatewayUnavailable) or getattr(e, 'not_processed', False)
+                if not_processed or retry_safe:
+                    logger.warning(f"{operation} on {provider.name} failed ({outcome}), trying next provider")
+                    continue
+                self._log_decision(operation, None, attempts)
+                raise
+
+            self._record(provider, time.perf_counter() - started, True)
+            attempts.append(self._attempt(provider, "ok", started))
+            self._log_decision(operation, provider, attempts)
+            return result
+
+        self._log_decision(operation, None, attempts)
+        raise error
+
+    @staticmethod
+    def _attempt(provider, outcome, started):
+        return {"provider": provider.name, "outcome": outcome,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    def _log_decision(self, operation, provider, attempts):
+        self._decisions.append({
+            "at": time.time(),
+            "operation": operation,
+            "provider": provider.name if provider is not None else None,
+            "attempts": attempts,
+        })
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            providers = {}
+            for provider in self.providers:
+                stats = self._stats[provider.name]
+                latencies = stats.latencies()
+                providers[provider.name] = {
+                    "calls": stats.calls,
+                    "failures": stats.failures,
+                    "error_rate": round(stats.error_rate(), 4),
+                    "latency_ms": {
+                        "p50": round(_percentile(latencies, 0.50) * 1000, 1),
+                        "p95": round(_percentile(latencies, 0.95) * 1000, 1),
+                    },
+                    "score": round(stats.score(), 4),
+                    "cooldown_seconds": max(round(stats.cooldown_until - now, 1), 0),
+                }
+            decisions = list(self._decisions)
+        return {
+            "order": [provider.name for provider in self.ranked()],
+            "providers": providers,
+            "decisions": decisions[::-1],
+        }
+
+
+def gateway_error_response(req_id, error):
+    """
+    Maps a provider failure (after failover) to the response the checkout expects.
+    """
+    if isinstance(error, GatewayTimeout):
+        logger.error(f"[{req_id}] Payment Gateway timed out: {str(error)}")
+        return jsonify({"error": "Payment Gateway Timeout", "message": "The payment service is taking too long to respond. Please try again."}), 504
+    if isinstance(error, GatewayUnavailable):
+        logger.error(f"[{req_id}] Connection error to Payment Gateway: {str(error)}")
+        return jsonify({"error": "Connection Error", "message": "Could not connect to payment service. Please check your internet connection."}), 503
+    if isinstance(error, (GatewayRejected, GatewayServerError)):
+        logger.error(f"[{req_id}] Payment Gateway error ({error.status_code}): {error.details}")
+        if getattr(error, 'user_message', None):
+            return jsonify({"error": error.user_message}), error.status_code
+        return jsonify({"error": "Payment Gateway Error", "details": error.details}), error.status_code
+    logger.error(f"[{req_id}] Unusable Payment Gateway response: {str(error)}")
+    return jsonify({"error": str(error), "details": getattr(error, 'details', None)}), 502
+
+
+def _parse_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def create_gateway_router(abacate_token, abacate_billing_url, abacate_pix_url, timeout, names=PAYMENT_PROVIDERS):
+    """
+    Builds the router from PAYMENT_PROVIDERS ("abacate", "local", ...).
+    """
+    providers = []
+    for name in (n.strip() for n in names.split(',')):
+        if name == "abacate":
+            providers.append(AbacateProvider(abacate_token, abacate_billing_url, abacate_pix_url, timeout,
+                                             list_url=ABACATE_LIST_URL, pix_check_url=ABACATE_PIX_CHECK_URL))
+        elif name == "local":
+            providers.append(LocalProvider())
+        elif name:
+            raise ValueError(f"Unknown payment provider: {name}")
+    return GatewayRouter(providers)
@@ -0,0 +1,473 @@
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import sqlite3
+import logging
+import threading
+from collections import deque
+
+from nickname_directory import is_valid_nickname
+
+logger = logging.getLogger(__name__)
+
+RCON_HOST = os.getenv("RCON_HOST")
+RCON_PORT = int(os.getenv("RCON_PORT", 25575))
+RCON_PASSWORD = os.getenv("RCON_PASSWORD", "")
+RCON_TIMEOUT = float(os.getenv("RCON_TIMEOUT", 5))  # seconds
+RCON_POOL_SIZE = int(os.getenv("RCON_POOL_SIZE", 2))  # max sockets open to the game server
+DELIVERY_DB = os.getenv("DELIVERY_DB", "deliveries.db")
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", 20))  # orders per RCON round trip
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", 5))
+DELIVERY_RETRY_DELAY = float(os.getenv("DELIVERY_RETRY_DELAY", 5))  # seconds, doubled per attempt
+
+# Commands run for each product. Override with a JSON file: {"LORD": ["cmd {nickname}", ...], ...}
+DEFAULT_KIT_COMMANDS = {
+    "LORD": ["lp user {nickname} parent add lord"],
+    "KNIGHT": ["lp user {nickname} parent add knight"],
+    "GUARDIAN": ["lp user {nickname} parent add guardian"],
+    "CHAMPION": ["lp user {nickname} parent add champion"],
+}
+
+# RCON packet types
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+
+class RconError(Exception):
+    pass
+
+
+def load_kit_commands(path=None):
+    path = path or os.getenv("VIP_COMMANDS_FILE")
+    if not path:
+        return DEFAULT_KIT_COMMANDS
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# --- RCON Protocol ---
+
+def encode_packet(request_id, packet_type, body):
+    payload = struct.pack('<ii', request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+    return struct.pack('<i', len(payload)) + payload
+
+
+def read_packet(sock):
+    """
+    Reads one packet and returns (request_id, packet_type, body).
+    """
+    length = struct.unpack('<i', _recv_exact(sock, 4))[0]
+    data = _recv_exact(sock, length)
+    request_id, packet_type = struct.unpack('<ii', data[:8])
+    return request_id, packet_type, data[8:-2].decode('utf-8', errors='replace')
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise RconError("Connection closed by game server")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+class RconConnection:
+    """
+    A persistent, authenticated RCON socket.
+    """
+
+    def __init__(self, host, port, password, timeout=RCON_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self._next_id = 1
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        request_id = self._new_id()
+        self.sock.sendall(encode_packet(request_id, SERVERDATA_AUTH, self.password))
+        while True:
+            response_id, packet_type, _ = read_packet(self.sock)
+            if packet_type == SERVERDATA_AUTH_RESPONSE:
+                break
+        if response_id == -1:
+            self.close()
+            raise RconError("RCON authentication failed")
+
+    def _new_id(self):
+        request_id = self._next_id
+        self._next_id = self._next_id % 2_000_000_000 + 1
+        return request_id
+
+    def execute_batch(self, commands):
+        """
+        Pipelines every command in a single write and collects the responses,
+        so a batch costs one round trip instead of one per command.
+
+        Long outputs arrive split across several packets with the same id and
+        no end marker, so the batch is followed by an empty RESPONSE_VALUE
+        packet. The server answers it only after everything before it, so
+        reading up to its answer drains every fragment of this batch and
+        leaves nothing on the socket for the next one.
+        """
+        if self.sock is None:
+            self.connect()
+
+        ids = [self._new_id() for _ in commands]
+        terminator = self._new_id()
+        self.sock.sendall(b''.join(
+            encode_packet(request_id, SERVERDATA_EXECCOMMAND, command)
+            for request_id, command in zip(ids, commands)
+        ) + encode_packet(terminator, SERVERDATA_RESPONSE_VALUE, ''))
+
+        responses = {request_id: '' for request_id in ids}
+        while True:
+            response_id, _, body = read_packet(self.sock)
+            if response_id == terminator:
+                return [responses[request_id] for request_id in ids]
+            if response_id in responses:
+                responses[response_id] += body
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class RconPool:
+    """
+    Bounded pool of persistent RCON connections. Connections are opened lazily,
+    reused across batches and discarded (then reopened) after any error.
+    """
+
+    def __init__(self, host, port, password, size=RCON_POOL_SIZE, timeout=RCON_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.connections_opened = 0
+
+    def execute_batch(self, commands):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = RconConnection(self.host, self.port, self.password, self.timeout)
+                conn.connect()
+                self.connections_opened += 1
+
+            try:
+                result = conn.execute_batch(commands)
+            except (OSError, RconError, struct.error):
+                conn.close()
+                raise
+            self._idle.put(conn)
+            return result
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# --- Delivery Queue ---
+
+class DeliveryStore:
+    """
+    Durable record of every delivery, keyed by order id. It makes enqueueing
+    idempotent and lets pending deliveries survive a restart.
+    """
+
+    def __init__(self, path=DELIVERY_DB):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL + NORMAL sync: commits stay durable across app crashes without an fsync per order
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                " order_id TEXT PRIMARY KEY, nickname TEXT NOT NULL, product TEXT NOT NULL,"
+                " status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT,"
+                " created_at REAL NOT NULL, delivered_at REAL)"
+            )
+            self._conn.commit()
+
+    def add(self, order_id, nickname, product):
+        """
+        Returns False if the order is already pending or delivered.
+        Permanently failed orders are reset to pending.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO deliveries (order_id, nickname, product, status, created_at) VALUES (?, ?, ?, 'pending', ?) "
+                "ON CONFLICT(order_id) DO UPDATE SET status = 'pending', attempts = 0 WHERE status = 'failed'",
+                (order_id, nickname, product, time.time())
+            )
+            self._conn.commit()
+            return cursor.rowcount == 1
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT order_id, nickname, product, attempts FROM deliveries WHERE status = 'pending'"
+            ).fetchall()
+
+    def mark_delivered(self, order_ids):
+        with self._lock:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE deliveries SET status = 'delivered', delivered_at = ?, attempts = attempts + 1 WHERE order_id = ?",
+                [(now, order_id) for order_id in order_ids]
+            )
+            self._conn.commit()
+
+    def mark_attempt(self, order_id, error, failed):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE deliveries SET attempts = attempts + 1, last_error = ?, status = ? WHERE order_id = ?",
+                (error, 'failed' if failed else 'pending', order_id)
+            )
+            self._conn.commit()
+
+    def status(self, order_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, attempts, last_error, delivered_at FROM deliveries WHERE order_id = ?", (order_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"status": row[0], "attempts": row[1], "last_error": row[2], "delivered_at": row[3]}
+
+
+class DeliveryJob:
+    __slots__ = ("order_id", "nickname", "product", "attempts", "enqueued_at")
+
+    def __init__(self, order_id, nickname, product, attempts=0):
+        self.order_id = order_id
+        self.nickname = nickname
+        self.product = product
+        self.attempts = attempts
+        self.enqueued_at = time.monotonic()
+
+
+class DeliveryService:
+    """
+    Applies paid kits on the game server. Confirmed orders go into a queue;
+    one worker per pooled connection drains it in batches, so a burst of
+    purchases never opens more than RCON_POOL_SIZE sockets.
+
+    Delivery is at-least-once: an order is only marked delivered after its
+    commands ran, and a crash in between re-runs them on the next start.
+    """
+
+    def __init__(self, pool, store, kit_commands=None, batch_size=DELIVERY_BATCH_SIZE,
+                 max_attempts=DELIVERY_MAX_ATTEMPTS, retry_delay=DELIVERY_RETRY_DELAY):
+        self.pool = pool
+        self.store = store
+        self.kit_commands = kit_commands or load_kit_commands()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._workers = []
+        self._stopping = threading.Event()
+        self._scheduled_retries = 0
+        self._retry_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.counters = {"delivered": 0, "failed": 0, "retried": 0, "batches": 0}
+
+    def start(self):
+        # Orders enqueued before start() are already in the queue; only reload the rest
+        with self._queue.mutex:
+            queued = {job.order_id for job in self._queue.queue}
+        for order_id, nickname, product, attempts in self.store.pending():
+            if order_id not in queued:
+                self._queue.put(DeliveryJob(order_id, nickname, product, attempts))
+        for i in range(self.pool.size):
+            worker = threading.Thread(target=self._run, name=f"rcon-delivery-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Delivery service started with {self.pool.size} workers ({self._queue.qsize()} pending)")
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self.pool.close()
+
+    def enqueue(self, order_id, nickname, product):
+        """
+        Queues an order for delivery. Returns False for duplicates.
+        The nickname is pasted into console commands, so anything that is not
+        a plain Minecraft name is refused.
+        """
+        if not is_valid_nickname(nickname):
+            raise ValueError(f"Invalid nickname for delivery: {nickname!r}")
+        job = DeliveryJob(order_id, nickname, product)
+        self._commands_for(job)  # a broken template is refused here, not found later by a worker
+        if not self.store.add(order_id, nickname, product):
+            logger.info(f"Delivery for order {order_id} already queued or done, skipping")
+            return False
+        self._queue.put(job)
+        return True
+
+    def join(self, timeout=None):
+        """
+        Waits until the queue is drained (used by tests and shutdown).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._scheduled_retries:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._deliver(batch)
+                except Exception as e:
+                    # The worker must outlive any one batch; pending rows are picked up again on restart
+                    logger.exception(f"Delivery worker error on a batch of {len(batch)} orders: {str(e)}")
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+
+    def _commands_for(self, job):
+        """
+        Renders the commands of one order. Raises ValueError when the product
+        has no commands or a template does not render.
+        """
+        try:
+            templates = self.kit_commands[job.product]
+            return [command.format(nickname=job.nickname, product=job.product) for command in templates]
+        except KeyError as e:
+            if job.product not in self.kit_commands:
+                raise ValueError(f"No delivery commands for product: {job.product}") from e
+            raise ValueError(f"Unknown placeholder {e} in delivery commands for {job.product}") from e
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"Invalid delivery command for {job.product}: {str(e)}") from e
+
+    def _deliver(self, batch):
+        jobs, commands = [], []
+        for job in batch:
+            try:
+                commands.extend(self._commands_for(job))
+            except ValueError as e:
+                # Retrying cannot fix a template; fail this order and deliver the rest
+                self._give_up(job, str(e))
+                continue
+            jobs.append(job)
+        batch = jobs
+        if not batch:
+            return
+
+        try:
+            responses = self.pool.execute_batch(commands)
+        except Exception as e:
+            logger.warning(f"RCON batch of {len(batch)} orders failed: {str(e)}")
+            for job in batch:
+                self._retry(job, str(e))
+            return
+
+        self.counters["batches"] += 1
+        logger.debug(f"RCON responses: {responses}")
+        self.store.mark_delivered([job.order_id for job in batch])
+        now = time.monotonic()
+        for job in batch:
+            self._latencies.append(now - job.enqueued_at)
+            logger.info(f"Delivered {job.product} to {job.nickname} (order {job.order_id})")
+        self.counters["delivered"] += len(batch)
+
+    def _give_up(self, job, error):
+        job.attempts += 1
+        self.store.mark_attempt(job.order_id, error, failed=True)
+        self.counters["failed"] += 1
+        logger.error(f"Giving up delivery of order {job.order_id} after {job.attempts} attempts: {error}")
+
+    def _retry(self, job, error):
+        if job.attempts + 1 >= self.max_attempts:
+            self._give_up(job, error)
+            return
+        job.attempts += 1
+        self.store.mark_attempt(job.order_id, error, failed=False)
+
+        self.counters["retried"] += 1
+        delay = self.retry_delay * (2 ** (job.attempts - 1))
+        with self._retry_lock:
+            self._scheduled_retries += 1
+        timer = threading.Timer(delay, self._requeue, args=(job,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job):
+        self._queue.put(job)
+        with self._retry_lock:
+            self._scheduled_retries -= 1
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            **self.counters,
+            "queued": self._queue.qsize(),
+            "connections_opened": self.pool.connections_opened,
+            "latency_ms": {
+                "p50": _percentile(latencies, 0.50) * 1000,
+                "p95": _percentile(latencies, 0.95) * 1000,
+                "max": (latencies[-1] if latencies else 0.0) * 1000,
+            },
+        }
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def create_delivery_service():
+    """
+    Builds and starts the delivery service from environment variables.
+    Returns None when RCON_HOST is not configured.
+    """
+    if not RCON_HOST:
+        return None
+    pool = RconPool(RCON_HOST, RCON_PORT, RCON_PASSWORD)
+    service = DeliveryService(pool, DeliveryStore())
+    service.start()
+    return service
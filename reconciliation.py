@@ -0,0 +1,534 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from order_ledger import _connect
+from payment_gateways import (
+    GatewayRateLimited, GatewayTimeout, GatewayUnavailable, GatewayResponseError, GATEWAY_LIST_PAGE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", 0))  # seconds between scheduled runs, 0 = on demand only
+RECONCILE_WINDOW_DAYS = int(os.getenv("RECONCILE_WINDOW_DAYS", 7))  # how far back local orders are compared
+RECONCILE_GRACE = int(os.getenv("RECONCILE_GRACE", 300))  # seconds; newer orders may not be recorded yet
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", 4))  # listing pages or status checks at once
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", 5))  # gateway requests per second
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", 10000))  # stop if a gateway ignores pagination
+RECONCILE_FETCH_ATTEMPTS = 5
+RECONCILE_QUERY_LIMIT = 500
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS reconcile_runs (
+        provider TEXT PRIMARY KEY,
+        run_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        since REAL NOT NULL,
+        until REAL NOT NULL,
+        next_page INTEGER NOT NULL,
+        charges INTEGER NOT NULL,
+        phase TEXT NOT NULL DEFAULT 'list',
+        check_after REAL,
+        check_after_rowid INTEGER,
+        checked INTEGER NOT NULL DEFAULT 0,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        error TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS reconcile_seen (
+        run_id TEXT NOT NULL,
+        charge_id TEXT NOT NULL,
+        PRIMARY KEY (run_id, charge_id)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS reconcile_mismatches (
+        run_id TEXT NOT NULL,
+        charge_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        local_status TEXT,
+        gateway_status TEXT,
+        local_amount INTEGER,
+        gateway_amount INTEGER,
+        found_at REAL NOT NULL,
+        PRIMARY KEY (run_id, charge_id, type)
+    )""",
+]
+
+MISMATCH_COLUMNS = ("charge_id", "type", "local_status", "gateway_status", "local_amount", "gateway_amount", "found_at")
+
+# Mismatch types
+UNACKNOWLEDGED_PAYMENT = "unacknowledged_payment"  # paid at the gateway, still unpaid here
+PAID_LOCALLY_ONLY = "paid_locally_only"  # paid here, not paid at the gateway
+AMOUNT_MISMATCH = "amount_mismatch"
+UNKNOWN_CHARGE = "unknown_charge"  # charge with no local order
+MISSING_ON_GATEWAY = "missing_on_gateway"  # local order the gateway does not list (or know, when checked)
+
+# Local statuses of a payment that was received and handled; "oversold" is a flash-sale
+# order paid after its stock ran out, already flagged for a refund by confirm_order
+ACKNOWLEDGED_STATUSES = ("paid", "oversold")
+
+
+def _compare(charge, local_status, local_amount):
+    """
+    Mismatches between one gateway charge and its local order, as
+    (type, local_status, gateway_status, local_amount, gateway_amount) rows.
+    """
+    paid_here = local_status in ACKNOWLEDGED_STATUSES
+    paid_there = charge.status == "paid"
+    found = []
+    if paid_there and not paid_here:
+        found.append((UNACKNOWLEDGED_PAYMENT, local_status, charge.status, local_amount, charge.amount))
+    elif paid_here and not paid_there:
+        found.append((PAID_LOCALLY_ONLY, local_status, charge.status, local_amount, charge.amount))
+    if charge.amount is not None and charge.amount != local_amount:
+        found.append((AMOUNT_MISMATCH, local_status, charge.status, local_amount, charge.amount))
+    return found
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the fetch workers. pause() holds every worker
+    back after the gateway answers 429.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class PageFetcher:
+    """
+    Fetches listing pages with at most `concurrency` requests in flight and
+    yields them strictly in page order, so the caller can checkpoint after
+    each page and memory never holds more than `concurrency` pages. Status
+    checks of single charges share the same limits.
+    """
+
+    def __init__(self, provider, concurrency=RECONCILE_CONCURRENCY, rate=RECONCILE_RATE,
+                 page_size=GATEWAY_LIST_PAGE_SIZE, attempts=RECONCILE_FETCH_ATTEMPTS):
+        self.provider = provider
+        self.concurrency = max(concurrency, 1)
+        self.limiter = RateLimiter(rate)
+        self.page_size = page_size
+        self.attempts = attempts
+
+    def _retrying(self, call, what):
+        for attempt in range(1, self.attempts + 1):
+            self.limiter.acquire()
+            try:
+                return call()
+            except GatewayRateLimited as e:
+                logger.info(f"{self.provider.name} {what} rate limited, pausing {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except (GatewayTimeout, GatewayUnavailable, GatewayResponseError) as e:
+                if attempt == self.attempts:
+                    raise
+                logger.warning(f"{self.provider.name} {what} failed ({str(e)}), retrying")
+                time.sleep(min(2 ** attempt * 0.1, 5))
+        raise GatewayRateLimited(0)
+
+    def _fetch(self, page):
+        return self._retrying(lambda: self.provider.list_charges(page, self.page_size), f"listing page {page}")
+
+    def _check(self, charge_id):
+        return self._retrying(lambda: self.provider.check_charge(charge_id), f"status check of {charge_id}")
+
+    def check(self, charge_ids):
+        """
+        Checks each charge with at most `concurrency` requests in flight.
+        Returns GatewayCharge-or-None results in the order given.
+        """
+        if not charge_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconcile-check") as executor:
+            return list(executor.map(self._check, charge_ids))
+
+    def pages(self, first_page=1, max_pages=RECONCILE_MAX_PAGES, is_last=None):
+        """
+        Yields (page_number, charges) from first_page on. Stops after a
+        short page or when is_last(charges) says the rest is not needed.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconcile-fetch")
+        in_flight = {}
+        next_submit = first_page
+        last_page = first_page + max_pages - 1
+        try:
+            for page in range(first_page, last_page + 1):
+                while next_submit <= last_page and len(in_flight) < self.concurrency:
+                    in_flight[next_submit] = executor.submit(self._fetch, next_submit)
+                    next_submit += 1
+
+                charges = in_flight.pop(page).result()
+                if len(charges) > self.page_size:
+                    # Pagination ignored: treating this response as the whole listing would report
+                    # everything past it as missing, and it is not bounded by page_size either
+                    raise GatewayResponseError(
+                        f"{self.provider.name} returned {len(charges)} charges for a page of {self.page_size}")
+                yield page, charges
+                if len(charges) < self.page_size or (is_last is not None and is_last(charges)):
+                    return
+            logger.warning(f"{self.provider.name} listing still had data after {max_pages} pages")
+        finally:
+            for future in in_flight.values():
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+class Reconciler:
+    """
+    Compares every charge a provider lists against the order ledger.
+
+    Pages are streamed from PageFetcher and each one is diffed against the
+    orders with the same ids (one indexed IN query, joined through a dict),
+    then its mismatches, the ids seen and the page checkpoint are committed
+    in a single transaction. A run that dies is resumed from its checkpoint
+    by the next run(). Local orders the gateway never listed are found at
+    the end with an anti-join against the seen ids, inside SQLite, so
+    memory stays flat however many charges there are.
+
+    Orders of a kind the provider cannot list (Abacate's PIX QR codes) are
+    then checked one by one: unpaid orders in the window are read in
+    created_at order, a chunk at a time, and each chunk is committed with
+    its keyset checkpoint the same way.
+    """
+
+    def __init__(self, ledger, providers, window_days=RECONCILE_WINDOW_DAYS, grace=RECONCILE_GRACE,
+                 concurrency=RECONCILE_CONCURRENCY, rate=RECONCILE_RATE, page_size=GATEWAY_LIST_PAGE_SIZE,
+                 on_unacknowledged=None):
+        self.ledger = ledger
+        self.providers = [p for p in providers if p.listed_kinds or p.checked_kinds]  # providers we can compare
+        self.window_days = window_days
+        self.grace = grace
+        self.concurrency = concurrency
+        self.rate = rate
+        self.page_size = page_size
+        self.on_unacknowledged = on_unacknowledged  # called with the order id of each paid-but-missed order
+        self._running = threading.Lock()
+        self._local = threading.local()
+
+        conn = self._conn()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.ledger.path)
+            self._local.conn = conn
+        return conn
+
+    # --- Running ---
+
+    def run(self):
+        """
+        Reconciles every provider that can list or check charges. Returns a summary
+        per provider, or None if a run is already in progress.
+        """
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            return {provider.name: self._run_provider(provider) for provider in self.providers}
+        finally:
+            self._running.release()
+
+    def start(self):
+        """
+        Runs in a background thread. Returns False if a run is in progress.
+        """
+        if not self._running.acquire(blocking=False):
+            return False
+
+        def background():
+            try:
+                for provider in self.providers:
+                    self._run_provider(provider)
+            except Exception as e:
+                logger.exception(f"Reconciliation failed: {str(e)}")
+            finally:
+                self._running.release()
+
+        threading.Thread(target=background, name="reconciliation", daemon=True).start()
+        return True
+
+    def schedule(self, interval=RECONCILE_INTERVAL):
+        if interval <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run()
+                except Exception as e:
+                    logger.exception(f"Scheduled reconciliation failed: {str(e)}")
+
+        threading.Thread(target=loop, name="reconciliation-scheduler", daemon=True).start()
+
+    def _begin(self, provider):
+        """
+        Resumes an unfinished run for this provider, or starts a new one.
+        """
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT run_id, since, until, next_page, phase FROM reconcile_runs WHERE provider = ? AND status != 'done'",
+            (provider.name,)
+        ).fetchone()
+        if row:
+            run_id, since, until, next_page, phase = row
+            logger.info(f"Resuming reconciliation {run_id} for {provider.name} ({phase}, page {next_page})")
+            with conn:
+                conn.execute("UPDATE reconcile_runs SET status = 'running', error = NULL WHERE provider = ?",
+                             (provider.name,))
+            return run_id, since, until, next_page, phase
+
+        previous = conn.execute("SELECT run_id FROM reconcile_runs WHERE provider = ?", (provider.name,)).fetchone()
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        until = now - self.grace
+        since = until - self.window_days * 86400
+        with conn:
+            if previous:
+                # Only the latest run's results are kept
+                conn.execute("DELETE FROM reconcile_mismatches WHERE run_id = ?", previous)
+                conn.execute("DELETE FROM reconcile_seen WHERE run_id = ?", previous)
+            conn.execute(
+                "INSERT OR REPLACE INTO reconcile_runs (provider, run_id, status, since, until, next_page, charges,"
+                " phase, check_after, check_after_rowid, started_at) VALUES (?, ?, 'running', ?, ?, 1, 0, 'list', ?, 0, ?)",
+                (provider.name, run_id, since, until, since, now)
+            )
+        return run_id, since, until, 1, "list"
+
+    def _run_provider(self, provider):
+        run_id, since, until, first_page, phase = self._begin(provider)
+        fetcher = PageFetcher(provider, self.concurrency, self.rate, self.page_size)
+
+        def is_last(page_charges):
+            # Newest-first listings can stop once a whole page predates the window
+            return provider.newest_first and all(
+                c.created_at is not None and c.created_at < since for c in page_charges
+            )
+
+        conn = self._conn()
+        try:
+            if phase == "list":
+                if provider.listed_kinds:
+                    for page, page_charges in fetcher.pages(first_page, is_last=is_last):
+                        unacknowledged = self._reconcile_page(conn, provider, run_id, page, page_charges, since, until)
+                        self._acknowledge(unacknowledged)
+                    self._find_missing(conn, provider, run_id, since, until)
+                with conn:
+                    conn.execute("UPDATE reconcile_runs SET phase = 'check' WHERE provider = ?", (provider.name,))
+            self._check_unlisted(conn, provider, fetcher, run_id, until)
+        except Exception as e:
+            logger.error(f"Reconciliation {run_id} for {provider.name} stopped: {str(e)}")
+            with conn:
+                conn.execute("UPDATE reconcile_runs SET status = 'failed', error = ? WHERE provider = ?",
+                             (str(e), provider.name))
+            raise
+
+        with conn:
+            conn.execute("UPDATE reconcile_runs SET status = 'done', finished_at = ? WHERE provider = ?",
+                         (time.time(), provider.name))
+            conn.execute("DELETE FROM reconcile_seen WHERE run_id = ?", (run_id,))
+        summary = self.status()[provider.name]
+        logger.info(f"Reconciliation {run_id} for {provider.name} done: {summary['mismatches']}")
+        return summary
+
+    def _reconcile_page(self, conn, provider, run_id, page, page_charges, since, until):
+        # Hash index of this page; a charge listed twice (pages shifting under us) is diffed once
+        by_id = {c.charge_id: c for c in page_charges if c.charge_id}
+        ids = list(by_id)
+        placeholders = ",".join("?" * len(ids))
+        if ids:
+            for (charge_id,) in conn.execute(
+                f"SELECT charge_id FROM reconcile_seen WHERE run_id = ? AND charge_id IN ({placeholders})",
+                [run_id, *ids]
+            ):
+                del by_id[charge_id]
+        orders = {
+            row[0]: row for row in conn.execute(
+                f"SELECT order_id, status, amount, created_at FROM orders WHERE order_id IN ({placeholders})", ids
+            )
+        } if ids else {}
+
+        now = time.time()
+        mismatches, unacknowledged = [], []
+        for charge in by_id.values():
+            order = orders.get(charge.charge_id)
+            if order is None:
+                if charge.created_at is None or since <= charge.created_at < until:
+                    mismatches.append((charge.charge_id, UNKNOWN_CHARGE, None, charge.status, None, charge.amount))
+                continue
+            _, local_status, local_amount, _ = order
+            for mismatch in _compare(charge, local_status, local_amount):
+                mismatches.append((charge.charge_id, *mismatch))
+                if mismatch[0] == UNACKNOWLEDGED_PAYMENT:
+                    unacknowledged.append(charge.charge_id)
+
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO reconcile_mismatches (run_id, charge_id, type, local_status, gateway_status,"
+                " local_amount, gateway_amount, found_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, *m, now) for m in mismatches]
+            )
+            conn.executemany("INSERT OR IGNORE INTO reconcile_seen (run_id, charge_id) VALUES (?, ?)",
+                             [(run_id, charge_id) for charge_id in by_id])
+            conn.execute(
+                "UPDATE reconcile_runs SET next_page = ?, charges = charges + ? WHERE provider = ?",
+                (page + 1, len(page_charges), provider.name)
+            )
+        return unacknowledged
+
+    def _acknowledge(self, order_ids):
+        if self.on_unacknowledged is None:
+            return
+        for order_id in order_ids:
+            try:
+                self.on_unacknowledged(order_id)
+            except Exception as e:
+                logger.error(f"Could not confirm reconciled order {order_id}: {str(e)}")
+
+    def _find_missing(self, conn, provider, run_id, since, until):
+        """
+        Local orders in the window, of a kind the provider lists, that the
+        listing never returned. Streams the anti-join cursor in batches.
+        """
+        if not provider.listed_kinds:
+            return
+        kinds = ",".join("?" * len(provider.listed_kinds))
+        reader = _connect(self.ledger.path)
+        try:
+            cursor = reader.execute(
+                f"SELECT order_id, status, amount FROM orders o WHERE o.created_at >= ? AND o.created_at < ?"
+                f" AND o.kind IN ({kinds}) AND NOT EXISTS ("
+                f" SELECT 1 FROM reconcile_seen s WHERE s.run_id = ? AND s.charge_id = o.order_id)",
+                (since, until, *provider.listed_kinds, run_id)
+            )
+            now = time.time()
+            while True:
+                rows = cursor.fetchmany(RECONCILE_QUERY_LIMIT)
+                if not rows:
+                    break
+                with conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO reconcile_mismatches (run_id, charge_id, type, local_status,"
+                        " local_amount, found_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(run_id, order_id, MISSING_ON_GATEWAY, status, amount, now)
+                         for order_id, status, amount in rows if provider.owns_charge(order_id)]
+                    )
+        finally:
+            reader.close()
+
+    def _check_unlisted(self, conn, provider, fetcher, run_id, until):
+        """
+        Checks, one request each, the unpaid orders in the window of a kind
+        the provider can check but not list. Keyset reads on the created_at
+        index (ties broken by rowid) resume exactly where the last committed
+        chunk stopped.
+        """
+        kinds = [k for k in provider.checked_kinds if k not in provider.listed_kinds]
+        if not kinds:
+            return
+        placeholders = ",".join("?" * len(kinds))
+        after, after_rowid = conn.execute(
+            "SELECT check_after, check_after_rowid FROM reconcile_runs WHERE provider = ?", (provider.name,)
+        ).fetchone()
+        while True:
+            rows = conn.execute(
+                f"SELECT rowid, order_id, status, amount, created_at FROM orders"
+                f" WHERE (created_at, rowid) > (?, ?) AND created_at < ? AND kind IN ({placeholders})"
+                f" AND status = 'created' ORDER BY created_at, rowid LIMIT ?",
+                (after, after_rowid, until, *kinds, self.page_size)
+            ).fetchall()
+            if not rows:
+                return
+            owned = [row for row in rows if provider.owns_charge(row[1])]
+            charges = fetcher.check([order_id for _, order_id, _, _, _ in owned])
+
+            now = time.time()
+            mismatches, unacknowledged = [], []
+            for (_, order_id, local_status, local_amount, _), charge in zip(owned, charges):
+                if charge is None:
+                    mismatches.append((order_id, MISSING_ON_GATEWAY, local_status, None, local_amount, None))
+                    continue
+                for mismatch in _compare(charge, local_status, local_amount):
+                    mismatches.append((order_id, *mismatch))
+                    if mismatch[0] == UNACKNOWLEDGED_PAYMENT:
+                        unacknowledged.append(order_id)
+
+            after_rowid, after = rows[-1][0], rows[-1][4]
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO reconcile_mismatches (run_id, charge_id, type, local_status,"
+                    " gateway_status, local_amount, gateway_amount, found_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(run_id, *m, now) for m in mismatches]
+                )
+                conn.execute(
+                    "UPDATE reconcile_runs SET check_after = ?, check_after_rowid = ?, checked = checked + ?"
+                    " WHERE provider = ?", (after, after_rowid, len(owned), provider.name)
+                )
+            self._acknowledge(unacknowledged)
+
+    # --- Results ---
+
+    def status(self):
+        conn = self._conn()
+        result = {}
+        for provider, run_id, status, next_page, charges, checked, started_at, finished_at, error in conn.execute(
+            "SELECT provider, run_id, status, next_page, charges, checked, started_at, finished_at, error"
+            " FROM reconcile_runs"
+        ):
+            counts = dict(conn.execute(
+                "SELECT type, COUNT(*) FROM reconcile_mismatches WHERE run_id = ? GROUP BY type", (run_id,)
+            ).fetchall())
+            result[provider] = {
+                "run_id": run_id,
+                "status": status,
+                "pages": next_page - 1,
+                "charges": charges,
+                "checked": checked,
+                "started_at": started_at,
+                "finished_at": finished_at,
+                "error": error,
+                "mismatches": counts,
+            }
+        return result
+
+    def mismatches(self, provider, type=None, after=None, limit=RECONCILE_QUERY_LIMIT):
+        """
+        Mismatches from the provider's latest run, ordered by charge id.
+        Pass the last charge_id as `after` to get the next page.
+        """
+        row = self._conn().execute("SELECT run_id FROM reconcile_runs WHERE provider = ?", (provider,)).fetchone()
+        if row is None:
+            return []
+        clauses, params = ["run_id = ?"], [row[0]]
+        if type:
+            clauses.append("type = ?")
+            params.append(type)
+        if after:
+            clauses.append("charge_id > ?")
+            params.append(after)
+        params.append(max(1, min(limit, RECONCILE_QUERY_LIMIT)))  # SQLite reads a negative LIMIT as "no limit"
+        rows = self._conn().execute(
+            f"SELECT {', '.join(MISMATCH_COLUMNS)} FROM reconcile_mismatches WHERE {' AND '.join(clauses)}"
+            f" ORDER BY charge_id LIMIT ?", params
+        ).fetchall()
+        return [dict(zip(MISMATCH_COLUMNS, row)) for row in rows]
+
@@ -0,0 +1,179 @@
+import os
+import hmac
+import time
+import pstats
+import random
+import cProfile
+import logging
+import threading
+import tracemalloc
+
+from flask import request, g
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))  # fraction of requests, 0 disables sampling
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 50))
+PROFILE_MAX_BYTES = int(os.getenv("PROFILE_MAX_BYTES", 50 * 1024 * 1024))
+PROFILE_HEADER = "X-Profile"  # value must be the admin token
+TRACEMALLOC_FRAMES = 10
+
+
+class RequestProfiler:
+    """
+    Runs cProfile around selected requests and keeps the resulting pstats
+    files in PROFILE_DIR, capped by count and total size.
+
+    A request is profiled when it carries X-Profile with the admin token, or
+    when it is picked by PROFILE_SAMPLE_RATE. With no header and a zero rate
+    the hooks return after a single header lookup.
+    """
+
+    def __init__(self, admin_token=None, profile_dir=PROFILE_DIR, sample_rate=PROFILE_SAMPLE_RATE,
+                 max_files=PROFILE_MAX_FILES, max_bytes=PROFILE_MAX_BYTES):
+        self.admin_token = admin_token
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        # cProfile allows only one active profiler per process at a time
+        self._active = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def _should_profile(self):
+        token = request.headers.get(PROFILE_HEADER)
+        if token is not None:
+            return bool(self.admin_token) and hmac.compare_digest(token, self.admin_token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _before_request(self):
+        if not self._should_profile() or not self._active.acquire(blocking=False):
+            return
+        profiler = cProfile.Profile()
+        g._profiler = profiler
+        g._profile_started = time.perf_counter()
+        profiler.enable()
+
+    def _after_request(self, response):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        self._active.release()
+
+        elapsed_ms = (time.perf_counter() - g.pop('_profile_started')) * 1000
+        endpoint = (request.endpoint or 'unknown').replace('/', '_')
+        filename = f"{int(time.time() * 1000)}_{endpoint}_{elapsed_ms:.0f}ms.pstats"
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, filename))
+            self._enforce_limits()
+        except OSError as e:
+            logger.warning(f"Could not save request profile: {str(e)}")
+            return response
+
+        response.headers['X-Profile-File'] = filename
+        return response
+
+    def _teardown_request(self, exc):
+        # The view raised before after_request ran: don't leave the profiler on
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._active.release()
+
+    def _profile_files(self):
+        """
+        Profile paths, newest first.
+        """
+        try:
+            names = [n for n in os.listdir(self.profile_dir) if n.endswith('.pstats')]
+        except OSError:
+            return []
+        return [os.path.join(self.profile_dir, n) for n in sorted(names, reverse=True)]
+
+    def _enforce_limits(self):
+        total = 0
+        for index, path in enumerate(self._profile_files()):
+            size = os.path.getsize(path)
+            total += size
+            if index >= self.max_files or total > self.max_bytes:
+                os.remove(path)
+
+    def summary(self, profiles=10, limit=25):
+        """
+        Merges the most recent profiles and returns the top functions by
+        cumulative time.
+        """
+        paths = self._profile_files()[:profiles]
+        if not paths:
+            return {"profiles": [], "functions": []}
+
+        stats = pstats.Stats(*paths)
+        rows = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 3),
+                "cumtime_ms": round(cumtime * 1000, 3),
+            })
+        rows.sort(key=lambda row: row["cumtime_ms"], reverse=True)
+        return {"profiles": [os.path.basename(p) for p in paths], "functions": rows[:limit]}
+
+
+class MemoryTracker:
+    """
+    On-demand tracemalloc: snapshot() starts tracing (if needed) and stores a
+    baseline, diff() compares the current heap against it. Tracing is off
+    until the first snapshot and can be switched off again with stop().
+    """
+
+    def __init__(self, frames=TRACEMALLOC_FRAMES):
+        self.frames = frames
+        self._baseline = None
+        self._baseline_at = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self._baseline = tracemalloc.take_snapshot()
+            self._baseline_at = time.time()
+            current, peak = tracemalloc.get_traced_memory()
+        return {"tracing": True, "baseline_at": self._baseline_at, "current_bytes": current, "peak_bytes": peak}
+
+    def diff(self, limit=20):
+        with self._lock:
+            if self._baseline is None or not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self._baseline, 'lineno')
+            current, peak = tracemalloc.get_traced_memory()
+
+        return {
+            "baseline_at": self._baseline_at,
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {
+                    "location": str(stat.traceback[0]),
+                    "size_diff_bytes": stat.size_diff,
+                    "size_bytes": stat.size,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._baseline = None
+            self._baseline_at = None
@@ -0,0 +1,201 @@
+import os
+import time
+import zlib
+import logging
+import threading
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))  # bytes; smaller bodies go out as-is
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 5))
+COMPRESS_STREAM_THRESHOLD = int(os.getenv("COMPRESS_STREAM_THRESHOLD", 256 * 1024))  # bytes
+COMPRESS_CHUNK_SIZE = 64 * 1024
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json", "application/javascript", "text/html", "text/css", "text/plain", "image/svg+xml",
+}
+
+
+def parse_accept_encoding(header):
+    """
+    Returns {coding: q} from an Accept-Encoding header.
+    """
+    accepted = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header):
+    """
+    Picks the best coding we support, preferring Brotli on ties.
+    Returns None when the client accepts neither.
+    """
+    if not header:
+        return None
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get('*', 0.0)
+    candidates = (['br'] if brotli is not None else []) + ['gzip']
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _Compressor:
+    """
+    Uniform compress()/flush() over gzip and Brotli.
+    """
+
+    def __init__(self, encoding, gzip_level, brotli_quality):
+        if encoding == 'br':
+            self._obj = brotli.Compressor(quality=brotli_quality)
+            self.compress = self._obj.process
+            self.flush = self._obj.finish
+        else:
+            # wbits=31 writes a gzip header and trailer
+            self._obj = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress = self._obj.compress
+            self.flush = self._obj.flush
+
+
+class ResponseCompressor:
+    """
+    Compresses API responses according to Accept-Encoding.
+
+    Bodies under COMPRESS_MIN_SIZE, non-text types and already-encoded
+    responses pass through untouched. Bodies above COMPRESS_STREAM_THRESHOLD
+    and streamed responses are compressed chunk by chunk instead of being
+    held in memory twice. Per-endpoint counters record bytes saved and the
+    CPU time spent so the threshold and level can be tuned.
+    """
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, gzip_level=COMPRESS_GZIP_LEVEL,
+                 brotli_quality=COMPRESS_BROTLI_QUALITY, stream_threshold=COMPRESS_STREAM_THRESHOLD):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.stream_threshold = stream_threshold
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.after_request(self._after_request)
+
+    def _record(self, endpoint, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"compressed": 0, "bytes_in": 0, "bytes_out": 0, "cpu_ms": 0.0})
+            stats["compressed"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["cpu_ms"] += cpu_seconds * 1000
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._stats.items():
+                saved = stats["bytes_in"] - stats["bytes_out"]
+                result[endpoint] = {
+                    **stats,
+                    "cpu_ms": round(stats["cpu_ms"], 3),
+                    "bytes_saved": saved,
+                    "ratio": round(stats["bytes_out"] / stats["bytes_in"], 4) if stats["bytes_in"] else None,
+                }
+            return result
+
+    def _is_compressible(self, response):
+        if request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in response.headers or response.direct_passthrough:
+            return False
+        if 'no-transform' in response.headers.get('Cache-Control', ''):
+            return False
+        return response.mimetype in COMPRESSIBLE_MIMETYPES
+
+    def _after_request(self, response):
+        if not self._is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        endpoint = request.endpoint or 'unknown'
+        if response.is_streamed:
+            self._compress_streaming(response, encoding, endpoint, response.response)
+            return response
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+
+        if len(body) >= self.stream_threshold:
+            chunks = (body[i:i + COMPRESS_CHUNK_SIZE] for i in range(0, len(body), COMPRESS_CHUNK_SIZE))
+            self._compress_streaming(response, encoding, endpoint, chunks)
+            return response
+
+        started = time.thread_time()
+        compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+        compressed = compressor.compress(body) + compressor.flush()
+        self._record(endpoint, len(body), len(compressed), time.thread_time() - started)
+
+        response.set_data(compressed)
+        self._mark_encoded(response, encoding)
+        return response
+
+    def _compress_streaming(self, response, encoding, endpoint, chunks):
+        compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+
+        def generate():
+            bytes_in = bytes_out = 0
+            cpu = 0.0
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                started = time.thread_time()
+                out = compressor.compress(chunk)
+                cpu += time.thread_time() - started
+                bytes_in += len(chunk)
+                bytes_out += len(out)
+                if out:
+                    yield out
+            started = time.thread_time()
+            out = compressor.flush()
+            cpu += time.thread_time() - started
+            bytes_out += len(out)
+            self._record(endpoint, bytes_in, bytes_out, cpu)
+            yield out
+
+        response.response = generate()
+        response.headers.pop('Content-Length', None)
+        self._mark_encoded(response, encoding)
+
+    @staticmethod
+    def _mark_encoded(response, encoding):
+        response.headers['Content-Encoding'] = encoding
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # The encoded bytes differ from the identity representation
+            response.headers['ETag'] = f"W/{etag}"
@@ -0,0 +1,226 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from nickname_directory import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SALES_TZ_OFFSET_HOURS = int(os.getenv("SALES_TZ_OFFSET_HOURS", -3))  # bucket boundaries in Brasília time
+SALES_HOURLY_RETENTION_DAYS = int(os.getenv("SALES_HOURLY_RETENTION_DAYS", 7))  # then folded into days
+SALES_DAILY_RETENTION_DAYS = int(os.getenv("SALES_DAILY_RETENTION_DAYS", 730))
+SALES_REPORT_CACHE_TTL = int(os.getenv("SALES_REPORT_CACHE_TTL", 30))  # seconds
+SALES_COMPACTION_INTERVAL = 3600  # seconds
+MAX_REPORT_BUCKETS = 24 * 92  # one quarter of hourly buckets per query
+
+HOUR = 3600
+DAY = 86400
+GRANULARITY_SECONDS = {"hour": HOUR, "day": DAY}
+
+# Counter slots per (bucket, product). Conversion is PIX generated -> paid, so PIX
+# orders are also counted on their own; hosted billings only add to the totals.
+CREATED, PAID, REVENUE, PIX_CREATED, PIX_PAID = range(5)
+SLOTS = range(5)
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS sales_rollups (
+    granularity TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    product TEXT NOT NULL,
+    created INTEGER NOT NULL DEFAULT 0,
+    paid INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    pix_created INTEGER NOT NULL DEFAULT 0,
+    pix_paid INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, bucket, product)
+)"""
+
+ADD_COUNTERS = (
+    "ON CONFLICT(granularity, bucket, product) DO UPDATE SET "
+    "created = created + excluded.created, paid = paid + excluded.paid, revenue = revenue + excluded.revenue, "
+    "pix_created = pix_created + excluded.pix_created, pix_paid = pix_paid + excluded.pix_paid"
+)
+
+UPSERT = (
+    "INSERT INTO sales_rollups (granularity, bucket, product, created, paid, revenue, pix_created, pix_paid) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) " + ADD_COUNTERS
+)
+
+
+def bucket_start(timestamp, granularity):
+    """
+    Start of the local-time bucket containing timestamp, as a UTC epoch.
+    """
+    size = GRANULARITY_SECONDS[granularity]
+    offset = SALES_TZ_OFFSET_HOURS * HOUR
+    return int((timestamp + offset) // size * size - offset)
+
+
+class SalesAggregator:
+    """
+    Pre-aggregated sales counters per product, in hourly buckets that are
+    folded into daily buckets after SALES_HOURLY_RETENTION_DAYS.
+
+    Counters live in memory and are updated as orders are created and paid;
+    every increment is also persisted through the order ledger's batched
+    writer, so reports never scan orders and a restart reloads the rollups.
+    """
+
+    def __init__(self, ledger, cache_ttl=SALES_REPORT_CACHE_TTL):
+        self.ledger = ledger
+        self._buckets = {"hour": {}, "day": {}}
+        self._lock = threading.Lock()
+        self._cache = TTLCache(maxsize=256)
+        self.cache_ttl = cache_ttl
+        self._last_compaction = float('-inf')
+        self._load()
+
+    def _load(self):
+        conn = sqlite3.connect(self.ledger.path)
+        try:
+            conn.execute(SCHEMA)
+            conn.commit()
+            rows = conn.execute(
+                "SELECT granularity, bucket, product, created, paid, revenue, pix_created, pix_paid FROM sales_rollups"
+            ).fetchall()
+        finally:
+            conn.close()
+        for granularity, bucket, product, *counters in rows:
+            self._buckets[granularity].setdefault(bucket, {})[product] = counters
+
+    # --- Incremental updates ---
+
+    def order_created(self, product, kind, timestamp=None):
+        pix = int(kind == "pix")
+        self._increment(product, timestamp, (1, 0, 0, pix, 0))
+
+    def order_paid(self, product, kind, amount, timestamp=None):
+        pix = int(kind == "pix")
+        self._increment(product, timestamp, (0, 1, amount, 0, pix))
+
+    def _increment(self, product, timestamp, deltas):
+        timestamp = time.time() if timestamp is None else timestamp
+        bucket = bucket_start(timestamp, "hour")
+        with self._lock:
+            counters = self._buckets["hour"].setdefault(bucket, {}).setdefault(product, [0] * len(SLOTS))
+            for i in SLOTS:
+                counters[i] += deltas[i]
+        self.ledger.enqueue_write(UPSERT, ("hour", bucket, product, *deltas))
+        self._maybe_compact()
+
+    # --- Compaction ---
+
+    def _maybe_compact(self):
+        if time.monotonic() - self._last_compaction < SALES_COMPACTION_INTERVAL:
+            return
+        self._last_compaction = time.monotonic()
+        self.compact()
+
+    def compact(self, now=None):
+        """
+        Folds hourly buckets older than the hourly retention into their day
+        and drops days older than the daily retention.
+        """
+        now = time.time() if now is None else now
+        hourly_cutoff = bucket_start(now - SALES_HOURLY_RETENTION_DAYS * DAY, "day")
+        daily_cutoff = bucket_start(now - SALES_DAILY_RETENTION_DAYS * DAY, "day")
+
+        with self._lock:
+            hours, days = self._buckets["hour"], self._buckets["day"]
+            for bucket in [b for b in hours if b < hourly_cutoff]:
+                day = days.setdefault(bucket_start(bucket, "day"), {})
+                for product, counters in hours.pop(bucket).items():
+                    totals = day.setdefault(product, [0] * len(SLOTS))
+                    for i in SLOTS:
+                        totals[i] += counters[i]
+            for bucket in [b for b in days if b < daily_cutoff]:
+                del days[bucket]
+
+        # Same fold on disk, queued behind any pending increments
+        self.ledger.enqueue_write(
+            "INSERT INTO sales_rollups (granularity, bucket, product, created, paid, revenue, pix_created, pix_paid) "
+            "SELECT 'day', bucket - ((bucket + ?) % ?) AS day, product, SUM(created), SUM(paid), SUM(revenue), "
+            "SUM(pix_created), SUM(pix_paid) "
+            "FROM sales_rollups WHERE granularity = 'hour' AND bucket < ? GROUP BY day, product " + ADD_COUNTERS,
+            (SALES_TZ_OFFSET_HOURS * HOUR, DAY, hourly_cutoff)
+        )
+        self.ledger.enqueue_write(
+            "DELETE FROM sales_rollups WHERE granularity = 'hour' AND bucket < ?", (hourly_cutoff,)
+        )
+        self.ledger.enqueue_write(
+            "DELETE FROM sales_rollups WHERE granularity = 'day' AND bucket < ?", (daily_cutoff,)
+        )
+        self._cache.clear()
+
+    # --- Reports ---
+
+    def report(self, start, end, granularity="hour"):
+        """
+        Totals, PIX conversion and a per-bucket series for [start, end).
+        Cost depends on the number of buckets in the range, never on the
+        number of orders; identical queries are served from a short cache.
+        """
+        size = GRANULARITY_SECONDS[granularity]
+        start = bucket_start(start, granularity)
+        end = bucket_start(end - 1, granularity) + size
+        if (end - start) // size > MAX_REPORT_BUCKETS:
+            raise ValueError(f"Range too large: at most {MAX_REPORT_BUCKETS} {granularity} buckets")
+
+        cache_key = (start, end, granularity)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        series = []
+        totals = {}
+        with self._lock:
+            for bucket in range(start, end, size):
+                products = self._bucket_totals(bucket, granularity)
+                if products:
+                    series.append({"bucket": bucket, "products": _as_dicts(products)})
+                for product, counters in products.items():
+                    product_totals = totals.setdefault(product, [0] * len(SLOTS))
+                    for i in SLOTS:
+                        product_totals[i] += counters[i]
+
+        pix_created = sum(c[PIX_CREATED] for c in totals.values())
+        pix_paid = sum(c[PIX_PAID] for c in totals.values())
+        result = {
+            "start": start,
+            "end": end,
+            "granularity": granularity,
+            "totals": {
+                "created": sum(c[CREATED] for c in totals.values()),
+                "paid": sum(c[PAID] for c in totals.values()),
+                "revenue": sum(c[REVENUE] for c in totals.values()),
+                "pix_created": pix_created,
+                "pix_paid": pix_paid,
+                "conversion": round(pix_paid / pix_created, 4) if pix_created else None,  # PIX only
+            },
+            "products": _as_dicts(totals),
+            "series": series,
+        }
+        self._cache.set(cache_key, result, self.cache_ttl)
+        return result
+
+    def _bucket_totals(self, bucket, granularity):
+        if granularity == "hour":
+            return self._buckets["hour"].get(bucket, {})
+
+        # A day is its compacted bucket plus any hours not folded in yet
+        totals = {product: list(c) for product, c in self._buckets["day"].get(bucket, {}).items()}
+        for hour in range(bucket, bucket + DAY, HOUR):
+            for product, counters in self._buckets["hour"].get(hour, {}).items():
+                product_totals = totals.setdefault(product, [0] * len(SLOTS))
+                for i in SLOTS:
+                    product_totals[i] += counters[i]
+        return totals
+
+
+def _as_dicts(products):
+    return {
+        product: {"created": c[CREATED], "paid": c[PAID], "revenue": c[REVENUE],
+                  "pix_created": c[PIX_CREATED], "pix_paid": c[PIX_PAID]}
+        for product, c in products.items()
+    }
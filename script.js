@@ -51,7 +51,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (input) input.classList.remove('valid');
             const img = modal.querySelector('.avatar-preview-img');
             // Simplified reset to just a default steve head or just keep whatever
-            if (img) img.src = `https://mc-heads.net/body/Steve/right`;
+            if (img) img.src = `${API_BASE_URL}/avatar/Steve`;
         }
     }
 
@@ -191,9 +191,21 @@ document.addEventListener('DOMContentLoaded', () => {
                 nickFeedback.textContent = 'Verificando disponibilidade...';
                 nickFeedback.style.color = '#d35400';
 
-                typingTimer = setTimeout(() => {
-                    // Simulate API check
-                    const isAvailable = true; // Mock availability
+                typingTimer = setTimeout(async () => {
+                    let isAvailable = true;
+                    try {
+                        const response = await fetch(`${API_BASE_URL}/nickname/${encodeURIComponent(value)}`);
+                        if (response.ok) {
+                            const data = await response.json();
+                            isAvailable = data.exists;
+                        }
+                    } catch (error) {
+                        // Directory unreachable: don't block the buyer, the server re-checks on checkout
+                        console.warn('Nickname check failed', error);
+                    }
+
+                    // Ignore stale answers if the user kept typing
+                    if (nicknameInput.value.trim() !== value) return;
 
                     if (isAvailable) {
                         nicknameInput.classList.add('valid');
@@ -203,7 +215,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         if (avatarPreviewImg) updateAvatar(avatarPreviewImg, value);
                     } else {
                         nicknameInput.classList.add('invalid');
-                        nickFeedback.textContent = '✕ Nick indisponível';
+                        nickFeedback.textContent = '✕ Jogador não encontrado no servidor';
                         nickFeedback.style.color = '#e74c3c';
                         validationState.nick = false;
                     }
@@ -432,7 +444,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function updateAvatar(imgElement, username) {
-        imgElement.src = `https://mc-heads.net/body/${username}/right`;
+        imgElement.src = `${API_BASE_URL}/avatar/${encodeURIComponent(username)}`;
     }
 
     // Terms Link Action (in purchase modals)
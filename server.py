@@ -1,13 +1,28 @@
 import os
+import hmac
 import json
 import logging
 import time
-from flask import Flask, request, jsonify
+import threading
+from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from avatar_proxy import AvatarProxy, AVATAR_FALLBACK_TTL
+from response_compression import ResponseCompressor
+from json_codec import CodecJSONProvider
+from payment_gateways import (
+    GatewayError, create_gateway_router, gateway_error_response
+)
+from checkout_payloads import ProductTemplate, build_product_templates, customer_fields
+from rcon_delivery import create_delivery_service
+from order_ledger import OrderLedger
+from sales_report import SalesAggregator
+from flash_sale import FlashSaleInventory, OVERSOLD
+from reconciliation import Reconciler, RECONCILE_INTERVAL
+from request_profiler import RequestProfiler, MemoryTracker
+from nickname_directory import (
+    TTLCache, NicknameService, load_player_directory, is_valid_nickname, normalize_nickname, MAX_BATCH_SIZE
+)
 
 # Load environment variables
 load_dotenv()
@@ -26,12 +41,22 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
+# Request parsing and jsonify() go through the shared codec (orjson when installed)
+app.json = CodecJSONProvider(app)
+
+# gzip/Brotli for API responses (brCodeBase64 alone is tens of KB)
+response_compressor = ResponseCompressor()
+response_compressor.init_app(app)
+
 # Configuration
 ABACATE_API_TOKEN = os.getenv("ABACATE_PAY_TOKEN", "abc_prod_0mDdwwz23aySmeUemLQmPhzw")
 ABACATE_API_URL = "https://api.abacatepay.com/v1/billing/create"
 ABACATE_PIX_URL = "https://api.abacatepay.com/v1/pixQrCode/create"
 API_TIMEOUT = int(os.getenv("API_TIMEOUT", 30))  # 30 seconds timeout
 
+# Payment providers (PAYMENT_PROVIDERS), routed by rolling latency/error stats with failover
+payment_router = create_gateway_router(ABACATE_API_TOKEN, ABACATE_API_URL, ABACATE_PIX_URL, API_TIMEOUT)
+
 # Product Pricing (in cents)
 PRICES = {
     "LORD": 4990,
@@ -40,23 +65,51 @@ PRICES = {
     "CHAMPION": 12990
 }
 
-# --- Helper Functions ---
+RETURN_URL = os.getenv("RETURN_URL", "http://localhost:5500/success")
+COMPLETION_URL = os.getenv("COMPLETION_URL", "http://localhost:5500/success")
 
-def get_requests_session():
-    """
-    Creates a requests session with retry logic and backoff.
-    """
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=3,
-        backoff_factor=1,  # wait 1s, 2s, 4s...
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
-    return session
+# Gateway payload parts that only depend on the product, built once
+PRODUCT_TEMPLATES = build_product_templates(PRICES, RETURN_URL, COMPLETION_URL)
+
+# Player directory used to check that a nickname exists (e.g. "file:usercache.json", "sqlite:players.db").
+# When unset, nickname checks are disabled and every well-formed nickname is accepted.
+PLAYER_DIRECTORY = os.getenv("PLAYER_DIRECTORY")
+_player_directory = load_player_directory(PLAYER_DIRECTORY)
+nickname_service = NicknameService(_player_directory) if _player_directory else None
+
+# Avatar proxy (replaces hot-linking mc-heads.net from the browser)
+avatar_proxy = AvatarProxy()
+
+# Token required by the admin/ops endpoints (sent as X-Admin-Token). Unset disables them.
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+
+# In-game kit delivery over RCON (disabled unless RCON_HOST is set)
+delivery_service = create_delivery_service()
+
+# Order ledger (SQLite, written in the background)
+order_ledger = OrderLedger()
+
+# Live sales rollups (persisted through the ledger writer)
+sales_aggregator = SalesAggregator(order_ledger)
+
+# Limited-stock flash sales (journaled in the ledger database)
+flash_inventory = FlashSaleInventory(order_ledger)
+FLASH_STOCK_MAX_AGE = 2  # seconds browsers/CDNs may cache GET /stock
+
+# Gateway charges vs. ledger reconciliation (every RECONCILE_INTERVAL seconds, or POST /reconciliation/run)
+reconciler = Reconciler(order_ledger, payment_router.providers)
+reconciler.schedule(RECONCILE_INTERVAL)
+RECONCILE_AUTO_CONFIRM = os.getenv("RECONCILE_AUTO_CONFIRM", "0") == "1"  # confirm paid orders it finds
+
+# Opt-in profiling: X-Profile header with the admin token, or PROFILE_SAMPLE_RATE
+request_profiler = RequestProfiler(admin_token=ADMIN_API_TOKEN)
+request_profiler.init_app(app)
+memory_tracker = MemoryTracker()
+
+# Shared secret Abacate Pay sends as ?webhookSecret= on webhook calls
+ABACATE_WEBHOOK_SECRET = os.getenv("ABACATE_WEBHOOK_SECRET")
+
+# --- Helper Functions ---
 
 def validate_customer_data(data):
     """
@@ -85,6 +138,15 @@ def validate_customer_data(data):
     if len(cpf_clean) != 11:
         return False, "CPF must have 11 digits"
 
+    # The nickname ends up in RCON commands, so its format is always enforced
+    nickname = str(data.get('nickname', ''))
+    if not is_valid_nickname(nickname):
+        return False, "Invalid nickname format"
+
+    # Player must exist on the game server (answered from cache in the common case)
+    if nickname_service is not None and not nickname_service.exists(nickname):
+        return False, f"Player not found: {nickname}"
+
     return True, None
 
 def sanitize_phone(phone):
@@ -105,13 +167,397 @@ def sanitize_phone(phone):
         
     return clean
 
+def check_admin_token():
+    """
+    Returns an error response tuple if the request lacks a valid admin token, else None.
+    """
+    if not ADMIN_API_TOKEN:
+        return jsonify({"error": "Admin API disabled"}), 403
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token, ADMIN_API_TOKEN):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+# Orders confirmed recently, so duplicate webhooks are not counted twice
+_confirmed_orders = TTLCache(maxsize=10000)
+_confirm_lock = threading.Lock()
+
+def confirm_order(order_id):
+    """
+    Marks a ledger order as paid, counts it in the sales rollups and queues
+    the in-game delivery. Safe to call more than once for the same order.
+    Returns the order's final status ("paid", or "oversold" for a flash-sale
+    order paid after its unit was resold), or None if the order is unknown.
+    """
+    order = order_ledger.get(order_id)
+    if order is None:
+        return None
+
+    with _confirm_lock:
+        done = _confirmed_orders.get(order_id)
+        if done or order["status"] in ("paid", "oversold"):
+            return done or order["status"]
+        _confirmed_orders.set(order_id, "paid", 86400)
+
+    try:
+        # The flash-sale and delivery steps are idempotent and the rollup comes after them,
+        # so until the order is marked a retried webhook can still finish the job
+        if flash_inventory.confirm(order_id) == OVERSOLD:
+            status = "oversold"
+            logger.error(f"Order {order_id} paid but {order['product']} sold out; not delivered, refund it")
+        else:
+            status = "paid"
+            if delivery_service is not None:
+                delivery_service.enqueue(order_id, order["nickname"], order["product"])
+            sales_aggregator.order_paid(order["product"], order["kind"], order["amount"])
+        order_ledger.update_status(order_id, status)
+    except Exception:
+        _confirmed_orders.pop(order_id)
+        raise
+    _confirmed_orders.set(order_id, status, 86400)
+    logger.info(f"Order {order_id} {status}: {order['product']} for {order['nickname']}")
+    return status
+
+if RECONCILE_AUTO_CONFIRM:
+    reconciler.on_unacknowledged = confirm_order
+
+# Templates at flash-sale prices, keyed by (product, price)
+_flash_templates = {}
+
+def flash_sale_template(product_name, sale):
+    """
+    Product template for the current price: the regular one, or one at the
+    flash-sale price (cached per price).
+    """
+    if sale is None:
+        return PRODUCT_TEMPLATES[product_name]
+    key = (product_name, sale.price)
+    template = _flash_templates.get(key)
+    if template is None:
+        template = ProductTemplate(product_name, sale.price, RETURN_URL, COMPLETION_URL)
+        _flash_templates[key] = template
+    return template
+
+def hold_flash_reservation(req_id, reservation, order_id):
+    """
+    Ties a reservation to the order just created and waits for the group
+    commit, so a unit we hand out survives a restart.
+    """
+    flash_inventory.attach_order(reservation, order_id)
+    if not reservation.wait_durable():
+        logger.warning(f"[{req_id}] Flash-sale reservation {reservation.id} not confirmed on disk")
+
+def sold_out_response(product_name):
+    return jsonify({"error": "Estoque esgotado para este kit.", "product": product_name}), 409
+
 # --- Routes ---
 
+@app.route('/nickname/<nickname>', methods=['GET'])
+def check_nickname(nickname):
+    if not is_valid_nickname(nickname):
+        return jsonify({"error": "Invalid nickname format"}), 400
+
+    if nickname_service is None:
+        return jsonify({"nickname": nickname, "exists": True, "verified": False})
+
+    try:
+        exists = nickname_service.exists(nickname)
+    except Exception as e:
+        logger.exception(f"Nickname lookup failed for {nickname}: {str(e)}")
+        return jsonify({"error": "Player directory unavailable"}), 503
+
+    return jsonify({"nickname": nickname, "exists": exists, "verified": True})
+
+@app.route('/nicknames', methods=['POST'])
+def check_nicknames():
+    data = request.json or {}
+    nicknames = data.get('nicknames')
+    if not isinstance(nicknames, list) or not nicknames:
+        return jsonify({"error": "Field 'nicknames' must be a non-empty list"}), 400
+    if len(nicknames) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} nicknames per request"}), 400
+
+    invalid = [n for n in nicknames if not isinstance(n, str) or not is_valid_nickname(n)]
+    if invalid:
+        return jsonify({"error": "Invalid nickname format", "invalid": invalid}), 400
+
+    if nickname_service is None:
+        return jsonify({"results": {n: True for n in nicknames}, "verified": False})
+
+    try:
+        found = nickname_service.exists_many(nicknames)
+    except Exception as e:
+        logger.exception(f"Batch nickname lookup failed: {str(e)}")
+        return jsonify({"error": "Player directory unavailable"}), 503
+
+    return jsonify({"results": {n: found[normalize_nickname(n)] for n in nicknames}, "verified": True})
+
+@app.route('/avatar/<nickname>', methods=['GET'])
+def avatar(nickname):
+    if is_valid_nickname(nickname):
+        entry, is_fallback = avatar_proxy.get(nickname)
+    else:
+        entry, is_fallback = avatar_proxy.fallback(), True
+
+    max_age = AVATAR_FALLBACK_TTL if is_fallback else avatar_proxy.ttl
+    response = make_response(entry.body)
+    response.headers['Content-Type'] = entry.content_type
+    response.headers['Cache-Control'] = f"public, max-age={max_age}"
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+@app.route('/deliveries', methods=['POST'])
+def enqueue_delivery():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    if delivery_service is None:
+        return jsonify({"error": "Delivery service disabled"}), 503
+
+    data = request.json or {}
+    order_id = data.get('order_id')
+    nickname = data.get('nickname')
+    product = str(data.get('product', '')).replace('KIT', '').strip().upper()
+    if not order_id or not nickname or product not in PRICES:
+        return jsonify({"error": "Fields 'order_id', 'nickname' and a valid 'product' are required"}), 400
+
+    try:
+        queued = delivery_service.enqueue(str(order_id), nickname, product)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"order_id": order_id, "queued": queued}), 202 if queued else 200
+
+@app.route('/deliveries/stats', methods=['GET'])
+def delivery_stats():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    if delivery_service is None:
+        return jsonify({"error": "Delivery service disabled"}), 503
+    return jsonify(delivery_service.stats())
+
+@app.route('/deliveries/<order_id>', methods=['GET'])
+def delivery_status(order_id):
+    denied = check_admin_token()
+    if denied:
+        return denied
+    if delivery_service is None:
+        return jsonify({"error": "Delivery service disabled"}), 503
+
+    status = delivery_service.store.status(order_id)
+    if status is None:
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify({"order_id": order_id, **status})
+
+@app.route('/orders', methods=['GET'])
+def list_orders():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    args = request.args
+    try:
+        since = float(args['since']) if 'since' in args else None
+        until = float(args['until']) if 'until' in args else None
+        limit = int(args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "'since', 'until' and 'limit' must be numbers"}), 400
+
+    product = args.get('product', '').replace('KIT', '').strip().upper() or None
+    orders = order_ledger.find(
+        nickname=args.get('nickname'), cpf=args.get('cpf'), product=product,
+        status=args.get('status'), since=since, until=until, limit=limit
+    )
+    return jsonify({"orders": orders})
+
+@app.route('/orders/<order_id>', methods=['GET'])
+def get_order(order_id):
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    order = order_ledger.get(order_id)
+    if order is None:
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify(order)
+
+@app.route('/orders/<order_id>/confirm', methods=['POST'])
+def confirm_order_route(order_id):
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    status = confirm_order(order_id)
+    if status is None:
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify({"order_id": order_id, "status": status})
+
+@app.route('/webhook/abacate-pay', methods=['POST'])
+def abacate_webhook():
+    secret = request.args.get('webhookSecret', '')
+    if not ABACATE_WEBHOOK_SECRET or not hmac.compare_digest(secret, ABACATE_WEBHOOK_SECRET):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    event = request.json or {}
+    if event.get('event') != 'billing.paid':
+        return jsonify({"received": True})
+
+    payload = event.get('data') or {}
+    charge = payload.get('pixQrCode') or payload.get('billing') or {}
+    order_id = charge.get('id')
+    if not order_id or not confirm_order(order_id):
+        logger.warning(f"Webhook for unknown order: {order_id}")
+        return jsonify({"error": "Order not found"}), 404
+    return jsonify({"received": True})
+
+@app.route('/stock', methods=['GET'])
+def flash_sale_stock():
+    response = jsonify({"sales": flash_inventory.snapshot()})
+    response.headers['Cache-Control'] = f'public, max-age={FLASH_STOCK_MAX_AGE}'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/flash-sales', methods=['POST'])
+def configure_flash_sale():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    data = request.json or {}
+    product_name = str(data.get('product', '')).replace('KIT', '').strip().upper()
+    if product_name not in PRICES:
+        return jsonify({"error": "Invalid product selected"}), 400
+    try:
+        stock = int(data['stock'])
+        price = int(data.get('price', PRICES[product_name]))
+        starts_at = float(data.get('starts_at', time.time()))
+        ends_at = float(data['ends_at']) if 'ends_at' in data else starts_at + float(data['duration'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "stock and ends_at (or duration) are required numbers"}), 400
+    if stock < 0 or price <= 0 or ends_at <= starts_at:
+        return jsonify({"error": "Invalid stock, price or time window"}), 400
+
+    flash_inventory.configure(product_name, stock, price, starts_at, ends_at)
+    return jsonify({"product": product_name, **flash_inventory.snapshot()[product_name]})
+
+@app.route('/reconciliation/run', methods=['POST'])
+def run_reconciliation():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    if not reconciler.providers:
+        return jsonify({"error": "No payment provider can list charges"}), 400
+    if not reconciler.start():
+        return jsonify({"error": "Reconciliation already running"}), 409
+    return jsonify({"started": True}), 202
+
+@app.route('/reconciliation', methods=['GET'])
+def reconciliation_status():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return jsonify(reconciler.status())
+
+@app.route('/reconciliation/mismatches', methods=['GET'])
+def reconciliation_mismatches():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    args = request.args
+    provider = args.get('provider') or (reconciler.providers[0].name if reconciler.providers else None)
+    try:
+        limit = int(args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "limit must be a number"}), 400
+    mismatches = reconciler.mismatches(provider, type=args.get('type'), after=args.get('after'), limit=limit)
+    return jsonify({"provider": provider, "mismatches": mismatches})
+
+@app.route('/reports/sales', methods=['GET'])
+def get_sales_report():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    args = request.args
+    granularity = args.get('granularity', 'hour')
+    if granularity not in ('hour', 'day'):
+        return jsonify({"error": "granularity must be 'hour' or 'day'"}), 400
+    try:
+        end = float(args.get('to', time.time()))
+        start = float(args.get('from', end - 86400))
+        report = sales_aggregator.report(start, end, granularity)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = jsonify(report)
+    response.headers['Cache-Control'] = 'private, max-age=30'
+    return response
+
+@app.route('/debug/profiles', methods=['GET'])
+def profile_summary():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    try:
+        profiles = int(request.args.get('profiles', 10))
+        limit = int(request.args.get('limit', 25))
+    except ValueError:
+        return jsonify({"error": "'profiles' and 'limit' must be integers"}), 400
+    return jsonify(request_profiler.summary(profiles=profiles, limit=limit))
+
+@app.route('/debug/memory/snapshot', methods=['POST'])
+def memory_snapshot():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return jsonify(memory_tracker.snapshot())
+
+@app.route('/debug/memory/diff', methods=['GET'])
+def memory_diff():
+    denied = check_admin_token()
+    if denied:
+        return denied
+
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+
+    diff = memory_tracker.diff(limit=limit)
+    if diff is None:
+        return jsonify({"error": "No baseline: POST /debug/memory/snapshot first"}), 409
+    return jsonify(diff)
+
+@app.route('/debug/memory/stop', methods=['POST'])
+def memory_stop():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    memory_tracker.stop()
+    return jsonify({"tracing": False})
+
+@app.route('/debug/compression', methods=['GET'])
+def compression_stats():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return jsonify(response_compressor.stats())
+
+@app.route('/debug/gateways', methods=['GET'])
+def gateway_stats():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    return jsonify(payment_router.stats())
+
 @app.route('/create-payment', methods=['POST'])
 def create_payment():
     req_id = int(time.time() * 1000)
     logger.info(f"[{req_id}] Received payment creation request")
-    
+
     try:
         data = request.json
         if not data:
@@ -132,84 +578,37 @@ def create_payment():
 
         product_name = product_raw.replace('KIT', '').strip().upper()
         amount = PRICES.get(product_name)
+
+        # A hosted billing has no expiry, so it could still be paid after its unit was resold
+        if flash_inventory.active_sale(product_name) is not None:
+            logger.info(f"[{req_id}] Refusing billing for {product_name}: flash sale is PIX only")
+            return jsonify({"error": "Esta promoção aceita apenas pagamento via PIX.", "product": product_name}), 409
         
         cellphone_clean = sanitize_phone(cellphone)
         cpf_clean = "".join(filter(str.isdigit, str(cpf)))
 
         logger.info(f"[{req_id}] Processing payment for {nickname} - {product_name} ({amount} cents)")
 
-        # 2. Prepare Payload
-        payload = {
-            "frequency": "ONE_TIME",
-            "methods": ["PIX"], # API only accepts PIX for now, others cause 422 error
-            "products": [
-                {
-                    "externalId": product_name,
-                    "name": f"VIP {product_name}",
-                    "quantity": 1,
-                    "price": amount,
-                    "description": f"VIP {product_name} para o jogador {nickname}"
-                }
-            ],
-            "returnUrl": "http://localhost:5500/success",
-            "completionUrl": "http://localhost:5500/success",
-            "customer": {
-                "name": nickname, 
-                "email": email,
-                "taxId": cpf_clean,
-                "cellphone": cellphone_clean
-            }
-        }
-
-        # 3. Send Request with Retries & Timeout
-        session = get_requests_session()
-        headers = {
-            "Authorization": f"Bearer {ABACATE_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        logger.debug(f"[{req_id}] Sending payload to Abacate Pay: {json.dumps(payload, indent=2)}")
-
-        response = session.post(
-            ABACATE_API_URL, 
-            json=payload, 
-            headers=headers, 
-            timeout=API_TIMEOUT
+        # 2. Create the charge on the best available provider (static payload parts come from the template)
+        charge = payment_router.create_billing(
+            PRODUCT_TEMPLATES[product_name], nickname,
+            customer_fields(nickname, email, cpf_clean, cellphone_clean)
         )
-        
-        # 4. Handle Response
-        try:
-            result = response.json()
-        except json.JSONDecodeError:
-            logger.error(f"[{req_id}] Failed to decode JSON response: {response.text}")
-            return jsonify({"error": "Invalid response from Payment Gateway", "details": response.text}), 502
-
-        if response.status_code != 200:
-            error_details = result.get('error') or result
-            logger.error(f"[{req_id}] Abacate Pay API Error ({response.status_code}): {json.dumps(error_details)}")
-            return jsonify({"error": "Payment Gateway Error", "details": error_details}), response.status_code
 
         # Log Success
-        logger.info(f"[{req_id}] Payment created successfully. Bill ID: {result.get('data', {}).get('id')}")
+        logger.info(f"[{req_id}] Payment created successfully on {charge.provider}. Bill ID: {charge.charge_id}")
         
         # Save last success for debugging
         with open('last_response.json', 'w') as f:
-            json.dump(result, f, indent=2)
+            json.dump(charge.raw, f, indent=2)
 
-        data_obj = result.get("data")
-        if not data_obj or not data_obj.get("url"):
-            logger.error(f"[{req_id}] No payment URL in successful response: {json.dumps(result)}")
-            return jsonify({"error": "No payment URL returned"}), 500
+        order_ledger.record_order(charge.charge_id, "billing", nickname, product_name, amount, cpf_clean, email)
+        sales_aggregator.order_created(product_name, "billing")
 
-        return jsonify({"url": data_obj.get("url")})
+        return jsonify({"url": charge.url})
 
-    except requests.exceptions.Timeout:
-        logger.error(f"[{req_id}] Request to Payment Gateway timed out after {API_TIMEOUT}s")
-        return jsonify({"error": "Payment Gateway Timeout", "message": "The payment service is taking too long to respond. Please try again."}), 504
-    
-    except requests.exceptions.ConnectionError:
-        logger.error(f"[{req_id}] Connection error to Payment Gateway")
-        return jsonify({"error": "Connection Error", "message": "Could not connect to payment service. Please check your internet connection."}), 503
+    except GatewayError as e:
+        return gateway_error_response(req_id, e)
         
     except Exception as e:
         logger.exception(f"[{req_id}] Unexpected server error: {str(e)}")
@@ -219,7 +618,8 @@ def create_payment():
 def create_pix_payment():
     req_id = int(time.time() * 1000)
     logger.info(f"[{req_id}] Received PIX creation request")
-    
+    reservation = None  # flash-sale unit held for this checkout, released unless the order is created
+
     try:
         data = request.json
         if not data:
@@ -237,73 +637,48 @@ def create_pix_payment():
         
         product_name = product_raw.replace('KIT', '').strip().upper()
         amount = PRICES.get(product_name)
+
+        sale = flash_inventory.active_sale(product_name)
+        expires_in = None
+        if sale is not None:
+            reservation = flash_inventory.reserve(sale)
+            if reservation is None:
+                return sold_out_response(product_name)
+            amount = sale.price
+            expires_in = flash_inventory.reservation_ttl  # an unpaid QR code dies with its reservation
         
         cellphone_clean = sanitize_phone(cellphone)
         cpf_clean = "".join(filter(str.isdigit, str(cpf)))
 
-        payload = {
-            "amount": amount,
-            "description": f"VIP {product_name} - {nickname}",
-            "customer": {
-                "name": nickname,
-                "email": email,
-                "taxId": cpf_clean,
-                "cellphone": cellphone_clean
-            }
-        }
-
-        session = get_requests_session()
-        headers = {
-            "Authorization": f"Bearer {ABACATE_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
-
-        response = session.post(
-            ABACATE_PIX_URL, 
-            json=payload, 
-            headers=headers,
-            timeout=API_TIMEOUT
+        charge = payment_router.create_pix(
+            flash_sale_template(product_name, sale), nickname,
+            customer_fields(nickname, email, cpf_clean, cellphone_clean), expires_in
         )
-        
-        if response.status_code != 200:
-            logger.error(f"[{req_id}] Abacate Pay PIX Error: {response.text}")
-            return jsonify({"error": "Payment Gateway Error", "details": response.json()}), response.status_code
 
-        result = response.json()
-        logger.info(f"[{req_id}] Abacate Pay Response: {json.dumps(result)}")
-        
-        if result.get('success') is False:
-             raw_error = result.get('error', 'Unknown error from payment provider')
-             
-             # Translate common errors
-             error_msg = raw_error
-             if "taxId" in raw_error:
-                 error_msg = "CPF inválido. Verifique se o número está correto."
-             elif "email" in raw_error:
-                 error_msg = "E-mail inválido."
-             elif "cellphone" in raw_error:
-                 error_msg = "Número de celular inválido."
-                 
-             logger.error(f"[{req_id}] Abacate Pay returned failure: {raw_error} -> {error_msg}")
-             return jsonify({"error": error_msg}), 400
-
-        data_obj = result.get('data')
-        if not data_obj:
-            logger.error(f"[{req_id}] No data object in response")
-            return jsonify({"error": "Invalid response from payment provider"}), 502
-
-        logger.info(f"[{req_id}] PIX generated successfully")
+        logger.info(f"[{req_id}] PIX generated successfully on {charge.provider}: {charge.charge_id}")
+        order_ledger.record_order(charge.charge_id, "pix", nickname, product_name, amount, cpf_clean, email)
+        sales_aggregator.order_created(product_name, "pix")
+        if reservation is not None and charge.charge_id:
+            hold_flash_reservation(req_id, reservation, charge.charge_id)
+            reservation = None
         
         return jsonify({
-            "brCode": data_obj.get('brCode'),
-            "brCodeBase64": data_obj.get('brCodeBase64'),
-            "pixId": data_obj.get('id')
+            "brCode": charge.br_code,
+            "brCodeBase64": charge.br_code_base64,
+            "pixId": charge.charge_id
         })
 
+    except GatewayError as e:
+        return gateway_error_response(req_id, e)
+
     except Exception as e:
         logger.exception(f"[{req_id}] Unexpected error in PIX generation: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        if reservation is not None:
+            flash_inventory.release(reservation)
+
 if __name__ == '__main__':
     logger.info("Starting Payment Server on port 5000...")
     app.run(port=5000, debug=True)
@@ -0,0 +1,138 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from avatar_proxy import AvatarProxy, AvatarEntry, MemoryLRU, DiskCache
+
+SKIN_BYTES = b"\x89PNG\r\n\x1a\nfake-skin"
+
+
+class StandInSkinServer:
+    """
+    Local stand-in for mc-heads.net: serves a fixed PNG with an ETag,
+    answers 304 to matching If-None-Match and can be made slow.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.conditional_requests = 0
+        self.delay = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if self.headers.get("If-None-Match") == '"v1"':
+                    server.conditional_requests += 1
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(SKIN_BYTES)))
+                self.end_headers()
+                self.wfile.write(SKIN_BYTES)
+
+            def log_message(self, *args):
+                pass
+
+        class QuietServer(ThreadingHTTPServer):
+            def handle_error(self, request, client_address):
+                pass  # clients that time out on purpose close the socket mid-response
+
+        self.httpd = QuietServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/body/{{nickname}}/right"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestAvatarProxy(unittest.TestCase):
+    def setUp(self):
+        self.upstream = StandInSkinServer()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.upstream.close()
+        self.tmpdir.cleanup()
+
+    def make_proxy(self, **kwargs):
+        kwargs.setdefault("ttl", 3600)
+        kwargs.setdefault("timeout", 2)
+        return AvatarProxy(upstream_url=self.upstream.url, cache_dir=self.tmpdir.name, **kwargs)
+
+    def test_memory_cache_serves_repeats(self):
+        proxy = self.make_proxy()
+        for _ in range(20):
+            entry, is_fallback = proxy.get("Notch")
+            self.assertEqual(entry.body, SKIN_BYTES)
+            self.assertFalse(is_fallback)
+        self.assertEqual(self.upstream.requests, 1)
+
+    def test_disk_cache_survives_restart(self):
+        self.make_proxy().get("Notch")
+        entry, _ = self.make_proxy().get("Notch")
+        self.assertEqual(entry.body, SKIN_BYTES)
+        self.assertEqual(self.upstream.requests, 1)
+
+    def test_concurrent_misses_are_coalesced(self):
+        self.upstream.delay = 0.3
+        proxy = self.make_proxy()
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(lambda _: proxy.get("Notch"), range(20)))
+        self.assertTrue(all(entry.body == SKIN_BYTES for entry, _ in results))
+        self.assertEqual(self.upstream.requests, 1)
+
+    def test_stale_entry_revalidated_with_etag(self):
+        proxy = self.make_proxy(ttl=0)
+        proxy.get("Notch")
+        entry, _ = proxy.get("Notch")
+        self.assertEqual(entry.body, SKIN_BYTES)
+        self.assertEqual(self.upstream.conditional_requests, 1)
+
+    def test_slow_upstream_falls_back_to_steve(self):
+        self.upstream.delay = 0.5
+        proxy = self.make_proxy(timeout=0.1)
+        entry, is_fallback = proxy.get("Notch")
+        self.assertTrue(is_fallback)
+        self.assertTrue(entry.body.startswith(b"\x89PNG"))
+        self.assertNotEqual(entry.body, SKIN_BYTES)
+
+
+class TestMemoryLRU(unittest.TestCase):
+    def test_bounded_by_bytes(self):
+        lru = MemoryLRU(max_bytes=10)
+        lru.put("a", AvatarEntry(b"12345"))
+        lru.put("b", AvatarEntry(b"12345"))
+        lru.put("c", AvatarEntry(b"12345"))
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.current_bytes, 10)
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_bounded_by_bytes_across_restarts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            disk = DiskCache(tmpdir, max_bytes=10)
+            disk.put("a", AvatarEntry(b"12345"))
+            disk.put("b", AvatarEntry(b"12345"))
+            disk.get("a")  # "b" is now least recently used
+            disk.put("c", AvatarEntry(b"12345"))
+
+            self.assertIsNone(disk.get("b"))
+            self.assertEqual(disk.get("a").body, b"12345")
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["a.img", "a.json", "c.img", "c.json"])
+
+            reopened = DiskCache(tmpdir, max_bytes=5)
+            self.assertEqual((len(reopened), reopened.current_bytes), (1, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
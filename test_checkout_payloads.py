@@ -0,0 +1,67 @@
+import json
+import unittest
+import importlib
+from unittest.mock import patch
+
+import json_codec
+from checkout_payloads import build_product_templates, customer_fields
+
+PRICES = {"LORD": 4990, "GUARDIAN": 9990}
+CUSTOMER = customer_fields("TestUser", "test@example.com", "12345678901", "5511999999999")
+
+
+class TestProductTemplates(unittest.TestCase):
+    def setUp(self):
+        self.templates = build_product_templates(PRICES, "http://shop/success", "http://shop/done")
+
+    def test_billing_payload(self):
+        payload = self.templates["GUARDIAN"].billing_payload("TestUser", CUSTOMER)
+        self.assertEqual(json.loads(json_codec.dumps(payload)), {
+            "frequency": "ONE_TIME",
+            "methods": ["PIX"],
+            "returnUrl": "http://shop/success",
+            "completionUrl": "http://shop/done",
+            "products": [{
+                "externalId": "GUARDIAN",
+                "name": "VIP GUARDIAN",
+                "quantity": 1,
+                "price": 9990,
+                "description": "VIP GUARDIAN para o jogador TestUser",
+            }],
+            "customer": CUSTOMER,
+        })
+
+    def test_pix_payload(self):
+        payload = self.templates["LORD"].pix_payload("TestUser", CUSTOMER)
+        self.assertEqual(payload, {"amount": 4990, "description": "VIP LORD - TestUser", "customer": CUSTOMER})
+
+    def test_pix_payload_with_expiry(self):
+        payload = self.templates["LORD"].pix_payload("TestUser", CUSTOMER, expires_in=900)
+        self.assertEqual(payload["expiresIn"], 900)
+
+    def test_templates_are_not_mutated_by_requests(self):
+        first = self.templates["LORD"].billing_payload("Alice", CUSTOMER)
+        first["products"][0]["price"] = 1
+        first["returnUrl"] = "http://evil"
+        second = self.templates["LORD"].billing_payload("Bob", CUSTOMER)
+        self.assertEqual(second["products"][0]["price"], 4990)
+        self.assertEqual(second["returnUrl"], "http://shop/success")
+        with self.assertRaises(TypeError):
+            self.templates["NEW"] = None
+
+
+class TestJsonCodec(unittest.TestCase):
+    def test_backends_round_trip(self):
+        data = {"nickname": "Jogador_ç", "amount": 4990, "nested": [1, None, True]}
+        for backend in ("auto", "stdlib"):
+            with patch.dict('os.environ', {"JSON_BACKEND": backend}):
+                codec = importlib.reload(json_codec)
+                encoded = codec.dumps(data)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(codec.loads(encoded), data)
+                self.assertEqual(json.loads(encoded), data)
+        importlib.reload(json_codec)
+
+
+if __name__ == '__main__':
+    unittest.main()
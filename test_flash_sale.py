@@ -0,0 +1,176 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from order_ledger import OrderLedger
+from flash_sale import FlashSaleInventory, CONFIRMED, NO_RESERVATION, OVERSOLD
+
+
+class TestFlashSaleInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "orders.db")
+        self.ledger = OrderLedger(self.path, flush_interval=0.01)
+        self.inventory = FlashSaleInventory(self.ledger, shard_count=8, reservation_ttl=60)
+        now = time.time()
+        self.sale = self.inventory.configure("GUARDIAN", 10, 4990, now - 1, now + 3600)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def statuses(self):
+        self.ledger.flush()
+        conn = sqlite3.connect(self.path)
+        try:
+            return dict(conn.execute(
+                "SELECT status, COUNT(*) FROM flash_reservations GROUP BY status"
+            ).fetchall())
+        finally:
+            conn.close()
+
+    def test_concurrent_reservations_never_oversell(self):
+        reservations = []
+        lock = threading.Lock()
+        start = threading.Barrier(50)
+
+        def buyer():
+            start.wait()
+            for _ in range(20):
+                reservation = self.inventory.reserve(self.sale)
+                if reservation is not None:
+                    with lock:
+                        reservations.append(reservation)
+
+        threads = [threading.Thread(target=buyer) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(reservations), 10)
+        self.assertEqual(len({r.id for r in reservations}), 10)
+        self.assertEqual(self.sale.available(), 0)
+        self.assertTrue(all(r.wait_durable() for r in reservations))
+        self.assertEqual(self.statuses(), {"reserved": 10})
+
+    def test_release_returns_stock(self):
+        reservation = self.inventory.reserve(self.sale)
+        self.assertEqual(self.sale.available(), 9)
+
+        self.assertTrue(self.inventory.release(reservation))
+        self.assertFalse(self.inventory.release(reservation))
+        self.assertEqual(self.sale.available(), 10)
+        self.assertEqual(self.statuses(), {"released": 1})
+
+    def test_confirm_turns_reservation_into_sale(self):
+        reservation = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(reservation, "pix_1")
+
+        self.assertEqual(self.inventory.confirm("pix_1"), CONFIRMED)
+        self.assertEqual(self.inventory.confirm("pix_1"), CONFIRMED)  # repeated webhook
+        self.assertEqual(self.inventory.confirm("pix_other"), NO_RESERVATION)
+        self.assertEqual(self.sale.sold(), 1)
+        self.assertEqual(self.sale.available(), 9)
+        self.assertEqual(self.statuses(), {"confirmed": 1})
+
+    def test_reservations_spread_over_shards(self):
+        for _ in range(8):
+            self.inventory.reserve(self.sale)
+        self.assertEqual([len(shard.reservations) for shard in self.sale.shards], [1] * 8)
+
+    def test_expired_reservations_are_reclaimed_by_the_sweep(self):
+        held = [self.inventory.reserve(self.sale) for _ in range(10)]
+        held[0].expires_at = time.time() - 1  # unpaid PIX past its expiry
+        self.assertIsNone(self.inventory.reserve(self.sale))  # sold-out attempts don't scan for expired holds
+
+        self.assertEqual(self.inventory.expire(self.sale), 1)
+        self.assertIsNotNone(self.inventory.reserve(self.sale))
+        self.assertIsNone(self.inventory.reserve(self.sale))
+
+    def test_hold_outlives_the_pix_it_pays_for(self):
+        reservation = self.inventory.reserve(self.sale)
+        before = time.time()
+        self.inventory.attach_order(reservation, "pix_1")
+        self.assertGreaterEqual(reservation.expires_at,
+                                before + self.inventory.reservation_ttl + self.inventory.payment_grace)
+
+    def test_late_payment_takes_a_free_unit_or_is_reported_oversold(self):
+        late = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(late, "pix_late")
+        late.expires_at = time.time() - 1
+        self.inventory.expire(self.sale)
+        self.ledger.flush()
+
+        self.assertEqual(self.inventory.confirm("pix_late"), CONFIRMED)
+        self.assertEqual(self.inventory.confirm("pix_late"), CONFIRMED)
+        self.assertEqual((self.sale.sold(), self.sale.available()), (1, 9))
+
+        unlucky = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(unlucky, "pix_unlucky")
+        unlucky.expires_at = time.time() - 1
+        self.inventory.expire(self.sale)
+        while self.inventory.reserve(self.sale) is not None:
+            pass  # resold to other buyers
+        self.ledger.flush()
+
+        self.assertEqual(self.inventory.confirm("pix_unlucky"), OVERSOLD)
+        self.assertEqual(self.sale.sold(), 1)
+
+    def test_state_survives_restart(self):
+        paid = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(paid, "pix_paid")
+        self.inventory.confirm("pix_paid")
+        pending = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(pending, "pix_pending")
+        self.inventory.release(self.inventory.reserve(self.sale))
+        self.ledger.flush()
+
+        restarted = FlashSaleInventory(self.ledger, shard_count=4, reservation_ttl=60)
+        sale = restarted.active_sale("GUARDIAN")
+        self.assertEqual(sale.sold(), 1)
+        self.assertEqual(sale.reserved(), 1)
+        self.assertEqual(sale.available(), 8)
+        self.assertEqual(restarted.confirm("pix_pending"), CONFIRMED)
+        self.assertEqual(restarted.confirm("pix_paid"), CONFIRMED)
+        self.assertEqual(sale.sold(), 2)
+
+    def test_reconfigure_keeps_sold_and_reserved_units(self):
+        reservation = self.inventory.reserve(self.sale)
+        self.inventory.attach_order(reservation, "pix_1")
+        self.inventory.reserve(self.sale)
+
+        sale = self.inventory.configure("GUARDIAN", 5, 3990, self.sale.starts_at, self.sale.ends_at)
+        self.assertEqual(sale.available(), 3)
+        self.assertEqual(self.sale.available(), 0)  # the replaced sale hands out nothing
+        self.assertEqual(sale.sale_id, self.sale.sale_id)
+        self.assertEqual(self.inventory.confirm("pix_1"), CONFIRMED)
+
+    def test_next_drop_starts_with_fresh_stock(self):
+        for index in range(10):
+            self.inventory.attach_order(self.inventory.reserve(self.sale), f"pix_{index}")
+            self.inventory.confirm(f"pix_{index}")
+        self.assertIsNone(self.inventory.reserve(self.sale))
+
+        now = time.time()
+        ended = self.inventory.configure("GUARDIAN", 10, 4990, now - 60, now - 1, now=now - 1)
+        drop = self.inventory.configure("GUARDIAN", 100, 3990, now, now + 3600)
+        self.assertNotEqual(drop.sale_id, ended.sale_id)
+        self.assertEqual(drop.available(), 100)
+
+        self.ledger.flush()
+        restarted = FlashSaleInventory(self.ledger, shard_count=4)
+        self.assertEqual(restarted.active_sale("GUARDIAN").available(), 100)
+
+    def test_inactive_sale(self):
+        now = time.time()
+        self.inventory.configure("LORD", 5, 2990, now + 60, now + 120)
+        self.assertIsNone(self.inventory.active_sale("LORD"))
+        self.assertIsNone(self.inventory.active_sale("CHAMPION"))
+        self.assertFalse(self.inventory.snapshot()["LORD"]["active"])
+
+
+if __name__ == '__main__':
+    unittest.main()
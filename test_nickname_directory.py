@@ -0,0 +1,135 @@
+import os
+import json
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from nickname_directory import (
+    BloomFilter, TTLCache, NicknameService, FilePlayerDirectory,
+    SQLitePlayerDirectory, load_player_directory
+)
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set("a", True, 60)
+        cache.set("b", True, 60)
+        cache.get("a")  # "a" is now most recently used
+        cache.set("c", True, 60)
+
+        self.assertTrue(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertTrue(cache.get("c"))
+
+    def test_expiry(self):
+        cache = TTLCache(maxsize=10)
+        with patch('nickname_directory.time.monotonic', return_value=100.0):
+            cache.set("a", False, 5)
+        with patch('nickname_directory.time.monotonic', return_value=104.0):
+            self.assertIs(cache.get("a"), False)
+        with patch('nickname_directory.time.monotonic', return_value=106.0):
+            self.assertIsNone(cache.get("a"))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        names = [f"player_{i}" for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"player_{i}")
+        false_positives = sum(f"unknown_{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class CountingDirectory(FilePlayerDirectory):
+    def __init__(self, path):
+        super().__init__(path)
+        self.lookups = 0
+
+    def lookup_many(self, nicknames):
+        self.lookups += 1
+        return super().lookup_many(nicknames)
+
+
+class TestNicknameService(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "players.txt")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("Notch\njeb_\nTestUser\n")
+        self.directory = CountingDirectory(self.path)
+        self.service = NicknameService(self.directory)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_exists_is_case_insensitive(self):
+        self.assertTrue(self.service.exists("notch"))
+        self.assertTrue(self.service.exists("TESTUSER"))
+
+    def test_repeated_lookups_hit_cache(self):
+        for _ in range(50):
+            self.assertTrue(self.service.exists("Notch"))
+        self.assertEqual(self.directory.lookups, 1)
+        self.assertEqual(self.service.stats["cache_hits"], 49)
+
+    def test_unknown_names_never_reach_backend(self):
+        self.assertFalse(self.service.exists("Herobrine"))
+        self.assertFalse(self.service.exists("Herobrine"))
+        # The Bloom filter (or the negative cache) answers; the backend is never queried
+        self.assertEqual(self.directory.lookups, 0)
+
+    def test_batch_lookup_uses_single_backend_query(self):
+        results = self.service.exists_many(["Notch", "jeb_", "Herobrine", "notch"])
+        self.assertEqual(results, {"notch": True, "jeb_": True, "herobrine": False})
+        self.assertEqual(self.directory.lookups, 1)
+
+    def test_new_player_is_found_before_bloom_refresh(self):
+        self.assertFalse(self.service.exists("Herobrine"))
+
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("Herobrine\n")
+        mtime = os.path.getmtime(self.path) + 1
+        os.utime(self.path, (mtime, mtime))
+
+        # The stale filter is bypassed while it is rebuilt in the background
+        self.assertTrue(self.service.exists("Herobrine"))
+        self.assertEqual(self.directory.lookups, 1)
+
+    def test_usercache_json(self):
+        path = os.path.join(self.tmpdir.name, "usercache.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([{"name": "Alex", "uuid": "x"}], f)
+        service = NicknameService(load_player_directory(f"file:{path}"))
+        self.assertTrue(service.exists("alex"))
+        self.assertFalse(service.exists("Steve"))
+
+
+class TestSQLitePlayerDirectory(unittest.TestCase):
+    def test_lookup(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "players.db")
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE players (nickname TEXT)")
+            conn.executemany("INSERT INTO players VALUES (?)", [("Notch",), ("jeb_",)])
+            conn.commit()
+            conn.close()
+
+            directory = load_player_directory(f"sqlite:{path}")
+            self.assertIsInstance(directory, SQLitePlayerDirectory)
+            self.assertEqual(directory.lookup_many(["notch", "steve"]), {"notch"})
+
+            service = NicknameService(directory)
+            self.assertEqual(service.exists_many(["Notch", "Steve"]), {"notch": True, "steve": False})
+
+
+if __name__ == '__main__':
+    unittest.main()
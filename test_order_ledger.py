@@ -0,0 +1,88 @@
+import os
+import time
+import sqlite3
+import tempfile
+import unittest
+
+from order_ledger import OrderLedger
+
+
+class TestOrderLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "orders.db")
+        self.ledger = OrderLedger(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_record_and_get(self):
+        self.ledger.record_order("pix_1", "pix", "TestUser", "GUARDIAN", 9990, "123.456.789-01", "a@b.com")
+        self.assertTrue(self.ledger.flush())
+
+        order = self.ledger.get("pix_1")
+        self.assertEqual(order["nickname"], "TestUser")
+        self.assertEqual(order["product"], "GUARDIAN")
+        self.assertEqual(order["status"], "created")
+
+    def test_cpf_is_stored_hashed(self):
+        self.ledger.record_order("pix_1", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.flush()
+
+        row = sqlite3.connect(self.path).execute("SELECT cpf_hash FROM orders").fetchone()
+        self.assertEqual(row[0], self.ledger.hash_cpf("123.456.789-01"))
+        self.assertNotIn("12345678901", row[0])
+
+    def test_cpf_key_is_generated_once_and_kept(self):
+        self.assertEqual(len(self.ledger.cpf_salt), 64)
+        self.assertEqual(os.stat(self.path + ".key").st_mode & 0o777, 0o600)
+        self.assertEqual(OrderLedger(self.path).cpf_salt, self.ledger.cpf_salt)
+
+    def test_failed_statement_only_drops_itself(self):
+        self.ledger.record_order("pix_a", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.enqueue_write("UPDATE no_such_table SET x = 1")
+        self.ledger.record_order("pix_b", "pix", "TestUser", "LORD", 4990, "12345678901")
+
+        self.assertFalse(self.ledger.flush())
+        self.assertEqual({o["order_id"] for o in self.ledger.find()}, {"pix_a", "pix_b"})
+        self.assertTrue(self.ledger.flush())  # the failure is only reported once
+
+    def test_negative_limit_is_clamped(self):
+        for i in range(3):
+            self.ledger.record_order(f"pix_{i}", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.flush()
+        self.assertEqual(len(self.ledger.find(limit=-1)), 1)
+
+    def test_find_by_nickname_cpf_and_product(self):
+        self.ledger.record_order("pix_1", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.record_order("pix_2", "pix", "testuser", "GUARDIAN", 9990, "12345678901")
+        self.ledger.record_order("pix_3", "pix", "Other", "GUARDIAN", 9990, "98765432100")
+        self.ledger.update_status("pix_2", "paid")
+        self.ledger.flush()
+
+        self.assertEqual({o["order_id"] for o in self.ledger.find(nickname="TESTUSER")}, {"pix_1", "pix_2"})
+        self.assertEqual([o["order_id"] for o in self.ledger.find(cpf="98765432100")], ["pix_3"])
+        paid = self.ledger.find(nickname="TestUser", product="GUARDIAN", status="paid")
+        self.assertEqual([o["order_id"] for o in paid], ["pix_2"])
+
+    def test_queries_use_indexes(self):
+        conn = sqlite3.connect(self.path)
+        for where in ("nickname_lower = 'x'", "cpf_hash = 'x'", "created_at > 0"):
+            plan = " ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN SELECT * FROM orders WHERE {where}"))
+            self.assertIn("INDEX", plan)
+
+    def test_retention_drops_old_and_excess_rows(self):
+        ledger = OrderLedger(os.path.join(self.tmpdir.name, "small.db"), retention_days=1, max_rows=2)
+        for i in range(4):
+            ledger.record_order(f"pix_{i}", "pix", "TestUser", "LORD", 4990, "12345678901")
+        ledger.flush()
+        with sqlite3.connect(ledger.path) as conn:
+            conn.execute("UPDATE orders SET created_at = ? WHERE order_id = 'pix_0'", (time.time() - 2 * 86400,))
+
+        ledger.apply_retention()
+        self.assertIsNone(ledger.get("pix_0"))
+        self.assertEqual(len(ledger.find()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from checkout_payloads import ProductTemplate
+from payment_gateways import (
+    AbacateProvider, LocalProvider, GatewayRouter, GatewayTimeout, GatewayUnavailable, GatewayRejected,
+    GatewayResponseError, GatewayServerError, create_gateway_router
+)
+
+TEMPLATE = ProductTemplate("LORD", 4990, "http://shop/success", "http://shop/success")
+CUSTOMER = {"name": "TestUser", "email": "a@b.com", "taxId": "12345678901", "cellphone": "5511999999999"}
+
+
+class TestGatewayRouter(unittest.TestCase):
+    def test_prefers_faster_provider_once_measured(self):
+        slow = LocalProvider("slow", latency=0.03)
+        fast = LocalProvider("fast")
+        router = GatewayRouter([slow, fast])
+
+        first = router.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+        self.assertEqual(first.provider, "slow")  # configured order until there are stats
+        router._record(fast, 0.001, True)
+
+        self.assertEqual(router.create_pix(TEMPLATE, "TestUser", CUSTOMER).provider, "fast")
+        self.assertEqual(router.stats()["order"], ["fast", "slow"])
+
+    def test_pix_fails_over_on_timeout(self):
+        primary = LocalProvider("primary", failure="timeout")
+        backup = LocalProvider("backup")
+        router = GatewayRouter([primary, backup])
+
+        charge = router.create_pix(TEMPLATE, "TestUser", CUSTOMER, expires_in=900)
+
+        self.assertEqual(charge.provider, "backup")
+        self.assertIn(charge.charge_id, backup.charges)
+        decision = router.stats()["decisions"][0]
+        self.assertEqual(decision["provider"], "backup")
+        self.assertEqual([a["outcome"] for a in decision["attempts"]], ["GatewayTimeout", "ok"])
+
+    def test_billing_does_not_fail_over_on_timeout(self):
+        backup = LocalProvider("backup")
+        router = GatewayRouter([LocalProvider("primary", failure="timeout"), backup])
+
+        with self.assertRaises(GatewayTimeout):
+            router.create_billing(TEMPLATE, "TestUser", CUSTOMER)
+        self.assertEqual(backup.charges, {})
+
+    def test_unreachable_provider_always_fails_over(self):
+        router = GatewayRouter([LocalProvider("primary", failure="unavailable"), LocalProvider("backup")])
+        self.assertEqual(router.create_billing(TEMPLATE, "TestUser", CUSTOMER).provider, "backup")
+
+    def test_rejection_is_not_failed_over(self):
+        backup = LocalProvider("backup")
+        router = GatewayRouter([LocalProvider("primary", failure="reject"), backup])
+
+        with self.assertRaises(GatewayRejected):
+            router.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+        self.assertEqual(backup.charges, {})
+        self.assertEqual(router.stats()["providers"]["primary"]["failures"], 0)
+
+    def test_failing_provider_cools_down(self):
+        primary = LocalProvider("primary", failure="unavailable")
+        backup = LocalProvider("backup", latency=0.01)
+        router = GatewayRouter([primary, backup], failure_threshold=1, cooldown=60)
+        router.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+
+        # Healthy again and faster than the backup, but still cooling down
+        primary.failure = None
+        router._record(primary, 0.001, True)
+        router._stats["primary"].consecutive_failures = 0
+        self.assertEqual(router.create_pix(TEMPLATE, "TestUser", CUSTOMER).provider, "backup")
+        self.assertGreater(router.stats()["providers"]["primary"]["cooldown_seconds"], 0)
+
+    def test_all_providers_failing_raises_last_error(self):
+        router = GatewayRouter([LocalProvider("a", failure="unavailable"), LocalProvider("b", failure="timeout")])
+        with self.assertRaises(GatewayTimeout):
+            router.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+        self.assertIsNone(router.stats()["decisions"][0]["provider"])
+
+    def test_unknown_provider_name(self):
+        with self.assertRaises(ValueError):
+            create_gateway_router("token", "http://b", "http://p", 5, names="abacate,paypal")
+
+
+class TestAbacateProvider(unittest.TestCase):
+    def setUp(self):
+        self.provider = AbacateProvider("token", "http://gateway/billing", "http://gateway/pix", timeout=5)
+
+    def respond(self, mock_post, status_code, body):
+        mock_response = MagicMock()
+        mock_response.status_code = status_code
+        mock_response.json.return_value = body
+        mock_post.return_value = mock_response
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_pix_success(self, mock_post):
+        self.respond(mock_post, 200, {"data": {"id": "pix_1", "brCode": "0002", "brCodeBase64": "iVBOR"}})
+
+        charge = self.provider.create_pix(TEMPLATE, "TestUser", CUSTOMER, expires_in=900)
+
+        self.assertEqual((charge.provider, charge.charge_id, charge.br_code), ("abacate", "pix_1", "0002"))
+        self.assertEqual(mock_post.call_args.args[0], "http://gateway/pix")
+        self.assertEqual(mock_post.call_args.kwargs['timeout'][1], 5)
+
+    def respond_get(self, mock_get, status_code, body):
+        mock_response = MagicMock()
+        mock_response.status_code = status_code
+        mock_response.iter_content.return_value = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+        mock_get.return_value = mock_response
+
+    @patch('payment_gateways.requests.Session.get')
+    def test_pix_status_check(self, mock_get):
+        provider = AbacateProvider("token", "http://gateway/billing", "http://gateway/pix", timeout=5,
+                                   pix_check_url="http://gateway/pix/check")
+        self.assertEqual(provider.checked_kinds, ("pix",))
+
+        self.respond_get(mock_get, 200, b'{"data": {"status": "PAID", "expiresAt": "2026-01-01T00:00:00Z"}}')
+        charge = provider.check_charge("pix_char_1")
+        self.assertEqual((charge.charge_id, charge.status, charge.amount), ("pix_char_1", "paid", None))
+        self.assertEqual(mock_get.call_args.kwargs['params'], {"id": "pix_char_1"})
+
+        self.respond_get(mock_get, 404, b'{"error": "Not found"}')
+        self.assertIsNone(provider.check_charge("pix_char_2"))
+
+    @patch('payment_gateways.requests.Session.get')
+    @patch('payment_gateways.GATEWAY_READ_MAX_BYTES', 4096)
+    def test_oversized_listing_is_refused(self, mock_get):
+        provider = AbacateProvider("token", "http://gateway/billing", "http://gateway/pix", timeout=5,
+                                   list_url="http://gateway/billing/list")
+        self.respond_get(mock_get, 200, b'{"data": [' + b'{"id": "bill_1"},' * 1000 + b'{}]}')
+
+        with self.assertRaises(GatewayResponseError):
+            provider.list_charges(1)
+        self.assertTrue(mock_get.call_args.kwargs['stream'])
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_network_errors_are_classified(self, mock_post):
+        mock_post.side_effect = requests.exceptions.ConnectTimeout
+        with self.assertRaises(GatewayUnavailable):
+            self.provider.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+
+        mock_post.side_effect = requests.exceptions.ReadTimeout
+        with self.assertRaises(GatewayTimeout):
+            self.provider.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_validation_failure_is_translated(self, mock_post):
+        self.respond(mock_post, 200, {"success": False, "error": "Invalid taxId"})
+
+        with self.assertRaises(GatewayRejected) as ctx:
+            self.provider.create_pix(TEMPLATE, "TestUser", CUSTOMER)
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.assertEqual(ctx.exception.user_message, "CPF inválido. Verifique se o número está correto.")
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_server_errors_count_against_health(self, mock_post):
+        self.respond(mock_post, 502, {"error": "Bad Gateway"})
+        backup = LocalProvider("backup")
+        router = GatewayRouter([self.provider, backup])
+
+        with self.assertRaises(GatewayServerError) as ctx:
+            router.create_billing(TEMPLATE, "TestUser", CUSTOMER)  # may have been processed: no failover
+        self.assertEqual(ctx.exception.status_code, 502)
+        self.assertEqual(backup.charges, {})
+        self.assertEqual(router.stats()["providers"]["abacate"]["failures"], 1)
+        self.assertEqual(router.stats()["order"], ["backup", "abacate"])
+
+        # 503 means the request was not processed, so even a billing fails over
+        self.respond(mock_post, 503, {"error": "Unavailable"})
+        router = GatewayRouter([self.provider, backup])
+        self.assertEqual(router.create_billing(TEMPLATE, "TestUser", CUSTOMER).provider, "backup")
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_billing_without_url(self, mock_post):
+        self.respond(mock_post, 200, {"data": {"id": "bill_1"}})
+        with self.assertRaises(GatewayResponseError):
+            self.provider.create_billing(TEMPLATE, "TestUser", CUSTOMER)
+
+
+if __name__ == '__main__':
+    unittest.main()
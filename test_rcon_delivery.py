@@ -0,0 +1,194 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from rcon_delivery import (
+    RconPool, DeliveryStore, DeliveryService, RconError,
+    encode_packet, read_packet, SERVERDATA_AUTH, SERVERDATA_AUTH_RESPONSE, SERVERDATA_EXECCOMMAND,
+    SERVERDATA_RESPONSE_VALUE
+)
+
+KIT_COMMANDS = {
+    "LORD": ["lp user {nickname} parent add lord", "say {nickname} agora e LORD"],
+    "KNIGHT": ["lp user {nickname} parent add knight"],
+}
+
+
+class FakeRconServer:
+    """
+    Minimal Minecraft-style RCON server: checks the password, answers every
+    command packet in order (in `fragments` packets each, like a long
+    output) and records what it executed. Other packet types get the
+    single "Unknown request" reply Minecraft sends.
+    """
+
+    def __init__(self, password="secret"):
+        self.password = password
+        self.commands = []
+        self.connections = 0
+        self.drop_next_connections = 0
+        self.fragments = 1
+        self._lock = threading.Lock()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                request_id, _, password = read_packet(conn)
+                ok = password == self.password
+                conn.sendall(encode_packet(request_id if ok else -1, SERVERDATA_AUTH_RESPONSE, ""))
+                if not ok:
+                    return
+                while True:
+                    request_id, packet_type, body = read_packet(conn)
+                    if packet_type != SERVERDATA_EXECCOMMAND:
+                        conn.sendall(encode_packet(request_id, SERVERDATA_RESPONSE_VALUE, "Unknown request 0"))
+                        continue
+                    with self._lock:
+                        if self.drop_next_connections:
+                            self.drop_next_connections -= 1
+                            return
+                        self.commands.append(body)
+                    reply = f"ok: {body}"
+                    size = -(-len(reply) // self.fragments)
+                    conn.sendall(b''.join(encode_packet(request_id, SERVERDATA_RESPONSE_VALUE, reply[i:i + size])
+                                          for i in range(0, len(reply), size)))
+            except (RconError, OSError):
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+class TestDeliveryService(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRconServer()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.tmpdir.name, "deliveries.db")
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            service.stop()
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def make_service(self, pool_size=2, password="secret", **kwargs):
+        pool = RconPool("127.0.0.1", self.server.port, password, size=pool_size, timeout=2)
+        kwargs.setdefault("retry_delay", 0.01)
+        kwargs.setdefault("kit_commands", KIT_COMMANDS)
+        service = DeliveryService(pool, DeliveryStore(self.store_path), **kwargs)
+        self.services.append(service)
+        return service
+
+    def test_burst_uses_bounded_connections(self):
+        service = self.make_service(pool_size=2)
+        for i in range(300):
+            service.enqueue(f"order-{i}", f"Player{i}", "KNIGHT")
+        service.start()
+        self.assertTrue(service.join(timeout=10))
+
+        self.assertEqual(len(self.server.commands), 300)
+        self.assertLessEqual(self.server.connections, 2)
+        stats = service.stats()
+        self.assertEqual(stats["delivered"], 300)
+        self.assertLess(stats["batches"], 300)
+
+    def test_split_responses_stay_with_their_batch(self):
+        self.server.fragments = 3
+        pool = RconPool("127.0.0.1", self.server.port, "secret", size=1, timeout=2)
+        self.addCleanup(pool.close)
+
+        self.assertEqual(pool.execute_batch(["list", "say hello world"]), ["ok: list", "ok: say hello world"])
+        self.assertEqual(pool.execute_batch(["tps"]), ["ok: tps"])
+        self.assertEqual(pool.connections_opened, 1)
+
+    def test_commands_are_rendered_per_order(self):
+        service = self.make_service()
+        service.start()
+        service.enqueue("order-1", "Notch", "LORD")
+        service.join(timeout=5)
+        self.assertEqual(self.server.commands, ["lp user Notch parent add lord", "say Notch agora e LORD"])
+
+    def test_duplicate_orders_delivered_once(self):
+        service = self.make_service()
+        service.start()
+        self.assertTrue(service.enqueue("order-1", "Notch", "KNIGHT"))
+        self.assertFalse(service.enqueue("order-1", "Notch", "KNIGHT"))
+        service.join(timeout=5)
+        self.assertFalse(service.enqueue("order-1", "Notch", "KNIGHT"))
+        self.assertEqual(len(self.server.commands), 1)
+        self.assertEqual(service.store.status("order-1")["status"], "delivered")
+
+    def test_rejects_nicknames_that_are_not_plain_names(self):
+        service = self.make_service()
+        with self.assertRaises(ValueError):
+            service.enqueue("order-1", "evil parent add owner", "LORD")
+        self.assertIsNone(service.store.status("order-1"))
+
+    def test_broken_command_template_fails_only_its_order(self):
+        service = self.make_service(pool_size=1, kit_commands={**KIT_COMMANDS, "LORD": ["give {player} x"]})
+        with self.assertRaises(ValueError):
+            service.enqueue("order-0", "Notch", "LORD")
+        self.assertIsNone(service.store.status("order-0"))
+
+        # Rows already in deliveries.db (e.g. from an older commands file) are not validated on enqueue
+        store = DeliveryStore(self.store_path)
+        store.add("order-1", "Notch", "LORD")
+        store.add("order-2", "jeb_", "CHAMPION")
+        store.add("order-3", "Notch", "KNIGHT")
+        service.start()
+        service.enqueue("order-4", "jeb_", "KNIGHT")
+        self.assertTrue(service.join(timeout=5))
+
+        self.assertEqual(sorted(self.server.commands),
+                         ["lp user Notch parent add knight", "lp user jeb_ parent add knight"])
+        for order_id in ("order-1", "order-2"):
+            status = service.store.status(order_id)
+            self.assertEqual(status["status"], "failed")
+            self.assertIn("delivery commands", status["last_error"])
+        self.assertEqual(service.stats()["failed"], 2)
+
+    def test_dropped_connection_is_retried(self):
+        self.server.drop_next_connections = 1
+        service = self.make_service()
+        service.start()
+        service.enqueue("order-1", "Notch", "KNIGHT")
+        self.assertTrue(service.join(timeout=5))
+        self.assertEqual(self.server.commands, ["lp user Notch parent add knight"])
+        self.assertEqual(service.stats()["retried"], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        service = self.make_service(password="wrong", max_attempts=2)
+        service.start()
+        service.enqueue("order-1", "Notch", "KNIGHT")
+        self.assertTrue(service.join(timeout=5))
+        self.assertEqual(service.store.status("order-1")["status"], "failed")
+
+    def test_pending_orders_resume_after_restart(self):
+        DeliveryStore(self.store_path).add("order-1", "Notch", "KNIGHT")
+        service = self.make_service()
+        service.start()
+        self.assertTrue(service.join(timeout=5))
+        self.assertEqual(self.server.commands, ["lp user Notch parent add knight"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from checkout_payloads import ProductTemplate
+from order_ledger import OrderLedger
+from payment_gateways import LocalProvider, GatewayUnavailable, GatewayRejected, GatewayResponseError
+from reconciliation import Reconciler
+
+TEMPLATE = ProductTemplate("LORD", 4990, "http://shop/success", "http://shop/success")
+CUSTOMER = {"name": "TestUser", "email": "a@b.com", "taxId": "12345678901", "cellphone": "5511999999999"}
+
+
+class CountingProvider(LocalProvider):
+    """
+    Stand-in gateway that records which pages were listed, which charges
+    were checked and how many listing calls overlapped, and can fail from a
+    given page or check on.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requested = []
+        self.fail_from_page = None
+        self.checked = []
+        self.fail_after_checks = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._count_lock = threading.Lock()
+
+    def list_charges(self, page, page_size=100):
+        if self.fail_from_page is not None and page >= self.fail_from_page:
+            raise GatewayUnavailable("gateway down")
+        with self._count_lock:
+            self.requested.append(page)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().list_charges(page, page_size)
+        finally:
+            with self._count_lock:
+                self.in_flight -= 1
+
+    def check_charge(self, charge_id):
+        with self._count_lock:
+            if self.fail_after_checks is not None and len(self.checked) >= self.fail_after_checks:
+                raise GatewayRejected(401, "token expired")
+            self.checked.append(charge_id)
+        return super().check_charge(charge_id)
+
+
+class UnpaginatedProvider(LocalProvider):
+    def list_charges(self, page, page_size=100):
+        return super().list_charges(1, 1_000_000)
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "orders.db")
+        self.ledger = OrderLedger(self.path, flush_interval=0.01)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reconciler(self, provider, **kwargs):
+        kwargs.setdefault("grace", -60)  # orders created during the test are inside the window
+        kwargs.setdefault("rate", 0)
+        return Reconciler(self.ledger, [provider], **kwargs)
+
+    def charge(self, provider, record=True, amount=4990, status="created"):
+        charge_id = provider.create_pix(TEMPLATE, "TestUser", CUSTOMER).charge_id
+        if record:
+            self.ledger.record_order(charge_id, "pix", "TestUser", "LORD", amount, "12345678901", status=status)
+        return charge_id
+
+    def by_type(self, reconciler, provider):
+        result = {}
+        for mismatch in reconciler.mismatches(provider.name):
+            result.setdefault(mismatch["type"], []).append(mismatch["charge_id"])
+        return result
+
+    def test_reports_mismatches_and_unacknowledged_payments(self):
+        gateway = LocalProvider()
+        paid_missed = self.charge(gateway)
+        gateway.mark_paid(paid_missed)
+        self.charge(gateway)  # pending on both sides
+        unknown = self.charge(gateway, record=False)
+        paid_locally = self.charge(gateway, status="paid")
+        wrong_amount = self.charge(gateway, amount=100)
+        self.ledger.record_order("local_pix_never_created", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.record_order("other_pix_1", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.flush()
+
+        confirmed = []
+        reconciler = self.reconciler(gateway, on_unacknowledged=confirmed.append)
+        summary = reconciler.run()["local"]
+
+        self.assertEqual(summary["status"], "done")
+        self.assertEqual(summary["charges"], 5)
+        self.assertEqual(self.by_type(reconciler, gateway), {
+            "unacknowledged_payment": [paid_missed],
+            "unknown_charge": [unknown],
+            "paid_locally_only": [paid_locally],
+            "amount_mismatch": [wrong_amount],
+            "missing_on_gateway": ["local_pix_never_created"],  # other_pix_1 belongs to another provider
+        })
+        self.assertEqual(confirmed, [paid_missed])
+
+    def test_oversold_orders_count_as_acknowledged(self):
+        gateway = LocalProvider()
+        oversold = self.charge(gateway, status="oversold")
+        gateway.mark_paid(oversold)
+        self.ledger.flush()
+
+        confirmed = []
+        reconciler = self.reconciler(gateway, on_unacknowledged=confirmed.append)
+        self.assertEqual(reconciler.run()["local"]["mismatches"], {})
+        self.assertEqual(confirmed, [])
+
+    def test_mismatch_pages_are_bounded(self):
+        gateway = LocalProvider()
+        for _ in range(5):
+            self.charge(gateway, record=False)
+        reconciler = self.reconciler(gateway)
+        reconciler.run()
+
+        self.assertEqual(len(reconciler.mismatches("local", limit=2)), 2)
+        self.assertEqual(len(reconciler.mismatches("local", limit=-1)), 1)
+
+    def test_streams_many_pages_with_bounded_concurrency_and_rate_limits(self):
+        gateway = CountingProvider(rate_limit_every=7)
+        for _ in range(2000):
+            self.charge(gateway, record=False)
+
+        reconciler = self.reconciler(gateway, concurrency=3, page_size=50)
+        summary = reconciler.run()["local"]
+
+        self.assertEqual(summary["charges"], 2000)
+        self.assertEqual(summary["pages"], 41)  # the 41st page comes back empty
+        self.assertEqual(summary["mismatches"], {"unknown_charge": 2000})
+        self.assertLessEqual(gateway.max_in_flight, 3)
+        row = sqlite3.connect(self.path).execute("SELECT COUNT(*) FROM reconcile_seen").fetchone()
+        self.assertEqual(row[0], 0)  # scratch ids are dropped once the run is done
+
+    def test_resumes_from_checkpoint(self):
+        gateway = CountingProvider()
+        for _ in range(120):
+            self.charge(gateway)
+        self.ledger.flush()
+
+        reconciler = self.reconciler(gateway, concurrency=2, page_size=25)
+        gateway.fail_from_page = 3
+        with self.assertRaises(GatewayUnavailable):
+            reconciler.run()
+        status = reconciler.status()["local"]
+        self.assertEqual((status["status"], status["pages"]), ("failed", 2))
+
+        gateway.fail_from_page = None
+        gateway.requested.clear()
+        summary = reconciler.run()["local"]
+
+        self.assertEqual(min(gateway.requested), 3)
+        self.assertEqual((summary["status"], summary["charges"]), ("done", 120))
+        self.assertEqual(summary["mismatches"], {})
+
+    def test_checks_orders_the_gateway_cannot_list(self):
+        gateway = CountingProvider(listed_kinds=("billing",))
+        paid_missed = self.charge(gateway)
+        gateway.mark_paid(paid_missed)
+        pending = self.charge(gateway)
+        self.charge(gateway, status="paid")  # nothing left to learn: not checked
+        self.ledger.record_order("local_pix_never_created", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.record_order("other_pix_1", "pix", "TestUser", "LORD", 4990, "12345678901")
+        self.ledger.flush()
+
+        confirmed = []
+        reconciler = self.reconciler(gateway, on_unacknowledged=confirmed.append)
+        summary = reconciler.run()["local"]
+
+        self.assertEqual((summary["status"], summary["charges"], summary["checked"]), ("done", 0, 3))
+        self.assertEqual(set(gateway.checked), {paid_missed, pending, "local_pix_never_created"})
+        self.assertEqual(self.by_type(reconciler, gateway), {
+            "unacknowledged_payment": [paid_missed],
+            "missing_on_gateway": ["local_pix_never_created"],
+        })
+        self.assertEqual(confirmed, [paid_missed])
+
+    def test_check_pass_resumes_from_checkpoint(self):
+        gateway = CountingProvider(listed_kinds=())
+        for _ in range(60):
+            self.charge(gateway)
+        self.ledger.flush()
+
+        reconciler = self.reconciler(gateway, page_size=25)
+        gateway.fail_after_checks = 30
+        with self.assertRaises(GatewayRejected):
+            reconciler.run()
+        status = reconciler.status()["local"]
+        self.assertEqual((status["status"], status["checked"]), ("failed", 25))
+
+        gateway.fail_after_checks = None
+        gateway.checked.clear()
+        summary = reconciler.run()["local"]
+
+        self.assertEqual(len(gateway.checked), 35)  # the committed chunk is not checked again
+        self.assertEqual((summary["status"], summary["checked"], summary["mismatches"]), ("done", 60, {}))
+
+    def test_listing_that_ignores_pagination_fails_the_run(self):
+        gateway = UnpaginatedProvider()
+        for _ in range(30):
+            self.charge(gateway)
+        self.ledger.flush()
+
+        reconciler = self.reconciler(gateway, page_size=10)
+        with self.assertRaises(GatewayResponseError):
+            reconciler.run()
+        status = reconciler.status()["local"]
+        self.assertEqual((status["status"], status["pages"]), ("failed", 0))
+        self.assertEqual(status["mismatches"], {})  # nothing reported missing from a partial listing
+
+    def test_only_one_run_at_a_time(self):
+        reconciler = self.reconciler(LocalProvider())
+        with reconciler._running:
+            self.assertIsNone(reconciler.run())
+            self.assertFalse(reconciler.start())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+
+from request_profiler import RequestProfiler, MemoryTracker
+
+
+class TestRequestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+
+        @self.app.route('/work')
+        def work():
+            return str(sum(i * i for i in range(10000)))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_client(self, **kwargs):
+        profiler = RequestProfiler(admin_token="admin", profile_dir=self.tmpdir.name, **kwargs)
+        profiler.init_app(self.app)
+        return profiler, self.app.test_client()
+
+    def test_disabled_by_default(self):
+        _, client = self.make_client()
+        response = client.get('/work')
+        self.assertNotIn('X-Profile-File', response.headers)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_header_requires_admin_token(self):
+        _, client = self.make_client()
+        client.get('/work', headers={'X-Profile': 'wrong'})
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+        response = client.get('/work', headers={'X-Profile': 'admin'})
+        self.assertIn(response.headers['X-Profile-File'], os.listdir(self.tmpdir.name))
+
+    def test_sampling_and_file_cap(self):
+        profiler, client = self.make_client(sample_rate=1.0, max_files=3)
+        for _ in range(5):
+            client.get('/work')
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 3)
+
+        summary = profiler.summary()
+        self.assertEqual(len(summary["profiles"]), 3)
+        self.assertTrue(any("work" in row["function"] for row in summary["functions"]))
+
+
+class TestMemoryTracker(unittest.TestCase):
+    def test_diff_reports_growth(self):
+        tracker = MemoryTracker()
+        self.assertIsNone(tracker.diff())
+        tracker.snapshot()
+        retained = [bytearray(1024) for _ in range(1000)]
+        diff = tracker.diff()
+        tracker.stop()
+
+        self.assertGreater(sum(row["size_diff_bytes"] for row in diff["top"]), 1000 * 1024)
+        self.assertEqual(len(retained), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import gzip
+import unittest
+from unittest.mock import patch
+
+from flask import Flask, jsonify, Response
+
+from response_compression import ResponseCompressor, choose_encoding
+
+BIG_PAYLOAD = {"brCodeBase64": "iVBORw0KGgo" * 4000}
+
+
+class TestChooseEncoding(unittest.TestCase):
+    def test_negotiation(self):
+        with patch('response_compression.brotli', None):
+            self.assertEqual(choose_encoding("gzip, deflate, br"), "gzip")
+            self.assertIsNone(choose_encoding("identity"))
+            self.assertIsNone(choose_encoding("gzip;q=0"))
+            self.assertEqual(choose_encoding("*"), "gzip")
+            self.assertIsNone(choose_encoding(""))
+
+    def test_prefers_brotli_when_available(self):
+        with patch('response_compression.brotli', object()):
+            self.assertEqual(choose_encoding("gzip, br"), "br")
+            self.assertEqual(choose_encoding("gzip, br;q=0.5"), "gzip")
+
+
+class TestResponseCompressor(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.compressor = ResponseCompressor(min_size=1024, stream_threshold=64 * 1024)
+        self.compressor.init_app(self.app)
+
+        @self.app.route('/big')
+        def big():
+            return jsonify(BIG_PAYLOAD)
+
+        @self.app.route('/small')
+        def small():
+            return jsonify({"ok": True})
+
+        @self.app.route('/huge')
+        def huge():
+            return Response("x" * (200 * 1024), mimetype="text/plain")
+
+        @self.app.route('/image')
+        def image():
+            return Response(b"\x89PNG" * 1000, mimetype="image/png")
+
+        self.client = self.app.test_client()
+
+    def test_large_json_is_gzipped(self):
+        response = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), jsonify_bytes(self.app, BIG_PAYLOAD))
+
+        stats = self.compressor.stats()["big"]
+        self.assertEqual(stats["compressed"], 1)
+        self.assertGreater(stats["bytes_saved"], 0)
+
+    def test_small_and_unaccepted_pass_through(self):
+        small = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', small.headers)
+
+        identity = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', identity.headers)
+
+    def test_images_not_compressed(self):
+        response = self.client.get('/image', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_large_body_streamed(self):
+        response = self.client.get('/huge', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gzip.decompress(response.data), b"x" * (200 * 1024))
+
+
+def jsonify_bytes(app, payload):
+    with app.app_context():
+        return jsonify(payload).get_data()
+
+
+if __name__ == '__main__':
+    unittest.main()
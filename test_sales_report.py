@@ -0,0 +1,84 @@
+import os
+import time
+import tempfile
+import unittest
+
+from order_ledger import OrderLedger
+from sales_report import SalesAggregator, bucket_start, DAY, HOUR, SALES_HOURLY_RETENTION_DAYS
+
+# Recent enough that the automatic compaction keeps its hourly buckets
+NOON = bucket_start(time.time() - DAY, "day") + 12 * HOUR
+
+
+class TestSalesAggregator(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ledger = OrderLedger(os.path.join(self.tmpdir.name, "orders.db"))
+        self.sales = SalesAggregator(self.ledger, cache_ttl=0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_bucket_start_uses_local_day(self):
+        self.assertEqual(bucket_start(NOON + 59, "hour"), NOON)
+        # Local midnight is 03:00 UTC
+        self.assertEqual(bucket_start(NOON, "day") % DAY, 3 * HOUR)
+
+    def test_report_totals_and_conversion(self):
+        for _ in range(4):
+            self.sales.order_created("LORD", "pix", NOON)
+        self.sales.order_created("GUARDIAN", "pix", NOON + HOUR)
+        self.sales.order_paid("LORD", "pix", 4990, NOON + 10)
+        self.sales.order_paid("GUARDIAN", "pix", 9990, NOON + HOUR + 10)
+
+        report = self.sales.report(NOON, NOON + 2 * HOUR)
+        self.assertEqual(report["totals"]["created"], 5)
+        self.assertEqual(report["totals"]["paid"], 2)
+        self.assertEqual(report["totals"]["revenue"], 14980)
+        self.assertEqual(report["totals"]["conversion"], 0.4)
+        self.assertEqual(report["products"]["LORD"],
+                         {"created": 4, "paid": 1, "revenue": 4990, "pix_created": 4, "pix_paid": 1})
+        self.assertEqual([b["bucket"] for b in report["series"]], [NOON, NOON + HOUR])
+
+    def test_conversion_counts_pix_only(self):
+        self.sales.order_created("LORD", "billing", NOON)
+        self.sales.order_paid("LORD", "billing", 4990, NOON + 10)
+        self.sales.order_created("LORD", "pix", NOON)
+
+        totals = self.sales.report(NOON, NOON + HOUR)["totals"]
+        self.assertEqual((totals["created"], totals["paid"], totals["revenue"]), (2, 1, 4990))
+        self.assertEqual((totals["pix_created"], totals["pix_paid"]), (1, 0))
+        self.assertEqual(totals["conversion"], 0.0)
+
+    def test_rollups_survive_restart(self):
+        self.sales.order_created("LORD", "pix", NOON)
+        self.sales.order_paid("LORD", "pix", 4990, NOON)
+        self.ledger.flush()
+
+        reloaded = SalesAggregator(self.ledger, cache_ttl=0)
+        self.assertEqual(reloaded.report(NOON, NOON + HOUR)["totals"]["revenue"], 4990)
+
+    def test_compaction_folds_hours_into_days(self):
+        self.sales.order_created("LORD", "pix", NOON)
+        self.sales.order_created("LORD", "pix", NOON + 2 * HOUR)
+        self.sales.order_paid("LORD", "pix", 4990, NOON + 2 * HOUR)
+        later = NOON + (SALES_HOURLY_RETENTION_DAYS + 2) * DAY
+
+        before = self.sales.report(NOON - DAY, NOON + DAY, "day")
+        self.sales.compact(now=later)
+        after = self.sales.report(NOON - DAY, NOON + DAY, "day")
+        self.assertEqual(before["totals"], after["totals"])
+        self.assertEqual(self.sales.report(NOON, NOON + 3 * HOUR)["series"], [])
+
+        # The fold is applied on disk too
+        self.ledger.flush()
+        reloaded = SalesAggregator(self.ledger, cache_ttl=0)
+        self.assertEqual(reloaded.report(NOON - DAY, NOON + DAY, "day")["totals"], after["totals"])
+
+    def test_range_limit(self):
+        with self.assertRaises(ValueError):
+            self.sales.report(NOON - 365 * DAY, NOON, "hour")
+
+
+if __name__ == '__main__':
+    unittest.main()
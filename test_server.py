@@ -2,7 +2,18 @@ import unittest
 from unittest.mock import patch, MagicMock
 import json
 import logging
+import os
+import time
+import tempfile
+import threading
 from server import app
+from order_ledger import OrderLedger
+from flash_sale import FlashSaleInventory, CONFIRMED
+from payment_gateways import GatewayRouter, LocalProvider
+from reconciliation import Reconciler
+from server import PRODUCT_TEMPLATES
+
+PRODUCT_TEMPLATE = PRODUCT_TEMPLATES["LORD"]
 
 # Disable logging during tests
 logging.disable(logging.CRITICAL)
@@ -19,7 +30,7 @@ class TestPaymentServer(unittest.TestCase):
             "cellphone": "11999999999"
         }
 
-    @patch('server.requests.Session.post')
+    @patch('payment_gateways.requests.Session.post')
     def test_create_payment_success(self, mock_post):
         # Mock successful response
         mock_response = MagicMock()
@@ -64,7 +75,19 @@ class TestPaymentServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertIn("Invalid product", data['error'])
 
-    @patch('server.requests.Session.post')
+    def test_validation_error_invalid_nickname_without_directory(self):
+        payload = self.valid_payload.copy()
+        payload['nickname'] = "evil parent add owner"
+
+        with patch('server.nickname_service', None):
+            response = self.app.post('/create-pix-payment',
+                                     data=json.dumps(payload),
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Invalid nickname", json.loads(response.data)['error'])
+
+    @patch('payment_gateways.requests.Session.post')
     def test_api_timeout(self, mock_post):
         # Mock timeout
         import requests
@@ -78,7 +101,7 @@ class TestPaymentServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['error'], "Payment Gateway Timeout")
 
-    @patch('server.requests.Session.post')
+    @patch('payment_gateways.requests.Session.post')
     def test_api_connection_error(self, mock_post):
         # Mock connection error
         import requests
@@ -92,7 +115,7 @@ class TestPaymentServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['error'], "Connection Error")
 
-    @patch('server.requests.Session.post')
+    @patch('payment_gateways.requests.Session.post')
     def test_api_error_response(self, mock_post):
         # Mock 500 from API
         mock_response = MagicMock()
@@ -108,5 +131,277 @@ class TestPaymentServer(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['error'], "Payment Gateway Error")
 
+    def test_nickname_check_without_directory(self):
+        with patch('server.nickname_service', None):
+            response = self.app.get('/nickname/TestUser')
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(data['exists'])
+        self.assertFalse(data['verified'])
+
+    def test_nickname_check_invalid_format(self):
+        response = self.app.get('/nickname/a!')
+        self.assertEqual(response.status_code, 400)
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_unknown_player_rejected_before_gateway(self, mock_post):
+        service = MagicMock()
+        service.exists.return_value = False
+
+        with patch('server.nickname_service', service):
+            response = self.app.post('/create-payment',
+                                     data=json.dumps(self.valid_payload),
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Player not found", json.loads(response.data)['error'])
+        mock_post.assert_not_called()
+
+    def test_batch_nickname_check(self):
+        service = MagicMock()
+        service.exists_many.return_value = {"testuser": True, "herobrine": False}
+
+        with patch('server.nickname_service', service):
+            response = self.app.post('/nicknames',
+                                     data=json.dumps({"nicknames": ["TestUser", "Herobrine"]}),
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['results'], {"TestUser": True, "Herobrine": False})
+
+    def test_avatar_served_with_cache_headers(self):
+        from avatar_proxy import AvatarEntry
+        with patch('server.avatar_proxy.get') as mock_get:
+            mock_get.return_value = (AvatarEntry(b"png-bytes"), False)
+            response = self.app.get('/avatar/TestUser')
+            revalidated = self.app.get('/avatar/TestUser', headers={'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"png-bytes")
+        self.assertIn("max-age=86400", response.headers['Cache-Control'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_delivery_requires_admin_token(self):
+        service = MagicMock()
+        service.enqueue.return_value = True
+        with patch('server.delivery_service', service), patch('server.ADMIN_API_TOKEN', 'admin'):
+            denied = self.app.post('/deliveries', data=json.dumps({}), content_type='application/json')
+            queued = self.app.post('/deliveries',
+                                   data=json.dumps({"order_id": "pix_1", "nickname": "TestUser", "product": "KIT LORD"}),
+                                   content_type='application/json',
+                                   headers={'X-Admin-Token': 'admin'})
+
+        self.assertEqual(denied.status_code, 401)
+        self.assertEqual(queued.status_code, 202)
+        service.enqueue.assert_called_once_with("pix_1", "TestUser", "LORD")
+
+    @patch('server.order_ledger')
+    @patch('payment_gateways.requests.Session.post')
+    def test_pix_payment_recorded_in_ledger(self, mock_post, mock_ledger):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"data": {"id": "pix_123", "brCode": "000201", "brCodeBase64": "iVBOR"}}
+        mock_post.return_value = mock_response
+
+        response = self.app.post('/create-pix-payment',
+                                 data=json.dumps(self.valid_payload),
+                                 content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        mock_ledger.record_order.assert_called_once_with(
+            "pix_123", "pix", "TestUser", "LORD", 4990, "12345678901", "test@example.com"
+        )
+
+    @patch('server.delivery_service')
+    @patch('server.sales_aggregator')
+    @patch('server.order_ledger')
+    def test_paid_webhook_confirms_order_once(self, mock_ledger, mock_sales, mock_delivery):
+        mock_ledger.get.return_value = {
+            "order_id": "pix_w1", "kind": "pix", "nickname": "TestUser", "product": "LORD", "amount": 4990, "status": "created"
+        }
+        event = {"event": "billing.paid", "data": {"pixQrCode": {"id": "pix_w1", "status": "PAID"}}}
+
+        with patch('server.ABACATE_WEBHOOK_SECRET', 'hook'):
+            denied = self.app.post('/webhook/abacate-pay?webhookSecret=wrong', data=json.dumps(event),
+                                   content_type='application/json')
+            for _ in range(2):
+                response = self.app.post('/webhook/abacate-pay?webhookSecret=hook', data=json.dumps(event),
+                                         content_type='application/json')
+
+        self.assertEqual(denied.status_code, 401)
+        self.assertEqual(response.status_code, 200)
+        mock_ledger.update_status.assert_called_once_with("pix_w1", "paid")
+        mock_sales.order_paid.assert_called_once_with("LORD", "pix", 4990)
+        mock_delivery.enqueue.assert_called_once_with("pix_w1", "TestUser", "LORD")
+
+    @patch('server.delivery_service')
+    @patch('server.sales_aggregator')
+    @patch('server.order_ledger')
+    def test_failed_confirmation_can_be_retried(self, mock_ledger, mock_sales, mock_delivery):
+        mock_ledger.get.return_value = {
+            "order_id": "pix_w2", "kind": "pix", "nickname": "TestUser", "product": "LORD", "amount": 4990, "status": "created"
+        }
+        mock_delivery.enqueue.side_effect = [ValueError("No delivery commands for product: LORD"), True]
+        event = {"event": "billing.paid", "data": {"pixQrCode": {"id": "pix_w2", "status": "PAID"}}}
+
+        with patch('server.ABACATE_WEBHOOK_SECRET', 'hook'):
+            responses = [self.app.post('/webhook/abacate-pay?webhookSecret=hook', data=json.dumps(event),
+                                       content_type='application/json') for _ in range(2)]
+
+        self.assertEqual([r.status_code for r in responses], [500, 200])
+        self.assertEqual(mock_delivery.enqueue.call_count, 2)
+        mock_ledger.update_status.assert_called_once_with("pix_w2", "paid")
+        mock_sales.order_paid.assert_called_once_with("LORD", "pix", 4990)
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_pix_payload_sent_to_gateway(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"data": {"id": "pix_456", "brCode": "000201", "brCodeBase64": "iVBOR"}}
+        mock_post.return_value = mock_response
+
+        self.app.post('/create-pix-payment', data=json.dumps(self.valid_payload), content_type='application/json')
+
+        sent = json.loads(mock_post.call_args.kwargs['data'])
+        self.assertEqual(sent, {
+            "amount": 4990,
+            "description": "VIP LORD - TestUser",
+            "customer": {"name": "TestUser", "email": "test@example.com",
+                         "taxId": "12345678901", "cellphone": "5511999999999"}
+        })
+
+    def flash_inventory(self, stock):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        inventory = FlashSaleInventory(OrderLedger(os.path.join(tmpdir.name, "orders.db")), shard_count=4)
+        inventory.configure("LORD", stock, 2990, time.time() - 1, time.time() + 3600)
+        return inventory
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_flash_sale_sells_limited_stock_at_sale_price(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"data": {"id": "pix_f1", "brCode": "000201", "brCodeBase64": "iVBOR"}}
+        mock_post.return_value = mock_response
+        inventory = self.flash_inventory(stock=1)
+
+        with patch('server.flash_inventory', inventory):
+            first = self.app.post('/create-pix-payment', data=json.dumps(self.valid_payload),
+                                  content_type='application/json')
+            second = self.app.post('/create-pix-payment', data=json.dumps(self.valid_payload),
+                                   content_type='application/json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 409)
+        self.assertEqual(mock_post.call_count, 1)
+        sent = json.loads(mock_post.call_args.kwargs['data'])
+        self.assertEqual(sent["amount"], 2990)
+        self.assertEqual(sent["expiresIn"], inventory.reservation_ttl)
+        self.assertEqual(inventory.confirm("pix_f1"), CONFIRMED)
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_flash_sale_reservation_released_on_gateway_error(self, mock_post):
+        mock_response = MagicMock()
+        mock_response.status_code = 500
+        mock_response.json.return_value = {"error": "Internal Error"}
+        mock_post.return_value = mock_response
+        inventory = self.flash_inventory(stock=1)
+
+        with patch('server.flash_inventory', inventory):
+            response = self.app.post('/create-pix-payment', data=json.dumps(self.valid_payload),
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(inventory.active_sale("LORD").available(), 1)
+
+    @patch('payment_gateways.requests.Session.post')
+    def test_flash_sale_refuses_billing_checkout(self, mock_post):
+        with patch('server.flash_inventory', self.flash_inventory(stock=5)):
+            response = self.app.post('/create-payment', data=json.dumps(self.valid_payload),
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 409)
+        mock_post.assert_not_called()
+
+    def test_flash_sale_drop_under_concurrent_pix_checkouts(self):
+        stock, clients, attempts_per_client = 50, 32, 60
+        inventory = self.flash_inventory(stock=stock)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        ledger = OrderLedger(os.path.join(tmpdir.name, "orders.db"), flush_interval=0.01)
+        gateway = LocalProvider()
+        statuses = []
+        start = threading.Barrier(clients)
+
+        def buyer():
+            client = app.test_client()
+            start.wait()
+            for _ in range(attempts_per_client):
+                response = client.post('/create-pix-payment', data=json.dumps(self.valid_payload),
+                                       content_type='application/json')
+                statuses.append(response.status_code)
+
+        with patch('server.flash_inventory', inventory), patch('server.order_ledger', ledger), \
+                patch('server.payment_router', GatewayRouter([gateway])), patch('server.sales_aggregator'):
+            threads = [threading.Thread(target=buyer) for _ in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        attempts = clients * attempts_per_client
+        self.assertEqual(statuses.count(200), stock)
+        self.assertEqual(statuses.count(409), attempts - stock)
+        self.assertEqual(len(gateway.charges), stock)  # sold-out attempts never reach the gateway
+        self.assertEqual(inventory.active_sale("LORD").available(), 0)
+        self.assertTrue(ledger.flush())
+        self.assertEqual(len(ledger.find(product="LORD", limit=100)), stock)
+
+    def test_stock_endpoint_is_cacheable(self):
+        with patch('server.flash_inventory', self.flash_inventory(stock=3)):
+            response = self.app.get('/stock')
+            revalidated = self.app.get('/stock', headers={'If-None-Match': response.headers['ETag']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertEqual(response.get_json()["sales"]["LORD"]["available"], 3)
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_pix_fails_over_to_backup_provider(self):
+        router = GatewayRouter([LocalProvider("primary", failure="timeout"), LocalProvider("backup")])
+
+        with patch('server.payment_router', router), patch('server.ADMIN_API_TOKEN', 'admin'):
+            response = self.app.post('/create-pix-payment', data=json.dumps(self.valid_payload),
+                                     content_type='application/json')
+            stats = self.app.get('/debug/gateways', headers={'X-Admin-Token': 'admin'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_json()["pixId"].startswith("backup_pix_"))
+        self.assertEqual(stats.get_json()["decisions"][0]["provider"], "backup")
+
+    def test_reconciliation_endpoints(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        ledger = OrderLedger(os.path.join(tmpdir.name, "orders.db"))
+        gateway = LocalProvider()
+        reconciler = Reconciler(ledger, [gateway], grace=-60, rate=0)
+        charge_id = gateway.create_pix(PRODUCT_TEMPLATE, "TestUser", {}).charge_id
+
+        with patch('server.reconciler', reconciler), patch('server.ADMIN_API_TOKEN', 'admin'):
+            headers = {'X-Admin-Token': 'admin'}
+            denied = self.app.post('/reconciliation/run')
+            started = self.app.post('/reconciliation/run', headers=headers)
+            with reconciler._running:  # held until the background run finishes
+                pass
+            status = self.app.get('/reconciliation', headers=headers)
+            mismatches = self.app.get('/reconciliation/mismatches?type=unknown_charge', headers=headers)
+
+        self.assertEqual(denied.status_code, 401)
+        self.assertEqual(started.status_code, 202)
+        self.assertEqual(status.get_json()["local"]["status"], "done")
+        self.assertEqual([m["charge_id"] for m in mismatches.get_json()["mismatches"]], [charge_id])
+
 if __name__ == '__main__':
     unittest.main()